@@ -3,20 +3,28 @@ import argparse
 import pandas as pd
 from astropy.time import Time
 from emgwcave.kowalski_utils import search_in_skymap, connect_kowalski, \
-    default_projection_kwargs
+    default_projection_kwargs, get_connection_stats, search_latest_in_skymap
 from emgwcave.plotting import plot_skymap, save_thumbnails, make_full_pdf
 from emgwcave.candidate_utils import save_candidates_to_file, \
     append_photometry_to_candidates, write_photometry_to_file, get_thumbnails, \
     deduplicate_candidates, get_candidates_in_localization, \
-    get_candidates_crossmatch, annotate_candidates
+    get_candidates_crossmatch, annotate_candidates, append_3d_localization_scores, \
+    get_candidates_in_any_localization, wait_for_background_saves
 from emgwcave.fritz_filter import pythonised_fritz_emgw_filter_stage_1, \
-    pythonised_fritz_emgw_filter_stationary_stage
+    pythonised_fritz_emgw_filter_stationary_stage, \
+    get_fritz_emgw_stage_1_mongo_filter, verify_server_side_filter
 import os
-from emgwcave.skymap_utils import get_mjd_from_skymap
-from copy import deepcopy
+from emgwcave.skymap_utils import get_mjd_from_skymap, write_union_skymap, \
+    write_coarsened_skymap
 from pathlib import Path
 from emgwcave.fritz_utils import query_candidates_fritz
+from emgwcave.query_cache import default_cache_dir, get_staleness_warning
+from emgwcave.enrichment import enrich_candidates
+from emgwcave.followup import FollowupState, default_ingestion_margin_hours
+from emgwcave.candidate_table import CandidateTable, get_candidate_field
+from emgwcave.photometry import make_photometry_table, check_parquet_support
 import numpy as np
+import time
 
 
 def setup_output_directories(output_dir: str):
@@ -40,7 +48,19 @@ def filter_candidates(skymap_path: str | Path,
                       outdir='emgwcave_output',
                       nthreads: int = 8,
                       min_ndethist: int = 1,
-                      localization_compare_skymappath: str | Path = None):
+                      localization_compare_skymappath: str | Path = None,
+                      query_chunk_size: int = 200,
+                      cache_dir: str | Path = None,
+                      cache_max_size_mb: float = 2048,
+                      concurrent_enrichment: bool = False,
+                      server_side_filter: bool = False,
+                      server_side_filter_check_size: int = 100,
+                      full_aux_projection: bool = False,
+                      followup_state: FollowupState = None,
+                      skymap_versions: list[str | Path] = None,
+                      query_tiles: int = None,
+                      coarsen_max_cells: int = None,
+                      latest_alert_only: bool = False):
     # TODO: use different dates for jd and jdstarthist, as jdstarthist is
     #  3-sigma detections. So the default should be search for all alerts generated in
     #  the given time windo (i.e. now), but filter through only those that have
@@ -51,62 +71,189 @@ def filter_candidates(skymap_path: str | Path,
     #  instead of arbitrarily large days.
 
     jd_event = mjd_event + 2400000.5
+    filter_kwargs = {"candidate.ndethist": {"$gt": min_ndethist}}
+    server_side_filter = server_side_filter & (filter == 'fritz')
+
+    # By default, only the aux fields used downstream are retrieved
+    photometry_projection, crossmatch_projection = None, None
+    if full_aux_projection:
+        photometry_projection = {'prv_candidates': 1}
+        crossmatch_projection = {'cross_matches': 1}
+
+    # In follow-up mode, only query the alerts since the last run
+    query_start_jd = start_date_jd
+    if followup_state is not None:
+        query_start_jd = followup_state.get_query_start(start_date_jd)
+
+    # With several versions of the skymap, query the union of their credible
+    # regions once
+    query_skymap_path, query_cumprob = skymap_path, cumprob
+    if skymap_versions is not None:
+        skymap_paths = [skymap_path] + list(skymap_versions)
+        query_skymap_path = os.path.join(outdir, 'union_skymap.fits')
+        query_cumprob = write_union_skymap(skymap_paths, cumprob=cumprob,
+                                           savepath=query_skymap_path)
+
+    # Optionally query a coarsened superset of the credible region, with fewer
+    # cells, the exact credible levels are checked locally afterwards
+    if coarsen_max_cells is not None:
+        exact_query_skymap_path, exact_query_cumprob = query_skymap_path, query_cumprob
+        coarsened_skymap_path = os.path.join(outdir, 'coarsened_skymap.fits')
+        query_cumprob, coarsened_order, exact_area, coarsened_area = \
+            write_coarsened_skymap(query_skymap_path, cumprob=query_cumprob,
+                                   savepath=coarsened_skymap_path,
+                                   max_cells=coarsen_max_cells)
+        query_skymap_path = coarsened_skymap_path
+        print(f"Querying the credible region coarsened to order {coarsened_order} : "
+              f"{coarsened_area:.1f} sq. deg. instead of {exact_area:.1f} sq. deg. "
+              f"(+{100 * (coarsened_area / exact_area - 1):.1f}%)")
+
     # Set up Kowalski connection and run query
-    kowalski = connect_kowalski()
-    candidates = search_in_skymap(k=kowalski,
-                                  skymap_path=skymap_path,
-                                  cumprob=cumprob,
-                                  jd_start=start_date_jd,
-                                  jd_end=end_date_jd,
-                                  jdstarthist_start=jd_event,
-                                  jdstarthist_end=jd_event + time_window_days,
-                                  catalogs=[f'{instrument}_alerts'],
-                                  projection_kwargs=default_projection_kwargs,
-                                  max_n_threads=nthreads,
-                                  filter_kwargs={"candidate.ndethist":
-                                                     {"$gt": min_ndethist}}
-                                  )
-
-    selected_candidates = candidates['default'][f'{instrument}_alerts']
-    print(f"Retrieved {len(selected_candidates)} alerts.")
+    kowalski = connect_kowalski(pool_maxsize=max(nthreads, 32),
+                                cache_dir=cache_dir,
+                                cache_max_size_mb=cache_max_size_mb)
+    t0 = time.perf_counter()
+    search_kwargs = dict(k=kowalski,
+                         skymap_path=query_skymap_path,
+                         cumprob=query_cumprob,
+                         jd_start=query_start_jd,
+                         jd_end=end_date_jd,
+                         jdstarthist_start=jd_event,
+                         jdstarthist_end=jd_event + time_window_days,
+                         catalogs=[f'{instrument}_alerts'],
+                         projection_kwargs=default_projection_kwargs,
+                         max_n_threads=nthreads,
+                         filter_kwargs=filter_kwargs,
+                         n_tiles=query_tiles,
+                         timings_path=f'{outdir}/query_tile_timings.csv',
+                         chunk_size=query_chunk_size)
+    queried_object_ids = None
+    if server_side_filter:
+        # Let kowalski apply the cheap stage 1 cuts to the newest alert of each
+        # object, i.e. after deduplication as locally. A sample of the rejected
+        # alerts is retrieved to verify the cuts.
+        alerts, object_ids, rejected_alerts = search_latest_in_skymap(
+            **search_kwargs, latest_filter=get_fritz_emgw_stage_1_mongo_filter(),
+            n_rejected_sample=server_side_filter_check_size)
+        selected_candidates = alerts[f'{instrument}_alerts']
+        queried_object_ids = object_ids[f'{instrument}_alerts']
+        rejected_alerts = rejected_alerts[f'{instrument}_alerts']
+    else:
+        candidates = search_in_skymap(**search_kwargs, latest_only=latest_alert_only)
+        selected_candidates = candidates['default'][f'{instrument}_alerts']
+    query_time = time.perf_counter() - t0
+    print(f"Retrieved {len(selected_candidates)} alerts in {query_time:.1f} s.")
 
     if len(selected_candidates) == 0:
+        if followup_state is not None:
+            selected_candidates = followup_state.merge(
+                selected_candidates, updated_object_ids=queried_object_ids)
+            followup_state.update(selected_candidates, jd_end=end_date_jd)
         return selected_candidates
 
-    # Deduplicate candidates
-    selected_candidates = deduplicate_candidates(selected_candidates)
-    print(f"Retained {len(selected_candidates)} alerts after deduplication.")
+    # Carry the alerts through the pipeline as columns
+    selected_candidates = CandidateTable.from_alerts(selected_candidates)
 
-    save_candidates_to_file(deepcopy(selected_candidates),
-                            savefile=f'{outdir}/all_retrieved_alerts.csv')
+    # Deduplicate candidates (a no-op if only the latest alerts were retrieved)
+    selected_candidates = deduplicate_candidates(selected_candidates)
+    n_deduplicated = len(selected_candidates)
+    retrieved_object_ids = get_candidate_field(selected_candidates,
+                                               'objectId').tolist()
+    if queried_object_ids is not None:
+        # Including the objects whose newest alert was rejected by kowalski
+        retrieved_object_ids = queried_object_ids
+    print(f"Retained {n_deduplicated} alerts after deduplication.")
+    if coarsen_max_cells is not None:
+        # The extra alerts are those outside the region that would have been queried
+        # without coarsening, not those removed by -additional_skymappath
+        n_inside_query = len(get_candidates_in_localization(
+            selected_candidates, exact_query_skymap_path, exact_query_cumprob))
+        print(f"Coarsened query took {query_time:.1f} s and returned "
+              f"{n_deduplicated} alerts, {n_inside_query} of them inside the exact "
+              f"credible region ({n_deduplicated - n_inside_query} extra alerts)")
+
+    # Intermediate files are written in the background while the pipeline goes on
+    save_candidates_to_file(selected_candidates,
+                            savefile=f'{outdir}/all_retrieved_alerts.csv',
+                            background=True)
 
     if localization_compare_skymappath is None:
         localization_compare_skymappath = skymap_path
     # Perform a second check for candidates in the skymap
-    selected_candidates = get_candidates_in_localization(selected_candidates,
-                                                         localization_compare_skymappath,
-                                                         cumprob)
+    if skymap_versions is not None:
+        selected_candidates = get_candidates_in_any_localization(selected_candidates,
+                                                                 skymap_paths,
+                                                                 cumprob)
+    else:
+        selected_candidates = get_candidates_in_localization(
+            selected_candidates, localization_compare_skymappath, cumprob)
     print(f"Retained {len(selected_candidates)} alerts after localization check.")
-    save_candidates_to_file(deepcopy(selected_candidates),
-                            savefile=f'{outdir}/alerts_inside_localization.csv')
+    save_candidates_to_file(selected_candidates,
+                            savefile=f'{outdir}/alerts_inside_localization.csv',
+                            background=True)
 
     if filter == 'fritz':
+        if server_side_filter:
+            # Keep the alerts that went in, to verify the server-side cuts on them
+            candidates_inside_localization = selected_candidates
         selected_candidates = pythonised_fritz_emgw_filter_stage_1(
-            selected_candidates, save=True, outdir=outdir)
+            selected_candidates, save=True, outdir=outdir, background_save=True)
+        if server_side_filter:
+            mismatched_candidates = verify_server_side_filter(
+                candidates_inside_localization, rejected_sources=rejected_alerts)
+            if len(mismatched_candidates) > 0:
+                save_candidates_to_file(
+                    mismatched_candidates,
+                    savefile=f'{outdir}/server_side_filter_mismatches.csv',
+                    background=True)
     print(f"Filtered {len(selected_candidates)} alerts.")
 
-    # Get full photometry history for the selected candidates
-    selected_candidates = append_photometry_to_candidates(selected_candidates)
+    if concurrent_enrichment:
+        # Fetch photometry, crossmatches and cutouts at the same time. The
+        # crossmatches and cutouts are fetched for all candidates that passed stage 1,
+        # not only for the ones that pass the stationary stage.
+        selected_candidates = enrich_candidates(selected_candidates,
+                                                k=kowalski,
+                                                instrument=instrument,
+                                                max_concurrent_queries=nthreads,
+                                                chunk_size=query_chunk_size,
+                                                photometry_projection=photometry_projection,
+                                                crossmatch_projection=crossmatch_projection)
+    else:
+        # Get full photometry history for the selected candidates
+        selected_candidates = append_photometry_to_candidates(
+            selected_candidates, k=kowalski, chunk_size=query_chunk_size,
+            n_threads=nthreads, projection=photometry_projection)
 
     if filter == 'fritz':
         selected_candidates = pythonised_fritz_emgw_filter_stationary_stage(
             selected_candidates, mjd_event=mjd_event,
-            save=True, outdir=outdir)
+            save=True, outdir=outdir, background_save=True)
 
     print(f"Filtered {len(selected_candidates)} alerts.")
 
-    selected_candidates = get_candidates_crossmatch(selected_candidates)
-    selected_candidates = annotate_candidates(selected_candidates)
+    if followup_state is not None:
+        # Only the objects with new alerts went through the filters and got their
+        # photometry refreshed, merge them with the previously retained candidates
+        selected_candidates = followup_state.merge(
+            selected_candidates, updated_object_ids=retrieved_object_ids)
+        print(f"Retained {len(selected_candidates)} candidates after merging with "
+              f"previous runs.")
+
+    if not concurrent_enrichment:
+        # Crossmatches of candidates retained by previous runs are kept
+        missing_crossmatch = [candidate for candidate in selected_candidates
+                              if 'cross_matches' not in candidate]
+        get_candidates_crossmatch(missing_crossmatch, k=kowalski,
+                                  chunk_size=query_chunk_size, n_threads=nthreads,
+                                  projection=crossmatch_projection)
+    selected_candidates = annotate_candidates(selected_candidates, k=kowalski)
+    selected_candidates = append_3d_localization_scores(
+        selected_candidates, localization_compare_skymappath)
+
+    if followup_state is not None:
+        followup_state.update(selected_candidates, jd_end=end_date_jd)
+    wait_for_background_saves()
     return selected_candidates
 
 
@@ -143,9 +290,73 @@ if __name__ == '__main__':
     parser.add_argument("-nthreads", type=int, help="How many threads "
                                                     "to use on kowalski",
                         default=8)
+    parser.add_argument("-query_chunk_size", type=int, default=200,
+                        help="Number of objects to bundle in each batched "
+                             "kowalski query")
+    parser.add_argument("-cache_dir", "--cache-dir", type=str,
+                        default=None,
+                        help="Cache kowalski query results in this directory, "
+                             f"e.g. {default_cache_dir}. Off by default. Results "
+                             "of live queries (photometry history, recent alerts) "
+                             "are reused for up to an hour.")
+    parser.add_argument("-no_cache", "--no-cache", action="store_true",
+                        help="Do not read or write the kowalski query cache, "
+                             "even if -cache_dir is given")
+    parser.add_argument("-cache_max_size_mb", type=float, default=2048,
+                        help="Size cap of the query cache, least recently used "
+                             "results are evicted beyond it")
+    parser.add_argument("-concurrent_enrichment", action="store_true",
+                        help="Fetch photometry, crossmatches and cutouts "
+                             "concurrently after the first filtering stage")
+    parser.add_argument("-server_side_filter", action="store_true",
+                        help="Apply the cheap cuts of the first fritz filtering "
+                             "stage on kowalski, to the newest alert of each object "
+                             "(implies -latest_alert_only), and only verify them "
+                             "locally, in both directions on a sample of the "
+                             "rejected alerts")
+    parser.add_argument("-full_aux_projection", action="store_true",
+                        help="Retrieve all fields of the photometry history and "
+                             "crossmatches, not only the ones used by emgwcave")
+    parser.add_argument("-followup", action="store_true",
+                        help="Incremental follow-up mode : only query alerts since "
+                             "the last run in outdir, and merge them with the "
+                             "candidates retained so far")
+    parser.add_argument("-followup_ingestion_margin_hours", type=float,
+                        default=default_ingestion_margin_hours,
+                        help="In follow-up mode, also query again the alerts up to "
+                             "this long before the end of the last run, that "
+                             "kowalski may have ingested after it")
+    parser.add_argument("-skymap_versions", type=str, nargs='+', default=None,
+                        help="Paths to other versions of the skymap of the same "
+                             "event. Kowalski is queried once with the union of "
+                             "all credible regions, and the credible level of each "
+                             "candidate in each map is reported")
+    parser.add_argument("-query_tiles", type=int, default=None,
+                        help="Split the credible region into this many equal-area "
+                             "tiles queried by -nthreads workers, instead of a single "
+                             "skymap query. Tiles whose query fails are split further. "
+                             "Per-tile timings are saved to query_tile_timings.csv")
+    parser.add_argument("-coarsen_max_cells", type=int, default=None,
+                        help="Query kowalski with a coarsened superset of the "
+                             "credible region with at most this many HEALPix cells. "
+                             "Alerts outside the exact credible region are removed "
+                             "locally")
+    parser.add_argument("-latest_alert_only", action="store_true",
+                        help="Only retrieve the newest alert of each object in the "
+                             "credible region, deduplicating on kowalski instead of "
+                             "after transferring all alerts")
+    parser.add_argument("-output_format", type=str, choices=['csv', 'parquet'],
+                        default='csv',
+                        help="Format of the candidates file and light curves. "
+                             "parquet writes a compressed candidates file and a "
+                             "single photometry dataset partitioned by objectId "
+                             "(requires pyarrow)")
     parser.add_argument("-plot_skymap", action="store_true")
     parser.add_argument("-plot_lightcurves_separately", action="store_true")
     parser.add_argument("-plot_thumbnails_separately", action="store_true")
+    parser.add_argument("-keep_raw_cutouts", action="store_true",
+                        help="Also save the raw gzipped FITS cutouts to "
+                             "thumbnails/thumbnails_raw.npz, for provenance")
     parser.add_argument("-date_event", type=str, default=None,
                         help="e.g. 2023-04-22T00:00:00")
     parser.add_argument("-do_fritz_comparison", action="store_true")
@@ -180,16 +391,30 @@ if __name__ == '__main__':
     # Set up paths and directories
     output_dir = args.outdir
 
+    if args.output_format == 'parquet':
+        # Fail before querying kowalski if the outputs can not be written
+        check_parquet_support()
+
     savefile = os.path.join(output_dir,
                             f"{os.path.basename(skymap_path).split('.fits')[0]}"
                             f"_{args.instrument}_alerts_cumprob{args.cumprob}"
                             f"_{round(start_date_jd, 2)}_{round(end_date_jd, 2)}"
-                            f".csv")
+                            f".{args.output_format}")
 
-    full_pdffile = savefile.replace(".csv", ".pdf")
+    full_pdffile = savefile.replace(f".{args.output_format}", ".pdf")
 
     phot_dir, thumbnails_dir = setup_output_directories(output_dir)
 
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    followup_state = None
+    if args.followup:
+        followup_state = FollowupState.load(
+            outdir=output_dir, skymap_path=skymap_path, cumprob=args.cumprob,
+            skymap_versions=args.skymap_versions,
+            localization_compare_skymappath=args.additional_skymappath,
+            ingestion_margin_hours=args.followup_ingestion_margin_hours)
+
     selected_candidates = filter_candidates(skymap_path=args.skymappath,
                                             cumprob=args.cumprob,
                                             time_window_days=args.time_window_days,
@@ -202,10 +427,27 @@ if __name__ == '__main__':
                                             nthreads=args.nthreads,
                                             outdir=output_dir,
                                             localization_compare_skymappath=localization_compare_skymappath,
+                                            query_chunk_size=args.query_chunk_size,
+                                            cache_dir=cache_dir,
+                                            cache_max_size_mb=args.cache_max_size_mb,
+                                            concurrent_enrichment=args.concurrent_enrichment,
+                                            server_side_filter=args.server_side_filter,
+                                            full_aux_projection=args.full_aux_projection,
+                                            followup_state=followup_state,
+                                            skymap_versions=args.skymap_versions,
+                                            query_tiles=args.query_tiles,
+                                            coarsen_max_cells=args.coarsen_max_cells,
+                                            latest_alert_only=args.latest_alert_only,
                                             )
 
-    # Get thumbnails
-    selected_candidates = get_thumbnails(selected_candidates)
+    # Get thumbnails, unless they were already fetched during enrichment
+    missing_thumbnails = [candidate for candidate in selected_candidates
+                          if 'cutoutScience' not in candidate]
+    get_thumbnails(missing_thumbnails,
+                   k=connect_kowalski(),
+                   instrument=args.instrument,
+                   chunk_size=args.query_chunk_size,
+                   n_threads=args.nthreads)
 
     # Make diagnostic plots
     ras = [x['candidate']['ra'] for x in selected_candidates]
@@ -213,22 +455,43 @@ if __name__ == '__main__':
     if args.plot_skymap:
         plot_skymap(skymap_path, output_dir, flatten=True, ras=ras, decs=decs)
 
-    save_thumbnails(selected_candidates,
-                    thumbnails_dir=thumbnails_dir,
-                    plot=args.plot_thumbnails_separately)
+    thumbnails = save_thumbnails(selected_candidates,
+                                 thumbnails_dir=thumbnails_dir,
+                                 plot=args.plot_thumbnails_separately,
+                                 keep_raw=args.keep_raw_cutouts)
+
+    if followup_state is not None:
+        # Save the state with the cutouts, so that they are not fetched again
+        followup_state.update(selected_candidates)
+        followup_state.save()
 
     # Save candidate info to CSV file
-    save_candidates_to_file(selected_candidates, savefile)
+    save_candidates_to_file(selected_candidates, savefile,
+                            output_format=args.output_format)
 
+    # Build the photometry of all candidates at once, for the files and the pdf
+    photometry = make_photometry_table(selected_candidates,
+                                       instrument=args.instrument)
     write_photometry_to_file(selected_candidates,
                              phot_dir=phot_dir,
-                             plot=args.plot_lightcurves_separately)
+                             plot=args.plot_lightcurves_separately,
+                             photometry=photometry,
+                             output_format=args.output_format)
 
     make_full_pdf(selected_candidates,
                   thumbnails_dir=thumbnails_dir,
                   phot_dir=phot_dir,
                   pdffilename=full_pdffile,
-                  mjd0=mjd_event)
+                  mjd0=mjd_event,
+                  photometry=photometry,
+                  thumbnails=thumbnails)
+
+    connection_stats = get_connection_stats()
+    print(f"Kowalski connection stats: {connection_stats}")
+    if 'cache' in connection_stats:
+        staleness_warning = get_staleness_warning(connection_stats['cache'])
+        if staleness_warning is not None:
+            print(staleness_warning)
 
     if args.do_fritz_comparison:
         if args.localization_name is None:
@@ -248,7 +511,10 @@ if __name__ == '__main__':
         np.savetxt(os.path.join(output_dir, 'fritz_candidates.txt'),
                    fritz_candidate_ztf_names, fmt='%s')
 
-        cave_candidates = pd.read_csv(savefile)
+        if args.output_format == 'parquet':
+            cave_candidates = pd.read_parquet(savefile, columns=['objectId'])
+        else:
+            cave_candidates = pd.read_csv(savefile)
         cave_candidate_ztf_names = np.array(cave_candidates['objectId'])
         print(f"Found {len(cave_candidate_ztf_names)} candidates in CAVE")
         print(f"Found {len(fritz_candidate_ztf_names)} candidates in Fritz")
@@ -0,0 +1,464 @@
+from collections.abc import Mapping, MutableMapping
+from copy import deepcopy
+
+import numpy as np
+
+# Alert fields that are flattened into columns, the other dictionaries and lists
+# (prv_candidates, cross_matches, cutouts) are kept in side stores
+flattened_fields = ['candidate']
+
+scalar_types = (str, bytes, bool, int, float, np.generic, type(None))
+
+
+def make_column(values: list):
+    """
+    Contiguous array of the values of one field for all alerts : bool or int64 if
+    all values are, float64 if they are all numbers (None becomes nan), and object
+    otherwise (strings, or ints with missing values, that would lose precision as
+    floats).
+    """
+    value_types = {type(value) for value in values}
+    if len(value_types) > 0 and all(issubclass(value_type, (bool, np.bool_))
+                                    for value_type in value_types):
+        return np.array(values, dtype=bool)
+    if all(issubclass(value_type, (int, np.integer))
+           and not issubclass(value_type, (bool, np.bool_))
+           for value_type in value_types):
+        return np.array(values, dtype=np.int64)
+    if all(issubclass(value_type, (int, float, np.integer, np.floating, type(None)))
+           and not issubclass(value_type, (bool, np.bool_))
+           for value_type in value_types) \
+            and any(issubclass(value_type, (float, np.floating))
+                    for value_type in value_types):
+        return np.array(values, dtype=float)
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def fits_column(value, column: np.ndarray):
+    """Whether value can be stored in the column without changing its dtype"""
+    if column.dtype == object:
+        return True
+    if column.dtype == bool:
+        return isinstance(value, (bool, np.bool_))
+    if isinstance(value, (bool, np.bool_)):
+        return False
+    if column.dtype.kind == 'i':
+        return isinstance(value, (int, np.integer))
+    return isinstance(value, (int, float, np.integer, np.floating))
+
+
+def is_nested(value):
+    """Whether value is a nested payload, rather than a scalar (None is neither)"""
+    return not isinstance(value, scalar_types)
+
+
+def to_python(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class CandidateTable:
+    """
+    Columnar container of alerts. Scalar fields, at the top level and in the
+    candidate dictionary, are stored as contiguous numpy columns named by their path
+    ('objectId', 'candidate.jd'). Nested payloads (prv_candidates, cross_matches,
+    cutouts) are stored in side stores, one object per row, None where a row does
+    not have one. Columns that some rows do not have come with a presence mask, so
+    that these rows do not get the field. Masking, sorting and indexing with arrays
+    take rows from every column at once, slicing gives views of the columns.
+    Iterating over the table, or indexing it with an integer, gives CandidateRow
+    views that behave like the alert dictionaries and write through to the table,
+    so that code written for lists of dictionaries keeps working. The order in which
+    fields were added is kept, so that the alerts are rebuilt with the same layout.
+    """
+
+    def __init__(self, columns: dict = None, side_stores: dict = None,
+                 length: int = 0, field_order: list[str] = None, masks: dict = None):
+        self.columns = {} if columns is None else columns
+        self.side_stores = {} if side_stores is None else side_stores
+        # Rows that have each field, for the columns that not all rows have, and for
+        # the side stores with None values that are not missing ones
+        self.masks = {} if masks is None else masks
+        if field_order is None:
+            field_order = list(self.columns) + list(self.side_stores)
+        self.field_order = dict.fromkeys(field_order)
+        # Columns of each flattened field, see get_prefix_columns
+        self._prefix_columns = None
+        lengths = {len(values) for values in
+                   list(self.columns.values()) + list(self.side_stores.values())}
+        if len(lengths) > 1:
+            err = f"Columns of a CandidateTable must have the same length, " \
+                  f"got {lengths}"
+            print(err)
+            raise ValueError(err)
+        self.length = lengths.pop() if len(lengths) > 0 else length
+
+    @classmethod
+    def from_alerts(cls, alerts: list[dict]):
+        """
+        Build a table from alert dictionaries. A field goes to a side store if any
+        alert has a nested value for it, so that each field is in a single store.
+        """
+        alerts = list(alerts)
+        field_order, nested_keys = {}, set()
+        for alert in alerts:
+            for key, value in alert.items():
+                if (key in flattened_fields) & isinstance(value, Mapping):
+                    for field in value.keys():
+                        field_order[f'{key}.{field}'] = None
+                else:
+                    field_order[key] = None
+                    if is_nested(value) | (key in flattened_fields):
+                        nested_keys.add(key)
+        # Flattened fields that are not always dictionaries are kept as they are
+        field_order = {name: None for name in field_order
+                       if name.split('.', 1)[0] not in nested_keys
+                       or name in nested_keys}
+
+        columns, side_stores, masks = {}, {}, {}
+        for name in field_order:
+            if name in nested_keys:
+                side_stores[name] = np.empty(len(alerts), dtype=object)
+                side_stores[name][:] = [alert.get(name) for alert in alerts]
+                present = np.array([name in alert for alert in alerts], dtype=bool)
+                if any((alert.get(name, 0) is None) for alert in alerts):
+                    masks[name] = present
+                continue
+            if '.' in name:
+                key, field = name.split('.', 1)
+                containers = [alert[key] if isinstance(alert.get(key), Mapping)
+                              else {} for alert in alerts]
+            else:
+                field, containers = name, alerts
+            columns[name] = make_column([container.get(field)
+                                         for container in containers])
+            present = np.array([field in container for container in containers],
+                               dtype=bool)
+            if not np.all(present):
+                masks[name] = present
+        return cls(columns, side_stores, length=len(alerts),
+                   field_order=list(field_order), masks=masks)
+
+    def to_alerts(self, exclude: list[str] = ()):
+        """Alert dictionaries with the contents of the table, without the fields or
+        side stores in exclude"""
+        alerts = [{} for _ in range(self.length)]
+        for name in list(self.field_order):
+            if name in exclude:
+                continue
+            if name in self.columns:
+                key, field = name.split('.', 1) if '.' in name else (name, None)
+                present = self.masks.get(name, np.ones(self.length, dtype=bool))
+                for alert, value, is_present in zip(alerts, self.columns[name].tolist(),
+                                                    present):
+                    if not is_present:
+                        continue
+                    if field is None:
+                        alert[key] = value
+                    else:
+                        alert.setdefault(key, {})[field] = value
+            elif name in self.side_stores:
+                for index, (alert, value) in enumerate(zip(alerts,
+                                                           self.side_stores[name])):
+                    if self.has_value(name, index):
+                        alert[name] = value
+        return alerts
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, name: str):
+        return (name in self.columns) | (name in self.side_stores)
+
+    def has_value(self, name: str, index: int):
+        """Whether the row at index has the field or nested payload name"""
+        mask = self.masks.get(name)
+        if mask is not None:
+            return bool(mask[index])
+        if name in self.columns:
+            return True
+        store = self.side_stores.get(name)
+        return (store is not None) and (store[index] is not None)
+
+    def get_prefix_columns(self, key: str):
+        """Paths of the columns of a flattened field (e.g. 'candidate.jd' for
+        'candidate'), in field order. The index is built once, and again only after
+        columns are added or replaced."""
+        if self._prefix_columns is None:
+            prefix_columns = {}
+            for path in self.field_order:
+                if (path in self.columns) & ('.' in path):
+                    prefix_columns.setdefault(path.split('.', 1)[0], []).append(path)
+            # Whether all rows have the flattened field : masks are only ever
+            # removed from existing columns
+            self._prefix_columns = {
+                prefix: (paths, any(path not in self.masks for path in paths))
+                for prefix, paths in prefix_columns.items()}
+        return self._prefix_columns.get(key, ([], False))[0]
+
+    def has_flattened_value(self, key: str, index: int):
+        """Whether the row at index has any field of the flattened field key"""
+        paths = self.get_prefix_columns(key)
+        if self._prefix_columns.get(key, ([], False))[1]:
+            return True
+        return any(self.has_value(path, index) for path in paths)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield CandidateRow(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key in self.columns:
+                return self.columns[key]
+            if key in self.side_stores:
+                return self.side_stores[key]
+            raise KeyError(key)
+        if isinstance(key, (int, np.integer)):
+            if not -self.length <= key < self.length:
+                raise IndexError(f"Row {key} out of range for {self.length} rows")
+            return CandidateRow(self, int(key) % self.length)
+        if isinstance(key, slice):
+            return self.take(key)
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        return self.take(key.astype(int))
+
+    def __setitem__(self, name: str, values):
+        """Set a whole column (or side store, for nested values)"""
+        if len(values) != self.length:
+            err = f"Column {name} has {len(values)} values for {self.length} rows"
+            print(err)
+            raise ValueError(err)
+        self.columns.pop(name, None)
+        self.side_stores.pop(name, None)
+        self.masks.pop(name, None)
+        self.field_order.setdefault(name)
+        self._prefix_columns = None
+        if isinstance(values, np.ndarray) and values.dtype != object:
+            self.columns[name] = values
+        elif all(isinstance(value, scalar_types) for value in values):
+            self.columns[name] = make_column(list(values))
+        else:
+            self.side_stores[name] = np.empty(self.length, dtype=object)
+            self.side_stores[name][:] = list(values)
+
+    def take(self, indices: np.ndarray | slice):
+        """
+        New table with the rows at indices. A slice, or indices that are a
+        contiguous range, gives views of the columns without copying them : as with
+        a slice of a list of dictionaries, values written to the existing fields of
+        the rows are seen by both tables. Other indices copy the rows.
+        """
+        if isinstance(indices, np.ndarray) and (len(indices) > 0) \
+                and (indices[0] >= 0) \
+                and (indices[-1] - indices[0] == len(indices) - 1) \
+                and np.all(np.diff(indices) == 1):
+            indices = slice(int(indices[0]), int(indices[-1]) + 1)
+        length = len(range(*indices.indices(self.length))) \
+            if isinstance(indices, slice) else len(indices)
+        return CandidateTable({path: column[indices]
+                               for path, column in self.columns.items()},
+                              {name: store[indices]
+                               for name, store in self.side_stores.items()},
+                              length=length,
+                              field_order=list(self.field_order),
+                              masks={path: mask[indices]
+                                     for path, mask in self.masks.items()})
+
+    def get_value(self, name: str, index: int):
+        column = self.columns.get(name)
+        if column is not None:
+            mask = self.masks.get(name)
+            if (mask is not None) and not mask[index]:
+                raise KeyError(name)
+            return to_python(column[index])
+        if not self.has_value(name, index):
+            raise KeyError(name)
+        return self.side_stores[name][index]
+
+    def set_value(self, name: str, index: int, value):
+        """Set the value of one row, adding a column or side store if needed"""
+        if name in self.columns:
+            column = self.columns[name]
+            if not fits_column(value, column):
+                column = self.columns[name] = column.astype(object)
+            column[index] = value
+            if name in self.masks:
+                self.masks[name][index] = True
+                if np.all(self.masks[name]):
+                    del self.masks[name]
+        elif name in self.side_stores:
+            self.side_stores[name][index] = value
+            if name in self.masks:
+                self.masks[name][index] = True
+        elif isinstance(value, scalar_types):
+            column = np.full(self.length, None, dtype=object)
+            column[index] = value
+            self.columns[name] = column
+            if self.length > 1:
+                self.masks[name] = np.arange(self.length) == index
+            self.field_order.setdefault(name)
+            self._prefix_columns = None
+        else:
+            store = np.full(self.length, None, dtype=object)
+            store[index] = value
+            self.side_stores[name] = store
+            self.field_order.setdefault(name)
+
+
+class CandidateFields(MutableMapping):
+    """View of the candidate.* columns of one row, as a dictionary"""
+
+    __slots__ = ('table', 'index', 'key', 'prefix')
+
+    def __init__(self, table: CandidateTable, index: int, key: str = 'candidate'):
+        self.table = table
+        self.index = index
+        self.key = key
+        self.prefix = f'{key}.'
+
+    def __getitem__(self, field):
+        path = self.prefix + field
+        if path not in self.table.columns:
+            raise KeyError(field)
+        return self.table.get_value(path, self.index)
+
+    def __setitem__(self, field, value):
+        self.table.set_value(self.prefix + field, self.index, value)
+
+    def __delitem__(self, field):
+        raise TypeError("Fields of a CandidateTable can not be deleted")
+
+    def __iter__(self):
+        return (path[len(self.prefix):]
+                for path in list(self.table.get_prefix_columns(self.key))
+                if self.table.has_value(path, self.index))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+
+class CandidateRow(MutableMapping):
+    """
+    View of one row of a CandidateTable, that behaves like the alert dictionary.
+    Values written to it are stored in the table. Copying it gives a plain alert
+    dictionary.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: CandidateTable, index: int):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        if key in flattened_fields:
+            if not self.table.has_flattened_value(key, self.index):
+                raise KeyError(key)
+            return CandidateFields(self.table, self.index, key)
+        return self.table.get_value(key, self.index)
+
+    def __setitem__(self, key, value):
+        if (key in flattened_fields) & isinstance(value, Mapping):
+            for field, field_value in value.items():
+                self.table.set_value(f'{key}.{field}', self.index, field_value)
+            return
+        self.table.set_value(key, self.index, value)
+
+    def __delitem__(self, key):
+        if key not in self.table.side_stores:
+            raise TypeError(f"Only nested fields can be deleted from a "
+                            f"CandidateTable, not {key}")
+        self.table.side_stores[key][self.index] = None
+        if key in self.table.masks:
+            self.table.masks[key][self.index] = False
+
+    def __iter__(self):
+        keys = {}
+        for name in list(self.table.field_order):
+            if self.table.has_value(name, self.index):
+                keys[name.split('.', 1)[0] if name in self.table.columns else name] = None
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"CandidateRow({self.to_dict()})"
+
+    def to_dict(self):
+        """The row as a plain alert dictionary"""
+        return {key: dict(value) if isinstance(value, CandidateFields) else value
+                for key, value in self.items()}
+
+    def __copy__(self):
+        return self.to_dict()
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self.to_dict(), memo)
+
+
+def as_candidate_array(candidates):
+    """
+    Candidates as an indexable collection : CandidateTables and object arrays are
+    returned as they are, lists (of dictionaries or CandidateRows) are converted to
+    an object array.
+    """
+    if isinstance(candidates, (np.ndarray, CandidateTable)):
+        return candidates
+    candidates = list(candidates)
+    candidate_array = np.empty(len(candidates), dtype=object)
+    candidate_array[:] = candidates
+    return candidate_array
+
+
+def get_candidate_field(candidates, path: str, default=None):
+    """Values of a field (e.g. 'candidate.jd') for all candidates, as an array"""
+    if isinstance(candidates, CandidateTable):
+        if path in candidates:
+            return candidates[path]
+        return np.full(len(candidates), default, dtype=object)
+
+    keys = path.split('.')
+    values = []
+    for candidate in candidates:
+        value = candidate
+        for key in keys:
+            value = value.get(key, default) if isinstance(value, Mapping) else default
+        values.append(value)
+    return make_column(values)
+
+
+def set_candidate_field(candidates, name: str, values: np.ndarray | list):
+    """Store one value per candidate under name (e.g. a flag, or 'candidate.age')"""
+    if isinstance(candidates, CandidateTable):
+        candidates[name] = values
+        return
+    values = values.tolist() if isinstance(values, np.ndarray) else list(values)
+    key, field = name.split('.', 1) if '.' in name else (None, name)
+    for candidate, value in zip(candidates, values):
+        if key is not None:
+            candidate = candidate[key]
+        candidate[field] = value
+
+
+def to_alert_dicts(candidates, exclude: list[str] = ()):
+    """Candidates as plain alert dictionaries, without the fields in exclude"""
+    if isinstance(candidates, CandidateTable):
+        return candidates.to_alerts(exclude=exclude)
+    alerts = []
+    for candidate in candidates:
+        if isinstance(candidate, CandidateRow):
+            candidate = candidate.to_dict()
+        alerts.append({key: value for key, value in candidate.items()
+                       if key not in exclude})
+    return alerts
@@ -1,36 +1,207 @@
 from pathlib import Path
+import csv
+import json
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from emgwcave.kowalski_utils import query_aux_alerts, connect_kowalski, \
-    get_find_query, get_cone_search_query
-from emgwcave.skymap_utils import read_flattened_skymap, in_skymap, flatten_skymap, \
-    get_flattened_skymap_path
+    get_find_query, query_aux_alerts_batch, \
+    get_latest_candids, run_queries, chunk_list, \
+    cone_search_batch, get_prv_candidates_projection, get_cross_matches_projection
+from emgwcave.skymap_utils import Skymap, get_3d_localization_scores
+from astropy.cosmology import Planck18
 import numpy as np
-from copy import deepcopy
 from typing import Optional
 import os
 from emgwcave.plotting import plot_photometry
+from emgwcave.photometry import PhotometryTable, make_photometry_table, \
+    check_parquet_support, get_photometry_dataset_path, write_photometry_dataset
+from emgwcave.candidate_table import CandidateTable, as_candidate_array, get_candidate_field, set_candidate_field
 
 
-def save_candidates_to_file(candidates: list[dict],
-                            savefile: str | Path):
-    # with open(savefile.replace('.csv', '.json'), 'wb') as f:
-    #     json.dump(candidates, f)
+cutout_keys = ['cutoutScience', 'cutoutTemplate', 'cutoutDifference']
+
+
+# Csv files saved in the background are written one after the other by this thread
+_csv_writer = ThreadPoolExecutor(max_workers=1)
+_pending_csv_writes = []
+
+
+def flatten_candidate(candidate: Mapping, exclude: list[str] = (), prefix: str = ''):
+    """Flat {path: value} view of a candidate, with the nested dictionaries
+    flattened (and ordered) like pandas.json_normalize. The values are not copied."""
+    flat_candidate, nested = {}, []
+    for key, value in candidate.items():
+        if key in exclude:
+            continue
+        if isinstance(value, Mapping):
+            nested.append((key, value))
+        else:
+            flat_candidate[f'{prefix}{key}'] = value
+    for key, value in nested:
+        flat_candidate.update(flatten_candidate(value, prefix=f'{prefix}{key}.'))
+    return flat_candidate
 
+
+def get_flat_rows(candidates, exclude: list[str] = ()):
+    """Flattened views of the candidates, generated one at a time, without the
+    fields in exclude"""
     for candidate in candidates:
-        if 'cutoutScience' in candidate:
-            _ = candidate.pop('cutoutScience')
-        if 'cutoutTemplate' in candidate:
-            _ = candidate.pop('cutoutTemplate')
-        if 'cutoutDifference' in candidate:
-            _ = candidate.pop('cutoutDifference')
+        yield flatten_candidate(candidate, exclude=exclude)
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
 
-    candidate_df = pd.json_normalize(candidates)
-    candidate_df.to_csv(savefile, index=False)
 
+def get_value_kind(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if is_missing(value):
+        return 'missing'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'object'
+
+
+def get_csv_layout(rows):
+    """
+    Columns of the flattened rows, in the order of pandas.json_normalize, and the
+    columns that pandas would store as floats : numbers with at least one float or
+    missing value (e.g. ints that some rows do not have).
+    """
+    column_kinds, column_counts, n_rows = {}, {}, 0
+    for row in rows:
+        n_rows += 1
+        for column, value in row.items():
+            column_kinds.setdefault(column, set()).add(get_value_kind(value))
+            column_counts[column] = column_counts.get(column, 0) + 1
+    for column, count in column_counts.items():
+        if count < n_rows:
+            column_kinds[column].add('missing')
+    float_columns = {column for column, kinds in column_kinds.items()
+                     if (kinds - {'missing'}) and (kinds <= {'int', 'float', 'missing'})
+                     and (kinds != {'int'})}
+    return list(column_kinds), float_columns
+
+
+def format_csv_value(value, as_float: bool = False):
+    """Value as written by pandas.DataFrame.to_csv, missing values are empty"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if is_missing(value):
+        return ''
+    if as_float:
+        return repr(float(value))
+    return value
+
+
+def write_csv_rows(get_rows, savefile: str | Path):
+    """Write the rows to a csv file like pandas.json_normalize(...).to_csv. get_rows
+    returns a new iterator over the rows : they are read once for the layout, and
+    once more to stream them to the file."""
+    columns, float_columns = get_csv_layout(get_rows())
+    as_float = [column in float_columns for column in columns]
+    with open(savefile, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        for row in get_rows():
+            writer.writerow([format_csv_value(row.get(column), is_float)
+                             for column, is_float in zip(columns, as_float)])
+
+
+def to_json(value):
+    return json.dumps(value, default=lambda x: x.item() if isinstance(x, np.generic)
+                      else str(x))
+
+
+def write_parquet_rows(get_rows, savefile: str | Path):
+    """Write flattened rows to a compressed parquet file. Scalar columns keep their
+    dtype, nested values (e.g. prv_candidates, cross_matches) and columns of mixed
+    types are stored as JSON strings."""
+    check_parquet_support()
+    rows = list(get_rows())
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    df = pd.DataFrame(rows, columns=columns)
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        value_types = {type(value) for value in df[column] if not is_missing(value)}
+        if (len(value_types) > 1) or not value_types <= {str, bool, int, float}:
+            df[column] = [None if is_missing(value) else to_json(value)
+                          for value in df[column]]
+    df.to_parquet(savefile, index=False, compression='zstd')
+
+
+def save_candidates_to_file(candidates: list[dict] | np.ndarray | CandidateTable,
+                            savefile: str | Path,
+                            background: bool = False,
+                            output_format: str = 'csv'):
+    """
+    Write the candidates to a csv (or parquet) file, with one column per flattened
+    field and without the cutouts, as pandas.json_normalize(...).to_csv would. The
+    candidates are neither modified nor copied : the rows are flattened views of
+    them, generated one at a time and streamed to the csv file. With
+    background=True, the rows are flattened before returning (as the candidates may
+    change afterwards), written by a background thread and a Future is returned,
+    see wait_for_background_saves.
+    """
+    # with open(savefile.replace('.csv', '.json'), 'wb') as f:
+    #     json.dump(candidates, f)
+
+    write_rows = write_parquet_rows if output_format == 'parquet' else write_csv_rows
+    if not background:
+        write_rows(lambda: get_flat_rows(candidates, exclude=cutout_keys), savefile)
+        return None
+
+    rows = list(get_flat_rows(candidates, exclude=cutout_keys))
+    future = _csv_writer.submit(write_rows, lambda: iter(rows), savefile)
+    _pending_csv_writes.append(future)
+    return future
+
+
+def wait_for_background_saves():
+    """Wait until all csv files saved in the background are written, raising any
+    error that occurred while writing them"""
+    while len(_pending_csv_writes) > 0:
+        _pending_csv_writes.pop(0).result()
+
+
+def append_photometry_to_candidates(candidates: list[dict],
+                                    k=None,
+                                    batch: bool = True,
+                                    chunk_size: int = 200,
+                                    n_threads: int = 8,
+                                    projection: dict = None,
+                                    query_slots: threading.Semaphore = None):
+    """Attach the prv_candidates history from the aux alerts catalog to each
+    candidate. In batch mode, the objects are queried with chunked $in queries run
+    on n_threads threads (sharing query_slots, see run_queries), otherwise with one
+    query per candidate. By default, only the prv_candidates fields used downstream
+    are retrieved, pass projection={'prv_candidates': 1} to get all of them.
+    """
+    if projection is None:
+        projection = get_prv_candidates_projection()
+    if k is None:
+        k = connect_kowalski()
+    if batch:
+        names = [candidate['objectId'] for candidate in candidates]
+        aux_alerts = query_aux_alerts_batch(k=k,
+                                            names=names,
+                                            projection=projection,
+                                            chunk_size=chunk_size,
+                                            n_threads=n_threads,
+                                            query_slots=query_slots)
+        for candidate in candidates:
+            candidate['prv_candidates'] = \
+                aux_alerts[candidate['objectId']]['prv_candidates']
+        return candidates
 
-def append_photometry_to_candidates(candidates: list[dict]):
-    projection = {'prv_candidates': 1}
-    k = connect_kowalski()
     for candidate in candidates:
         name = candidate['objectId']
         prv_candidates = query_aux_alerts(k=k,
@@ -44,13 +215,24 @@ def append_photometry_to_candidates(candidates: list[dict]):
 
 def write_photometry_to_file(candidates: list[dict],
                              phot_dir: str | Path = None,
-                             plot: bool = False):
+                             plot: bool = False,
+                             photometry: PhotometryTable = None,
+                             output_format: str = 'csv'):
+    """Write the light curve of each candidate to phot_dir, as one csv file per
+    candidate or as a single parquet dataset partitioned by objectId (see
+    get_photometry_dataset_path). The photometry of all candidates is built at
+    once, unless it is given."""
+    if photometry is None:
+        photometry = make_photometry_table(candidates)
+    if output_format == 'parquet':
+        write_photometry_dataset(photometry, get_photometry_dataset_path(phot_dir))
     for candidate in candidates:
         name = candidate['objectId']
-        photometry_df = make_photometry(candidate)
+        photometry_df = photometry[name]
 
-        lcfilename = os.path.join(phot_dir, f'lc_{name}.csv')
-        photometry_df.to_csv(lcfilename)
+        if output_format == 'csv':
+            lcfilename = os.path.join(phot_dir, f'lc_{name}.csv')
+            photometry_df.to_csv(lcfilename)
         if plot:
             lcplotfilename = os.path.join(phot_dir, f'lc_{name}.png')
 
@@ -61,267 +243,346 @@ def make_photometry(alert,
                     jd_start: Optional[float] = None,
                     instrument: str = 'ZTF'):
     """
-    Make a de-duplicated pandas.DataFrame with photometry of alert['objectId']
-    Modified from Kowalksi (https://github.com/dmitryduev/kowalski)
+    Make a de-duplicated pandas.DataFrame with photometry of alert['objectId'],
+    see make_photometry_table to build the photometry of many alerts at once
 
     :param alert: candidate dictionary
     :param jd_start: date from which to start photometry from
     """
-    alert = deepcopy(alert)
-    top_level = [
-        "schemavsn",
-        "publisher",
-        "objectId",
-        "candid",
-        "candidate",
-        "prv_candidates",
-        "cutoutScience",
-        "cutoutTemplate",
-        "cutoutDifference",
-    ]
-    # alert["candidate"] = {}
-
-    # (keys having value in 3.)
-    delete = [key for key in alert.keys() if key not in top_level]
-
-    # delete the key/s
-    for key in delete:
-        alert["candidate"][key] = alert[key]
-        del alert[key]
-
-    alert["candidate"] = [alert["candidate"]]
-    df_candidate = pd.DataFrame(alert["candidate"], index=[0])
-
-    df_prv_candidates = pd.DataFrame(alert["prv_candidates"])
-
-    df_light_curve = pd.concat(
-        [df_candidate, df_prv_candidates], ignore_index=True, sort=False
-    )
-
-    # note: WNTR (like PGIR) uses 2massj, which is not in sncosmo as of
-    # 20210803, cspjs seems to be close/good enough as an approximation
-    if instrument == "ZTF":
-        ztf_filters = {1: "ztfg", 2: "ztfr", 3: "ztfi"}
-        df_light_curve["filter"] = df_light_curve["fid"].apply(
-            lambda x: ztf_filters[x]
-        )
-    elif instrument == "WNTR":
-        # 20220818: added WNTR
-        # 20220929: nir bandpasses have been added to sncosmo
-        nir_filters = {0: "ps1::y", 1: "2massj", 2: "2massh", 3: "2massks"}
-        df_light_curve["filter"] = df_light_curve["fid"].apply(
-            lambda x: nir_filters[x]
-        )
-
-    df_light_curve["magsys"] = "ab"
-    df_light_curve["mjd"] = df_light_curve["jd"] - 2400000.5
-
-    df_light_curve["mjd"] = df_light_curve["mjd"].astype(np.float64)
-    df_light_curve["magpsf"] = df_light_curve["magpsf"].astype(np.float32)
-    df_light_curve["sigmapsf"] = df_light_curve["sigmapsf"].astype(np.float32)
-
-    df_light_curve = (
-        df_light_curve.drop_duplicates(subset=["mjd", "magpsf"])
-        .reset_index(drop=True)
-        .sort_values(by=["mjd"])
-    )
-
-    # filter out bad data:
-    mask_good_diffmaglim = df_light_curve["diffmaglim"] > 0
-    df_light_curve = df_light_curve.loc[mask_good_diffmaglim]
-
-    # convert from mag to flux
-
-    # step 1: calculate the coefficient that determines whether the
-    # flux should be negative or positive
-    coeff = df_light_curve["isdiffpos"].apply(
-        lambda x: 1.0 if x in [True, 1, "y", "Y", "t", "1"] else -1.0
-    )
-
-    # step 2: calculate the flux normalized to an arbitrary AB zeropoint of
-    # 23.9 (results in flux in uJy)
-    df_light_curve["flux"] = coeff * 10 ** (
-            -0.4 * (df_light_curve["magpsf"] - 23.9)
-    )
-
-    # step 3: separate detections from non detections
-    detected = np.isfinite(df_light_curve["magpsf"])
-    undetected = ~detected
-
-    # step 4: calculate the flux error
-    df_light_curve["fluxerr"] = None  # initialize the column
-
-    # step 4a: calculate fluxerr for detections using sigmapsf
-    df_light_curve.loc[detected, "fluxerr"] = np.abs(
-        df_light_curve.loc[detected, "sigmapsf"]
-        * df_light_curve.loc[detected, "flux"]
-        * np.log(10)
-        / 2.5
-    )
-
-    # step 4b: calculate fluxerr for non detections using diffmaglim
-    df_light_curve.loc[undetected, "fluxerr"] = (
-            10 ** (-0.4 * (df_light_curve.loc[undetected, "diffmaglim"] - 23.9)) / 5.0
-    )  # as diffmaglim is the 5-sigma depth
-
-    # step 5: set the zeropoint and magnitude system
-    df_light_curve["zp"] = 23.9
-    df_light_curve["zpsys"] = "ab"
-
-    # only "new" photometry requested?
-    if jd_start is not None:
-        w_after_jd = df_light_curve["jd"] > jd_start
-        df_light_curve = df_light_curve.loc[w_after_jd]
-
-    return df_light_curve
+    return make_photometry_table([alert], jd_start=jd_start,
+                                 instrument=instrument)[alert['objectId']]
 
 
 def get_thumbnails(candidates: list[dict],
-                   catalog='ZTF_alerts'):
-    projection = {'cutoutScience': 1,
-                  'cutoutTemplate': 1,
-                  'cutoutDifference': 1
-                  }
-    k = connect_kowalski()
+                   k=None,
+                   catalog: str = None,
+                   instrument: str = 'ZTF',
+                   latest_only: bool = False,
+                   chunk_size: int = 200,
+                   n_threads: int = 8,
+                   query_slots: threading.Semaphore = None):
+    """
+    Fetch the cutouts for all candidates with a few concurrent bulk queries.
+    Candidates that carry a candid get the cutouts of exactly that alert,
+    the others (or all of them, if latest_only) get the cutouts of the newest alert
+    of the object, whose candid is resolved first (see get_latest_candids).
+
+    :param candidates: candidate dictionaries
+    :param k: Kowalski client, defaults to the shared one
+    :param catalog: alerts catalog to query, defaults to {instrument}_alerts
+    :param instrument: instrument name, used to pick the catalog
+    :param latest_only: ignore the candid and fetch the newest alert of each object
+    :param chunk_size: number of alerts per query
+    :param n_threads: number of queries to run concurrently
+    :param query_slots: limit on the queries in flight, see run_queries
+    """
+    if catalog is None:
+        catalog = f'{instrument}_alerts'
+    projection = {key: 1 for key in cutout_keys}
+    if k is None:
+        k = connect_kowalski()
+
+    if latest_only:
+        candids = []
+    else:
+        candids = [candidate['candid'] for candidate in candidates
+                   if 'candid' in candidate]
+    candid_set = set(candids)
+    object_ids = [candidate['objectId'] for candidate in candidates
+                  if candidate.get('candid') not in candid_set]
+    object_ids = list(dict.fromkeys(object_ids))
+    latest_candids = {}
+    if len(object_ids) > 0:
+        latest_candids = get_latest_candids(k, object_ids=object_ids,
+                                            catalog=catalog, chunk_size=chunk_size,
+                                            n_threads=n_threads,
+                                            query_slots=query_slots)
+    candids = list(dict.fromkeys(candids + list(latest_candids.values())))
+
+    queries = [get_find_query(catalog=catalog,
+                              filter={'candid': {'$in': chunk}},
+                              projection={'candid': 1, **projection})
+               for chunk in chunk_list(candids, chunk_size)]
+    responses = run_queries(k, queries, n_threads=n_threads, query_slots=query_slots)
+
+    cutouts_by_candid = {}
+    for response in responses:
+        response = response['default']
+        if response['status'] != 'success':
+            print(f"Failed cutout query : {response.get('message')}")
+            continue
+        for alert in response['data']:
+            cutouts_by_candid[alert['candid']] = alert
 
     for candidate in candidates:
-        query = get_find_query(catalog=catalog,
-                               filter={'objectId': candidate['objectId']},
-                               projection=projection)
-        response = k.query(query=query)
-
-        if response['default']['status'] == 'success':
-            candidate['cutoutScience'] = response['default']['data'][0]['cutoutScience']
-            candidate['cutoutTemplate'] = \
-                response['default']['data'][0]['cutoutTemplate']
-            candidate['cutoutDifference'] = response['default']['data'][0][
-                'cutoutDifference']
+        if candidate.get('candid') in candid_set:
+            alert = cutouts_by_candid.get(candidate['candid'])
+        else:
+            alert = cutouts_by_candid.get(latest_candids.get(candidate['objectId']))
+
+        if alert is not None:
+            for key in cutout_keys:
+                candidate[key] = alert[key]
         else:
             print(f'Failed to get cutouts for {candidate["objectId"]}')
-            candidate['cutoutScience'] = np.zeros((1, 1))
-            candidate['cutoutTemplate'] = np.zeros((1, 1))
-            candidate['cutoutDifference'] = np.zeros((1, 1))
+            for key in cutout_keys:
+                candidate[key] = np.zeros((1, 1))
 
     return candidates
 
 
 def deduplicate_candidates(candidates: list[dict]):
-    """Deduplicate candidates by objectId by keeping the one with the latest jd"""
-    if not isinstance(candidates, np.ndarray):
-        candidates = np.array(candidates)
-    all_jds = np.array([x['candidate']['jd'] for x in candidates])
-
-    sortinds = np.argsort(all_jds)
-    candidates = candidates[sortinds[::-1]]
-    all_objectids = np.array([x['objectId'] for x in candidates])
-    unique_objectids, unique_indices = np.unique(all_objectids, return_index=True)
+    """Deduplicate candidates by objectId by keeping the one with the latest jd.
+    The alerts are grouped by objectId with a single hash pass, only the unique
+    objectIds are sorted."""
+    candidates = as_candidate_array(candidates)
+    if len(candidates) == 0:
+        return candidates
+    all_jds = pd.Series(get_candidate_field(candidates, 'candidate.jd'),
+                        dtype=float).fillna(-np.inf)
+    all_objectids = get_candidate_field(candidates, 'objectId')
 
-    return candidates[unique_indices]
+    latest_indices = all_jds.groupby(all_objectids, sort=True).idxmax()
+    return candidates[latest_indices.to_numpy()]
 
 
 def get_candidates_in_localization(candidates: list[dict],
                                    skymap_path: str,
                                    cumulative_probability: float = 0.9):
-    if not isinstance(candidates, np.ndarray):
-        candidates = np.array(candidates)
-
-    ras = np.array([x['candidate']['ra'] for x in candidates])
-    decs = np.array([x['candidate']['dec'] for x in candidates])
-    # Read skymap, calculate top pixels
-    try:
-        (skymap_prob, _, _, _), _ = read_flattened_skymap(skymap_path)
-    except:
-        flattened_filepath = get_flattened_skymap_path(skymap_path)
-        if not os.path.exists(flattened_filepath):
-            flatten_skymap(skymap_path, flattened_filepath)
-        (skymap_prob, _, _, _), _ = read_flattened_skymap(flattened_filepath)
-
-    in_skymap_mask = in_skymap(skymap_prob=skymap_prob,
-                               ra_obj=ras,
-                               dec_obj=decs,
-                               probability=cumulative_probability)
+    candidates = as_candidate_array(candidates)
+
+    ras = get_candidate_field(candidates, 'candidate.ra')
+    decs = get_candidate_field(candidates, 'candidate.dec')
+    # The credible levels are computed once per skymap file and cached
+    in_skymap_mask = Skymap(skymap_path).contains(ra_obj=ras,
+                                                  dec_obj=decs,
+                                                  cumprob=cumulative_probability)
     return candidates[in_skymap_mask]
 
 
-def get_candidates_crossmatch(candidates: list[dict]):
-    """Crossmatch candidates with other catalogs"""
-    if not isinstance(candidates, np.ndarray):
-        candidates = np.array(candidates)
-
-    projection = {'cross_matches': 1}
-    k = connect_kowalski()
-    for candidate in candidates:
-        name = candidate['objectId']
-        ra = candidate['candidate']['ra']
-        dec = candidate['candidate']['dec']
-        coords_dict = {name: [ra, dec]}
-        cross_matches = query_aux_alerts(k=k,
-                                         name=name,
-                                         projection=projection)
-
-        candidate['cross_matches'] = cross_matches['cross_matches']
+def get_skymap_label(skymap_path: str):
+    return os.path.basename(skymap_path).split('.fits')[0]
 
-        query = get_cone_search_query(coords_dict=coords_dict,
-                                      catalog='milliquas_v6',
-                                      projection={'Name': 1,
-                                                  'Qpct': 1,
-                                                  'RA': 1, 'DEC': 1, 'Z': 1},
-                                      )
-        result = k.query(query=query)['default']['data']['milliquas_v6'][name]
-        candidate['cross_matches']['milliquas'] = result
 
+def get_candidates_in_any_localization(candidates: list[dict],
+                                       skymap_paths: list[str],
+                                       cumulative_probability: float = 0.9):
+    """
+    Evaluate all candidates against several skymaps of the same event (e.g.
+    successive localization updates). Adds the credible level of each candidate in
+    each map as credible_level_<skymap name>, and keeps the candidates that are
+    inside the credible region of at least one of the maps.
+    """
+    candidates = as_candidate_array(candidates)
+
+    ras = get_candidate_field(candidates, 'candidate.ra')
+    decs = get_candidate_field(candidates, 'candidate.dec')
+    credible_levels = np.array([Skymap(skymap_path).get_credible_levels(ras, decs)
+                                for skymap_path in skymap_paths])
+    for skymap_path, levels in zip(skymap_paths, credible_levels):
+        set_candidate_field(candidates, f'credible_level_{get_skymap_label(skymap_path)}',
+                            levels)
+
+    in_any_skymap_mask = np.any(credible_levels <= cumulative_probability, axis=0)
+    return candidates[in_any_skymap_mask]
+
+
+def get_nearest_clu_redshifts(candidates: list[dict] | np.ndarray):
+    """Redshift of the nearest CLU galaxy crossmatch of each candidate, NaN if there
+    is none"""
+    redshifts = np.full(len(candidates), np.nan)
+    for ind, cross_matches in enumerate(get_candidate_field(candidates,
+                                                            'cross_matches')):
+        if cross_matches is None:
+            continue
+        clu_galaxies = cross_matches.get('CLU_20190625', [])
+        if len(clu_galaxies) == 0:
+            continue
+        nearest_clu = min(clu_galaxies,
+                          key=lambda x: x['coordinates']['distance_arcsec'])
+        if nearest_clu.get('z') is not None:
+            redshifts[ind] = nearest_clu['z']
+    return redshifts
+
+
+def append_3d_localization_scores(candidates: list[dict] | np.ndarray,
+                                  skymap_path: str,
+                                  max_distance_sigma: float = 2.):
+    """
+    Score all candidates against the 3D localization in one vectorized pass, using
+    the luminosity distance of their nearest CLU galaxy. Adds the columns
+    clu_distance_mpc, distance_posterior_density (dp/dr at that distance),
+    probability_density_3d, distance_sigma_offset and distance_consistent_flag
+    (within max_distance_sigma of the skymap distance).
+    """
+    candidates = as_candidate_array(candidates)
+    if len(candidates) == 0:
+        return candidates
 
+    ras = get_candidate_field(candidates, 'candidate.ra')
+    decs = get_candidate_field(candidates, 'candidate.dec')
+    redshifts = get_nearest_clu_redshifts(candidates)
+    distances = np.full(len(candidates), np.nan)
+    has_redshift = redshifts > 0
+    if np.any(has_redshift):
+        distances[has_redshift] = Planck18.luminosity_distance(
+            redshifts[has_redshift]).to('Mpc').value
+
+    prob_density, distmu, distsigma, distnorm = \
+        Skymap(skymap_path).get_distance_parameters(ras, decs)
+    dp_dr, prob_density_3d, distance_sigma_offset = get_3d_localization_scores(
+        prob_density, distmu, distsigma, distnorm, distances)
+    distance_consistent = np.abs(distance_sigma_offset) <= max_distance_sigma
+
+    set_candidate_field(candidates, 'clu_distance_mpc', distances)
+    set_candidate_field(candidates, 'distance_posterior_density', dp_dr)
+    set_candidate_field(candidates, 'probability_density_3d', prob_density_3d)
+    set_candidate_field(candidates, 'distance_sigma_offset', distance_sigma_offset)
+    set_candidate_field(candidates, 'distance_consistent_flag', distance_consistent)
     return candidates
 
 
-def get_candidates_milliquas_crossmatch(candidates: list[dict]|np.ndarray):
-    """Crossmatch candidates with MILLIQUAS catalog"""
+milliquas_projection = {'Name': 1, 'Qpct': 1, 'RA': 1, 'DEC': 1, 'Z': 1}
+ps1_strm_projection = {'prob_Galaxy': 1, 'prob_Star': 1, 'prob_QSO': 1, 'z_phot': 1,
+                       'class': 1, 'z_photErr': 1}
+
+
+def get_candidates_crossmatch(candidates: list[dict],
+                              k=None,
+                              chunk_size: int = 200,
+                              n_threads: int = 8,
+                              projection: dict = None,
+                              query_slots: threading.Semaphore = None):
+    """Crossmatch candidates with other catalogs. By default, only the aux
+    crossmatch catalogs and fields used downstream are retrieved, pass
+    projection={'cross_matches': 1} to get all of them. The queries share
+    query_slots, see run_queries."""
+    candidates = as_candidate_array(candidates)
+
+    if projection is None:
+        projection = get_cross_matches_projection()
+    if k is None:
+        k = connect_kowalski()
+    names = get_candidate_field(candidates, 'objectId').tolist()
+    coords_dict = {name: [ra, dec] for name, ra, dec in
+                   zip(names, get_candidate_field(candidates, 'candidate.ra').tolist(),
+                       get_candidate_field(candidates, 'candidate.dec').tolist())}
+    aux_alerts = query_aux_alerts_batch(k=k,
+                                        names=names,
+                                        projection=projection,
+                                        chunk_size=chunk_size,
+                                        n_threads=n_threads,
+                                        query_slots=query_slots)
+    milliquas_matches = cone_search_batch(k=k,
+                                          coords_dict=coords_dict,
+                                          catalog='milliquas_v6',
+                                          projection=milliquas_projection,
+                                          chunk_size=chunk_size,
+                                          n_threads=n_threads,
+                                          query_slots=query_slots)
+    for candidate in candidates:
+        name = candidate['objectId']
+        candidate['cross_matches'] = aux_alerts[name]['cross_matches']
+        candidate['cross_matches']['milliquas'] = milliquas_matches[name]
+
+    return candidates
 
-    if not isinstance(candidates, np.ndarray):
-        candidates = np.array(candidates)
 
-    k = connect_kowalski()
+def get_candidates_milliquas_crossmatch(candidates: list[dict] | np.ndarray,
+                                        k=None,
+                                        chunk_size: int = 200,
+                                        n_threads: int = 8):
+    """Crossmatch candidates with MILLIQUAS and PS1_STRM catalogs"""
+
+    candidates = as_candidate_array(candidates)
+
+    if k is None:
+        k = connect_kowalski()
+    coords_dict = {candidate['objectId']: [candidate['candidate']['ra'],
+                                           candidate['candidate']['dec']]
+                   for candidate in candidates}
+    milliquas_matches = cone_search_batch(k=k,
+                                          coords_dict=coords_dict,
+                                          catalog='milliquas_v6',
+                                          projection=milliquas_projection,
+                                          chunk_size=chunk_size,
+                                          n_threads=n_threads)
+    ps1_strm_matches = cone_search_batch(k=k,
+                                         coords_dict=coords_dict,
+                                         catalog='PS1_STRM',
+                                         projection=ps1_strm_projection,
+                                         chunk_size=chunk_size,
+                                         n_threads=n_threads)
     for candidate in candidates:
         name = candidate['objectId']
-        ra = candidate['candidate']['ra']
-        dec = candidate['candidate']['dec']
-        coords_dict = {name: [ra, dec]}
-        query = get_cone_search_query(coords_dict=coords_dict,
-                                      catalog='milliquas_v6',
-                                      projection={'Name': 1,
-                                                  'Qpct': 1,
-                                                  'RA': 1, 'DEC': 1, 'Z': 1},
-                                      )
-
-        result = k.query(query=query)['default']['data']['milliquas_v6'][name]
-
         if 'cross_matches' not in candidate:
             candidate['cross_matches'] = {}
-        candidate['cross_matches']['milliquas'] \
-            = result
-
-        query = get_cone_search_query(coords_dict=coords_dict,
-                                      catalog='PS1_STRM',
-                                      projection={'prob_Galaxy': 1,
-                                                  'prob_Star': 1,
-                                                  'prob_QSO': 1, 'z_phot': 1,
-                                                  'class': 1,
-                                                  'z_photErr': 1},
-                                      )
-
-        result = k.query(query=query)['default']['data']['milliquas_v6'][name]
-        candidate['cross_matches']['PS1_STRM'] = result
+        candidate['cross_matches']['milliquas'] = milliquas_matches[name]
+        candidate['cross_matches']['PS1_STRM'] = ps1_strm_matches[name]
     return candidates
 
 
-def annotate_candidates(candidates: list[dict]):
-    if not isinstance(candidates, np.ndarray):
-        candidates = np.array(candidates)
+def get_annotation(cross_matches: dict, ssdistnr: float = None):
+    """Annotation text and annotation_id (used to order the candidates in the pdf)
+    of a candidate, from its crossmatches and its distance to the nearest known solar
+    system object"""
+    annotations = ''
+    annotation_id = 10
+    milliquas_xmatch = cross_matches['milliquas']
+    wise_xmatch = cross_matches['AllWISE']
+    clu_xmatch = cross_matches['CLU_20190625']
+    ps1_strm_xmatch = cross_matches['PS1_STRM']
+    if len(clu_xmatch) > 0:
+        annotation_id = 1
+
+    if len(ps1_strm_xmatch) > 0:
+        if ps1_strm_xmatch[0]['class'] == 'QSO':
+            annotations = f"likely QSO (PS1_STRM)"
+            annotation_id = 99
+        elif ps1_strm_xmatch[0]['class'] == 'STAR':
+            annotations = f"likely STAR (PS1_STRM)"
+            annotation_id = 90
+    if len(milliquas_xmatch) > 0:
+        annotations = f"likely QSO (MQ P = {milliquas_xmatch[0]['Qpct']}%)"
+        annotation_id = 100
+
+    elif len(wise_xmatch) > 0:
+        w1mw2 = wise_xmatch[0]['w1mpro'] - wise_xmatch[0]['w2mpro']
+        if w1mw2 > 0.5:
+            annotations = f"likely QSO WISE W1-W2 = {w1mw2:.2f})"
+            annotation_id = 99
+        else:
+            if len(annotations) == 0:
+                annotations += f", W1-W2 = {w1mw2:.2f}"
+                annotation_id = 50
+
+    if (ssdistnr is not None) and (0 <= ssdistnr < 10):
+        annotations = f"likely asteroid, ssdistnr={ssdistnr:.2f}"
+    return annotations, annotation_id
+
+
+def annotate_candidates(candidates: list[dict], k=None):
+    """Add the annotations and annotation_id columns (see get_annotation), read from
+    the crossmatch and ssdistnr columns"""
+    candidates = as_candidate_array(candidates)
     if len(candidates) == 0:
         return candidates
 
     if 'cross_matches' not in candidates[0]:
-        candidates = get_candidates_crossmatch(candidates)
+        candidates = get_candidates_crossmatch(candidates, k=k)
+
+    annotations = [get_annotation(cross_matches, ssdistnr) for cross_matches, ssdistnr
+                   in zip(get_candidate_field(candidates, 'cross_matches'),
+                          get_candidate_field(candidates, 'candidate.ssdistnr').tolist())]
+    set_candidate_field(candidates, 'annotations',
+                        [annotation for annotation, _ in annotations])
+    set_candidate_field(candidates, 'annotation_id',
+                        np.array([annotation_id for _, annotation_id in annotations],
+                                 dtype=int))
+    return candidates
+
+    if 'cross_matches' not in candidates[0]:
+        candidates = get_candidates_crossmatch(candidates, k=k)
 
     for candidate in candidates:
         candidate['annotations'] = ''
@@ -0,0 +1,126 @@
+import atexit
+import base64
+import gzip
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from emgwcave.query_cache import get_query_key, get_skymap_query_key
+
+
+def encode_value(value):
+    """JSON encoding of the values of kowalski responses that json does not
+    handle : bytes (the gzipped fits cutouts) as base64, and numpy values"""
+    if isinstance(value, bytes):
+        return {'$binary': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    err = f"Cannot record a value of type {type(value)} in a cassette"
+    print(err)
+    raise TypeError(err)
+
+
+def decode_object(document: dict):
+    if (len(document) == 1) & ('$binary' in document):
+        return base64.b64decode(document['$binary'])
+    return document
+
+
+class Cassette:
+    """
+    Recorded Kowalski responses, keyed by the content address of the query and
+    stored as gzipped JSON, so that a cassette can be read and diffed.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.responses = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with gzip.open(self.path, 'rt') as f:
+                self.responses = json.load(f, object_hook=decode_object)
+
+    def __contains__(self, key):
+        return key in self.responses
+
+    def __len__(self):
+        return len(self.responses)
+
+    def get(self, key: str):
+        if key not in self.responses:
+            err = f"Query {key} is not recorded in cassette {self.path}. Record it " \
+                  f"again with KOWALSKI_CASSETTE_MODE=record"
+            print(err)
+            raise KeyError(err)
+        return self.responses[key]
+
+    def record(self, key: str, response):
+        with self._lock:
+            self.responses[key] = response
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with gzip.open(tmp_path, 'wt') as f:
+            json.dump(self.responses, f, default=encode_value, sort_keys=True,
+                      indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class RecordingKowalski:
+    """
+    Wrapper around a live Kowalski client that records every query and
+    query_skymap response to a cassette. The cassette is written when the process
+    exits, or when save() is called.
+    """
+
+    def __init__(self, k, cassette_path: str | Path):
+        self.k = k
+        self.cassette = Cassette(cassette_path)
+        atexit.register(self.save)
+
+    def save(self):
+        self.cassette.save()
+
+    def __getattr__(self, name):
+        return getattr(self.k, name)
+
+    def query(self, query=None, **kwargs):
+        response = self.k.query(query=query, **kwargs)
+        self.cassette.record(get_query_key('query', {'query': query, **kwargs}),
+                             response)
+        return response
+
+    def query_skymap(self, path, **kwargs):
+        response = self.k.query_skymap(path=path, **kwargs)
+        key, _ = get_skymap_query_key(path, kwargs)
+        self.cassette.record(key, response)
+        return response
+
+
+class ReplayKowalski:
+    """
+    In-process stand-in for a Kowalski client that serves the responses recorded in
+    a cassette, without any network access.
+    """
+
+    def __init__(self, cassette_path: str | Path):
+        self.cassette = Cassette(cassette_path)
+        if len(self.cassette) == 0:
+            err = f"Cassette {cassette_path} is empty or does not exist"
+            print(err)
+            raise ValueError(err)
+        self.instances = {}
+
+    def ping(self):
+        return True
+
+    def query(self, query=None, **kwargs):
+        return self.cassette.get(get_query_key('query', {'query': query, **kwargs}))
+
+    def query_skymap(self, path, **kwargs):
+        key, _ = get_skymap_query_key(path, kwargs)
+        return self.cassette.get(key)
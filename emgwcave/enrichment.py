@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from emgwcave.candidate_utils import append_photometry_to_candidates, \
+    get_candidates_crossmatch, get_thumbnails, cutout_keys
+from emgwcave.kowalski_utils import connect_kowalski
+from emgwcave.candidate_table import as_candidate_array, get_candidate_field
+
+
+def get_phase_inputs(candidates):
+    """Small copies of the candidates with only the fields that the enrichment
+    phases read (objectId, candid, candidate.ra and candidate.dec), so that the
+    phases never touch the candidates themselves while they run"""
+    phase_inputs = [{'objectId': name, 'candidate': {'ra': ra, 'dec': dec}}
+                    for name, ra, dec in
+                    zip(get_candidate_field(candidates, 'objectId').tolist(),
+                        get_candidate_field(candidates, 'candidate.ra').tolist(),
+                        get_candidate_field(candidates, 'candidate.dec').tolist())]
+    for phase_input, candidate in zip(phase_inputs, candidates):
+        if 'candid' in candidate:
+            phase_input['candid'] = candidate['candid']
+    return phase_inputs
+
+
+def enrich_candidates(candidates: list[dict] | np.ndarray,
+                      k=None,
+                      photometry: bool = True,
+                      crossmatch: bool = True,
+                      thumbnails: bool = True,
+                      instrument: str = 'ZTF',
+                      max_concurrent_queries: int = 8,
+                      chunk_size: int = 200,
+                      photometry_projection: dict = None,
+                      crossmatch_projection: dict = None):
+    """
+    Fetch the photometry history, crossmatches and cutouts of the candidates
+    concurrently instead of one phase after the other. The phases run on copies of
+    the fields they need (see get_phase_inputs) and return their results, which are
+    attached to the candidates (prv_candidates, cross_matches, cutout*) by the
+    calling thread as soon as each phase is done, so that the candidates are only
+    ever written by one thread. At most max_concurrent_queries kowalski queries are
+    in flight at any time across all phases.
+
+    :param candidates: candidate dictionaries
+    :param k: Kowalski client, defaults to the shared one
+    :param photometry: fetch the prv_candidates history
+    :param crossmatch: fetch the aux and cone search crossmatches
+    :param thumbnails: fetch the cutouts
+    :param instrument: instrument name, used to pick the alerts catalog for cutouts
+    :param max_concurrent_queries: global limit on concurrent kowalski queries
+    :param chunk_size: number of objects per query
+    :param photometry_projection: aux projection for the photometry history,
+    defaults to the fields used downstream
+    :param crossmatch_projection: aux projection for the crossmatches, defaults to
+    the catalogs and fields used downstream
+    :return: candidates
+    """
+    candidates = as_candidate_array(candidates)
+    if len(candidates) == 0:
+        return candidates
+
+    if k is None:
+        k = connect_kowalski()
+
+    # Fields added by each phase
+    phases = {}
+    if photometry:
+        phases['photometry'] = (lambda cands, **kwargs: append_photometry_to_candidates(
+            cands, projection=photometry_projection, **kwargs), ['prv_candidates'])
+    if crossmatch:
+        phases['crossmatch'] = (lambda cands, **kwargs: get_candidates_crossmatch(
+            cands, projection=crossmatch_projection, **kwargs), ['cross_matches'])
+    if thumbnails:
+        phases['thumbnails'] = (lambda cands, **kwargs: get_thumbnails(
+            cands, instrument=instrument, **kwargs), cutout_keys)
+
+    query_slots = threading.BoundedSemaphore(max_concurrent_queries)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, len(phases))) as executor:
+        futures = {executor.submit(phase, get_phase_inputs(candidates),
+                                   k=k,
+                                   chunk_size=chunk_size,
+                                   n_threads=max_concurrent_queries,
+                                   query_slots=query_slots): name
+                   for name, (phase, _) in phases.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            fields = phases[name][1]
+            for candidate, phase_result in zip(candidates, future.result()):
+                for field in fields:
+                    candidate[field] = phase_result[field]
+            print(f"Finished {name} for {len(candidates)} candidates "
+                  f"after {time.time() - start_time:.1f}s")
+
+    return candidates
@@ -0,0 +1,157 @@
+import gzip
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+from astropy.time import Time
+
+from emgwcave.query_cache import get_file_hash
+from emgwcave.candidate_table import CandidateTable, as_candidate_array, \
+    to_alert_dicts
+
+followup_state_filename = 'emgwcave_followup_state.pkl.gz'
+
+# Kowalski ingests alerts with a delay, alerts up to this long before the checkpoint
+# are queried again by the next run
+default_ingestion_margin_hours = 3.
+
+
+class FollowupState:
+    """
+    State of an incremental follow-up of one event, kept in the output directory
+    between runs : the end of the last queried jd window and the candidates retained
+    so far (with their photometry, crossmatches and cutouts). A follow-up run only
+    queries alerts newer than the checkpoint, minus an ingestion margin for the
+    alerts that were ingested by kowalski after the previous run, and merges them
+    with the retained candidates. The state is only resumed with the same
+    localization : skymap, cumprob, skymap versions and skymap used for the
+    localization check.
+    """
+
+    def __init__(self,
+                 path: str | Path,
+                 skymap_hash: str,
+                 cumprob: float,
+                 last_jd_end: float = None,
+                 candidates: dict = None,
+                 localization_hashes: dict = None,
+                 ingestion_margin_hours: float = default_ingestion_margin_hours):
+        self.path = Path(path)
+        self.ingestion_margin_hours = ingestion_margin_hours
+        self.skymap_hash = skymap_hash
+        self.cumprob = cumprob
+        self.localization_hashes = localization_hashes
+        self.last_jd_end = last_jd_end
+        if candidates is None:
+            candidates = {}
+        self.candidates = candidates
+
+    @classmethod
+    def load(cls, outdir: str | Path, skymap_path: str | Path, cumprob: float,
+             skymap_versions: list[str | Path] = None,
+             localization_compare_skymappath: str | Path = None,
+             ingestion_margin_hours: float = default_ingestion_margin_hours):
+        """Load the state of the event from outdir, or start a new one if there is
+        none or it was made with a different localization
+
+        :param outdir: output directory of the event
+        :param skymap_path: path of the skymap
+        :param cumprob: cumulative probability of the credible region
+        :param skymap_versions: other versions of the skymap, whose credible regions
+        are queried too
+        :param localization_compare_skymappath: skymap used for the localization
+        check, if different from skymap_path
+        :param ingestion_margin_hours: how long before the checkpoint to resume
+        querying, to get the alerts ingested by kowalski after the previous run
+        """
+        path = os.path.join(outdir, followup_state_filename)
+        skymap_hash = get_file_hash(skymap_path)
+        localization_hashes = get_localization_hashes(
+            skymap_versions=skymap_versions,
+            localization_compare_skymappath=localization_compare_skymappath)
+        if os.path.exists(path):
+            with gzip.open(path, 'rb') as f:
+                state = pickle.load(f)
+            if (state['skymap_hash'] == skymap_hash) & (state['cumprob'] == cumprob) \
+                    & (state.get('localization_hashes') == localization_hashes):
+                print(f"Resuming follow-up from jd {state['last_jd_end']} with "
+                      f"{len(state['candidates'])} retained candidates")
+                return cls(path=path, ingestion_margin_hours=ingestion_margin_hours,
+                           **state)
+            print(f"Follow-up state in {path} is for a different skymap, skymap "
+                  f"versions or cumprob, starting a new one")
+        return cls(path=path, skymap_hash=skymap_hash, cumprob=cumprob,
+                   localization_hashes=localization_hashes,
+                   ingestion_margin_hours=ingestion_margin_hours)
+
+    def save(self):
+        state = {'skymap_hash': self.skymap_hash,
+                 'cumprob': self.cumprob,
+                 'localization_hashes': self.localization_hashes,
+                 'last_jd_end': self.last_jd_end,
+                 'candidates': self.candidates}
+        tmp_path = self.path.with_suffix('.tmp')
+        with gzip.open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+    def get_query_start(self, start_date_jd: float):
+        """Start of the jd window to query : the end of the last queried window
+        minus the ingestion margin, if it is later than start_date_jd. Alerts of the
+        margin that were already retained are queried again, and replace
+        themselves when merged."""
+        if self.last_jd_end is None:
+            return start_date_jd
+        return max(start_date_jd,
+                   self.last_jd_end - self.ingestion_margin_hours / 24.)
+
+    def merge(self, new_candidates: list[dict] | np.ndarray | CandidateTable,
+              updated_object_ids: list[str] = None):
+        """
+        Merge newly retained candidates with the previously retained ones, a new
+        alert of an object replaces the previous one
+
+        :param new_candidates: candidates retained by this run
+        :param updated_object_ids: objects with new alerts in this run. The
+        previously retained ones that are not in new_candidates are dropped, as their
+        newest alert did not pass the filters.
+        """
+        merged_candidates = dict(self.candidates)
+        if updated_object_ids is not None:
+            retained_object_ids = set(candidate['objectId']
+                                      for candidate in new_candidates)
+            rejected_object_ids = [name for name in updated_object_ids
+                                   if (name in merged_candidates)
+                                   and (name not in retained_object_ids)]
+            for name in rejected_object_ids:
+                del merged_candidates[name]
+            if len(rejected_object_ids) > 0:
+                print(f"Dropped {len(rejected_object_ids)} previously retained "
+                      f"candidates whose newest alert did not pass the filters")
+        for candidate in to_alert_dicts(new_candidates):
+            merged_candidates[candidate['objectId']] = candidate
+        if isinstance(new_candidates, CandidateTable):
+            return CandidateTable.from_alerts(merged_candidates.values())
+        return as_candidate_array(list(merged_candidates.values()))
+
+    def update(self, candidates: list[dict] | np.ndarray | CandidateTable,
+               jd_end: float = None):
+        """Record the retained candidates, and the end of the queried jd window. The
+        window can not end in the future, as alerts up to now are all that could be
+        queried."""
+        self.candidates = {candidate['objectId']: candidate
+                           for candidate in to_alert_dicts(candidates)}
+        if jd_end is not None:
+            self.last_jd_end = min(jd_end, Time.now().jd)
+
+
+def get_localization_hashes(skymap_versions: list[str | Path] = None,
+                            localization_compare_skymappath: str | Path = None):
+    """Hashes of the skymaps, other than the main one, that define the candidates
+    of a follow-up"""
+    return {'skymap_versions': [get_file_hash(path)
+                                for path in (skymap_versions or [])],
+            'localization_compare_skymappath':
+                None if localization_compare_skymappath is None
+                else get_file_hash(localization_compare_skymappath)}
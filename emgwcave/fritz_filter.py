@@ -1,108 +1,254 @@
 import numpy as np
 from emgwcave.candidate_utils import save_candidates_to_file
-from copy import deepcopy
+from emgwcave.candidate_table import as_candidate_array, get_candidate_field, \
+    set_candidate_field, to_alert_dicts
 
 fritz_emgw_filter = {}
 
+positive_isdiffpos_values = ['t', '1', 'True', True, 1]
+
+# Stage 1 flags that get_fritz_emgw_stage_1_mongo_filter evaluates on the server,
+# with the value an alert needs to pass
+server_side_stage_1_flags = {'positive_sub_flag': True,
+                             'real_flag': True,
+                             'young_flag': True,
+                             'asteroid_flag': False,
+                             'point_underneath_flag': False}
+
+
+def get_fritz_emgw_stage_1_mongo_filter():
+    """
+    Mongo filter equivalent to the cheap cuts of pythonised_fritz_emgw_filter_stage_1
+    (positive subtraction, real, young, not an asteroid and no point source
+    underneath), to be evaluated by kowalski. The bright star and variable source
+    cuts are left to the local filter. As locally, where null values are nan and
+    fail every comparison, a null field never makes an alert an asteroid or a point
+    source, and an alert without jdstarthist is not young. In an $expr, mongo
+    sorts null below every number, so the age cut alone would let such alerts
+    through : jdstarthist is required explicitly.
+    """
+    mongo_filter = {
+        "candidate.isdiffpos": {"$in": positive_isdiffpos_values},
+        "candidate.drb": {"$gt": 0.3},
+        "candidate.jdstarthist": {"$exists": True, "$ne": None},
+        "$expr": {"$lt": [{"$subtract": ["$candidate.jd", "$candidate.jdstarthist"]},
+                          10]},
+        "$and": [
+            # not an asteroid
+            {"$or": [{"candidate.ssdistnr": {"$lt": 0}},
+                     {"candidate.ssdistnr": {"$gte": 10}},
+                     {"candidate.ssdistnr": None},
+                     {"candidate.ssmagnr": {"$gte": 20}},
+                     {"candidate.ssmagnr": None}]},
+            # no point source underneath
+            {"$or": [{"candidate.distpsnr1": {"$lt": 0}},
+                     {"candidate.distpsnr1": {"$gte": 2}},
+                     {"candidate.distpsnr1": None},
+                     {"candidate.sgscore1": {"$lte": 0.76}},
+                     {"candidate.sgscore1": None}]},
+        ]
+    }
+    return mongo_filter
+
+
+def get_server_side_stage_1_mask(sources: list[dict] | np.ndarray):
+    """Whether each source passes the local equivalent of
+    get_fritz_emgw_stage_1_mongo_filter"""
+    sources = as_candidate_array(sources)
+    flags, _ = get_fritz_emgw_stage_1_flags(sources)
+    mask = np.ones(len(sources), dtype=bool)
+    for flag, value in server_side_stage_1_flags.items():
+        mask &= flags[flag] == value
+    return mask
+
+
+def verify_server_side_filter(sources: list[dict] | np.ndarray,
+                              rejected_sources: list[dict] | np.ndarray = ()):
+    """
+    Check get_fritz_emgw_stage_1_mongo_filter against the corresponding local cuts,
+    in both directions : the sources it retrieved must pass the local cuts, and the
+    sources it rejected (usually a sample of them) must fail them. Returns the
+    sources where the server and local filters disagree.
+    """
+    sources = as_candidate_array(sources)
+    rejected_sources = as_candidate_array(rejected_sources)
+
+    passed_mismatches = np.flatnonzero(~get_server_side_stage_1_mask(sources))
+    rejected_mismatches = np.flatnonzero(get_server_side_stage_1_mask(rejected_sources))
+    if len(passed_mismatches) > 0:
+        print(f"WARNING: {len(passed_mismatches)} alerts passed the server-side "
+              f"filter but failed the same cuts locally.")
+    if len(rejected_mismatches) > 0:
+        print(f"WARNING: {len(rejected_mismatches)} out of {len(rejected_sources)} "
+              f"alerts rejected by the server-side filter passed the same cuts "
+              f"locally.")
+    return as_candidate_array(
+        to_alert_dicts([sources[ind] for ind in passed_mismatches])
+        + to_alert_dicts([rejected_sources[ind] for ind in rejected_mismatches]))
+
+
+stage_1_candidate_fields = ['jd', 'jdstarthist', 'drb', 'ssdistnr', 'ssmagnr',
+                            'distpsnr1', 'distpsnr2', 'distpsnr3',
+                            'sgscore1', 'sgscore2', 'sgscore3',
+                            'srmag1', 'srmag2', 'srmag3', 'sgmag1', 'simag1',
+                            'distnr', 'magnr']
+
+
+def get_candidate_columns(sources: np.ndarray, fields: list[str]):
+    """Extract candidate fields of all sources as float arrays, missing or null
+    values become nan (and fail every comparison)"""
+    return {field: np.array(get_candidate_field(sources, f'candidate.{field}'),
+                            dtype=float)
+            for field in fields}
+
+
+def in_range(values: np.ndarray, low: float, high: float, include_low: bool = True):
+    """low <= values < high (or low < values < high), elementwise"""
+    above_low = values >= low if include_low else values > low
+    return above_low & (values < high)
+
+
+def get_fritz_emgw_stage_1_flags(sources: np.ndarray):
+    """
+    Evaluate the stage 1 flags of the Fritz EMGW filter for all sources at once, on
+    columns of the candidate fields. Returns a dictionary of {flag: boolean array},
+    and the age of the sources.
+    """
+    c = get_candidate_columns(sources, stage_1_candidate_fields)
+    isdiffpos = get_candidate_field(sources, 'candidate.isdiffpos')
+    age = c['jd'] - c['jdstarthist']
+
+    flags = {}
+    flags['positive_sub_flag'] = np.isin(isdiffpos.astype(str),
+                                         [str(x) for x in positive_isdiffpos_values])
+    flags['real_flag'] = c['drb'] > 0.3
+    flags['young_flag'] = age < 10
+    flags['asteroid_flag'] = in_range(c['ssdistnr'], 0, 10) & (c['ssmagnr'] < 20)
+    flags['point_underneath_flag'] = in_range(c['distpsnr1'], 0, 2) \
+        & (c['sgscore1'] > 0.76)
+
+    brightstar_flag = (c['sgscore1'] == 0.5) & in_range(c['distpsnr1'], 0, 0.5) \
+        & (in_range(c['sgmag1'], 0, 17) | in_range(c['srmag1'], 0, 17)
+           | in_range(c['simag1'], 0, 17))
+    for ind in [1, 2, 3]:
+        brightstar_flag |= in_range(c[f'distpsnr{ind}'], 0, 20) \
+            & in_range(c[f'srmag{ind}'], 0, 15) & (c[f'sgscore{ind}'] > 0.49)
+    flags['brightstar_flag'] = brightstar_flag
+
+    variable_source_flag = np.zeros(len(sources), dtype=bool)
+    for max_distnr, max_magnr, min_magnr in [(0.4, 19, -np.inf), (0.8, 17, 0),
+                                             (1.2, 16, 0)]:
+        variable_source_flag |= in_range(c['distnr'], 0, max_distnr,
+                                         include_low=False) \
+            & in_range(c['magnr'], min_magnr, max_magnr, include_low=False) \
+            & (age > 90)
+    flags['variable_source_flag'] = variable_source_flag
+
+    flags['fritz_emgw_filter_1_flag'] = flags['positive_sub_flag'] \
+        & flags['real_flag'] \
+        & flags['young_flag'] \
+        & ~flags['asteroid_flag'] \
+        & ~flags['point_underneath_flag'] \
+        & ~flags['brightstar_flag'] \
+        & ~flags['variable_source_flag']
+    return flags, age
+
 
 def pythonised_fritz_emgw_filter_stage_1(sources: list[dict], save=True,
-                                         outdir: str = None):
-    """Filter candidates using the Fritz EMGW filter, but in python instead of mongo
+                                         outdir: str = None,
+                                         background_save: bool = False):
+    """Filter candidates using the Fritz EMGW filter, but in python instead of mongo.
+    The flags are evaluated on columns of the candidate fields (see
+    get_fritz_emgw_stage_1_flags), and stored in each source.
     """
-    if not isinstance(sources, np.ndarray):
-        sources = np.array(sources)
+    sources = as_candidate_array(sources)
 
-    for source in sources:
-        candidate = source['candidate']
-        candidate['age'] = candidate['jd'] - candidate['jdstarthist']
-
-        source['positive_sub_flag'] = candidate['isdiffpos'] in ['t', '1', 'True', True,
-                                                                 1]
-        source['real_flag'] = candidate['drb'] > 0.3
-        source['young_flag'] = candidate['jd'] - candidate['jdstarthist'] < 10
-        source['asteroid_flag'] = (0 <= candidate['ssdistnr'] < 10)  \
-                                  & (candidate['ssmagnr'] < 20)
-        source['point_underneath_flag'] = (0 <= candidate['distpsnr1'] < 2) & (
-                candidate['sgscore1'] > 0.76)
-        source['brightstar_flag'] = ((0 <= candidate['distpsnr1'] < 20) & (
-                0 <= candidate['srmag1'] < 15) & (candidate['sgscore1'] > 0.49)) \
-                                    | ((0 <= candidate['distpsnr2'] < 20) & (
-                0 <= candidate['srmag2'] < 15) & (candidate['sgscore2'] > 0.49)) \
-                                    | ((0 <= candidate['distpsnr3'] < 20) & (
-                0 <= candidate['srmag3'] < 15) & (candidate['sgscore3'] > 0.49)) \
-                                    | ((candidate['sgscore1'] == 0.5) & (
-                0 <= candidate['distpsnr1'] < 0.5) & ((0 <= candidate['sgmag1'] < 17) | (
-                0 <= candidate['srmag1'] < 17) | (0 <= candidate['simag1'] < 17)))
-
-        source['variable_source_flag'] = ((0 < candidate['distnr'] < 0.4) & (
-                candidate['magnr'] < 19) & (candidate['age'] > 90)) \
-                                         | ((0 < candidate['distnr'] < 0.8) & (
-                0 < candidate['magnr'] < 17) & (candidate['age'] > 90)) \
-                                         | ((0 < candidate['distnr'] < 1.2) & (
-                0 < candidate['magnr'] < 16) & (candidate['age'] > 90))
-
-        source['fritz_emgw_filter_1_flag'] = source['positive_sub_flag'] \
-                                             & source['real_flag'] \
-                                             & source['young_flag'] \
-                                             & ~source['asteroid_flag'] \
-                                             & ~source['point_underneath_flag'] \
-                                             & ~source['brightstar_flag'] \
-                                             & ~source['variable_source_flag']
-    selected_source_mask = np.array([x['fritz_emgw_filter_1_flag']
-                                     for x in sources]).astype(bool)
+    flags, age = get_fritz_emgw_stage_1_flags(sources)
+    set_candidate_field(sources, 'candidate.age', age)
+    for flag, values in flags.items():
+        # The combined flag has always been stored as 1 or 0 (the & of bools and
+        # ~bools), and is written as such in the csv files
+        if flag == 'fritz_emgw_filter_1_flag':
+            values = values.astype(int)
+        set_candidate_field(sources, flag, values)
+
+    selected_source_mask = flags['fritz_emgw_filter_1_flag']
     if save:
         if save:
-            save_candidates_to_file(deepcopy(sources),
-                                    savefile=f'{outdir}/fritz_emgw_stage_1.csv')
+            save_candidates_to_file(sources,
+                                    savefile=f'{outdir}/fritz_emgw_stage_1.csv',
+                                    background=background_save)
     return sources[selected_source_mask]
 
 
+def get_prv_detections_columns(sources: np.ndarray):
+    """
+    Flatten the previous detections (prv_candidates with a magpsf) of all sources
+    into contiguous arrays of jd, magpsf and positive subtraction flag, along with
+    the number of detections of each source. The detections of source i are
+    detections[offsets[i]:offsets[i] + counts[i]].
+    """
+    jds, mags, positive_sub, counts = [], [], [], []
+    for source in sources:
+        detections = [x for x in source['prv_candidates'] if 'magpsf' in x.keys()]
+        counts.append(len(detections))
+        for detection in detections:
+            jds.append(detection['jd'])
+            mags.append(detection['magpsf'])
+            positive_sub.append(detection['isdiffpos'] in ['1', 1, 't', True])
+    detections = {'jd': np.array(jds, dtype=float),
+                  'magpsf': np.array(mags, dtype=float),
+                  'positive_sub': np.array(positive_sub, dtype=bool)}
+    return detections, np.array(counts, dtype=int)
+
+
 def pythonised_fritz_emgw_filter_stationary_stage(sources: list[dict],
                                                   mjd_event: float,
                                                   save: bool = True,
-                                                  outdir: str = None):
+                                                  outdir: str = None,
+                                                  background_save: bool = False):
     """
     The sources should now have the prv_candidates field. This function does a
     final filtering of the sources to remove non-stationary sources by looking at
     the difference between two consecutive detections
     :param outdir: output directory in which to write the data
     :param save: save a record of all the sources and the evaluated values
+    :param background_save: write the record on a background thread
     :param sources:
     :return:
     """
-    if not isinstance(sources, np.ndarray):
-        sources = np.array(sources)
+    sources = as_candidate_array(sources)
 
-    for source in sources:
-        candidate = source['candidate']
-        prv_candidates = source['prv_candidates']
-        prv_candidates_detections = [x for x in prv_candidates if 'magpsf' in x.keys()]
-        prv_candidate_jds = np.array([x['jd'] for x in prv_candidates_detections])
-        prv_candidate_mags = np.array([x['magpsf'] for x in prv_candidates_detections])
-        prv_candidate_isdiffpos_flag = np.array([x['isdiffpos'] in ['1', 1, 't', True]
-                                                 for x in
-                                                 prv_candidates_detections]).astype(
-            bool)
-        if len(prv_candidate_jds) == 0:
-            source['mindiff'] = 0
-            source['earliest_detection'] = candidate['jd']
-        else:
-            source['mindiff'] = np.max(np.abs(prv_candidate_jds - candidate['jd']))
-            source['earliest_detection'] = np.min(prv_candidate_jds)
-
-        source['stationary_flag'] = np.any(
-            (np.abs(prv_candidate_jds - candidate['jd']) > 0.01) &
-            (prv_candidate_mags < 99) &
-            prv_candidate_isdiffpos_flag
-        )
-
-        source['old_prv_cands_flag'] = source['earliest_detection'] > mjd_event \
-                                       + 2400000.5
+    # The previous detections of all sources are reduced at once, segment by segment
+    detections, counts = get_prv_detections_columns(sources)
+    candidate_jds = np.array(get_candidate_field(sources, 'candidate.jd'), dtype=float)
+    time_diffs = np.abs(detections['jd'] - np.repeat(candidate_jds, counts))
+    stationary_detections = (time_diffs > 0.01) & (detections['magpsf'] < 99) \
+        & detections['positive_sub']
+
+    # reduceat can not reduce empty segments, these keep the default values
+    has_detections = counts > 0
+    offsets = (np.cumsum(counts) - counts)[has_detections]
+    mindiff = np.zeros(len(sources))
+    earliest_detection = candidate_jds.copy()
+    stationary_flag = np.zeros(len(sources), dtype=bool)
+    if np.sum(has_detections) > 0:
+        mindiff[has_detections] = np.maximum.reduceat(time_diffs, offsets)
+        earliest_detection[has_detections] = np.minimum.reduceat(detections['jd'],
+                                                                 offsets)
+        stationary_flag[has_detections] = np.logical_or.reduceat(
+            stationary_detections, offsets)
+    old_prv_cands_flag = earliest_detection > mjd_event + 2400000.5
+
+    set_candidate_field(sources, 'mindiff', mindiff)
+    set_candidate_field(sources, 'earliest_detection', earliest_detection)
+    set_candidate_field(sources, 'stationary_flag', stationary_flag)
+    set_candidate_field(sources, 'old_prv_cands_flag', old_prv_cands_flag)
 
     if save:
-        save_candidates_to_file(deepcopy(sources),
-                                savefile=f'{outdir}/fritz_emgw_stationary_stage.csv')
-    selected_source_mask = [(x['stationary_flag']) & (x['old_prv_cands_flag'])
-                            for x in sources]
+        save_candidates_to_file(sources,
+                                savefile=f'{outdir}/fritz_emgw_stationary_stage.csv',
+                                background=background_save)
+    selected_source_mask = stationary_flag & old_prv_cands_flag
 
     return sources[selected_source_mask]
@@ -1,8 +1,15 @@
 from penquins import Kowalski
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from emgwcave.query_cache import QueryCache, CachedKowalski
+from emgwcave.cassette import RecordingKowalski, ReplayKowalski
+from emgwcave.tiled_query import search_in_skymap_tiled
 
 default_projection_kwargs = {
+    "objectId": 1,
+    "candid": 1,
     "candidate.jdstarthist": 1,
     "candidate.isdiffpos": 1,
     "candidate.drb": 1,
@@ -28,8 +35,52 @@ default_projection_kwargs = {
     "candidate.magap": 1,
     }
 
+# Fields of the previous candidates read by make_photometry and the stationary stage
+default_prv_candidates_fields = ['jd', 'fid', 'magpsf', 'sigmapsf', 'diffmaglim',
+                                 'isdiffpos', 'candid', 'programid']
+
+# Crossmatch catalogs and fields read by annotate_candidates and make_full_pdf
+default_cross_matches_fields = {
+    'CLU_20190625': ['z', 'z_err', 'coordinates.distance_arcsec'],
+    'AllWISE': ['w1mpro', 'w2mpro'],
+    'PS1_STRM': ['class', 'prob_Star', 'prob_Galaxy', 'prob_QSO', 'z_phot'],
+}
+
+
+def get_prv_candidates_projection(fields: list[str] = None):
+    """Aux alerts projection returning only the given fields of prv_candidates"""
+    if fields is None:
+        fields = default_prv_candidates_fields
+    return {f'prv_candidates.{field}': 1 for field in fields}
+
+
+def get_cross_matches_projection(catalog_fields: dict = None):
+    """Aux alerts projection returning only the given {catalog: fields} of
+    cross_matches"""
+    if catalog_fields is None:
+        catalog_fields = default_cross_matches_fields
+    return {f'cross_matches.{catalog}.{field}': 1
+            for catalog, fields in catalog_fields.items() for field in fields}
+
+
+# One shared Kowalski client per process, see connect_kowalski
+_kowalski_sessions = {}
+_kowalski_session_lock = threading.Lock()
+_kowalski_session_stats = {'clients_created': 0, 'client_reuses': 0}
+
+
+def create_kowalski_client(pool_maxsize: int = 32):
+    """
+    Build and ping a new Kowalski client. If the KOWALSKI_CASSETTE environment
+    variable points to a cassette file and KOWALSKI_CASSETTE_MODE=replay (the
+    default), the client is replaced by an offline stand-in that replays the
+    recorded responses (recording is set up by connect_kowalski).
+    """
+    cassette_path, cassette_mode = get_cassette_settings()
+    if (cassette_path is not None) & (cassette_mode == 'replay'):
+        print(f'Replaying kowalski responses from {cassette_path}')
+        return ReplayKowalski(cassette_path)
 
-def connect_kowalski():
     kowalski_token = os.getenv('KOWALSKI_TOKEN')
     kowalski_url = os.getenv('KOWALSKI_URL')
     kowalski_port = os.getenv('KOWALSKI_PORT')
@@ -50,12 +101,110 @@ def connect_kowalski():
         raise ValueError(err)
 
     protocol, host, port = "https", kowalski_url, kowalski_port
-    kowalski = Kowalski(token=kowalski_token, protocol=protocol, host=host, port=port)
+    # The connection pool has to be at least as large as the number of threads
+    # querying concurrently, otherwise connections are dropped and re-opened
+    kowalski = Kowalski(token=kowalski_token, protocol=protocol, host=host, port=port,
+                        pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
     connection_ok = kowalski.ping()
     print(f'Connection OK: {connection_ok}')
     return kowalski
 
 
+def get_cassette_settings():
+    """The cassette path and mode set by the KOWALSKI_CASSETTE and
+    KOWALSKI_CASSETTE_MODE environment variables"""
+    cassette_path = os.getenv('KOWALSKI_CASSETTE')
+    cassette_mode = os.getenv('KOWALSKI_CASSETTE_MODE', 'replay')
+    if cassette_mode not in ['record', 'replay']:
+        err = f"KOWALSKI_CASSETTE_MODE must be record or replay, got {cassette_mode}"
+        print(err)
+        raise ValueError(err)
+    return cassette_path, cassette_mode
+
+
+def wrap_kowalski_client(kowalski,
+                         cache_dir: str | Path = None,
+                         cache_max_size_mb: float = 2048):
+    """
+    Add the on-disk query cache and, with KOWALSKI_CASSETTE_MODE=record, the
+    cassette recorder to a client. The recorder sits above the cache, so that
+    responses served from the cache are recorded too.
+    """
+    if cache_dir is not None:
+        kowalski = CachedKowalski(kowalski, QueryCache(cache_dir, cache_max_size_mb))
+    cassette_path, cassette_mode = get_cassette_settings()
+    if (cassette_path is not None) & (cassette_mode == 'record'):
+        print(f'Recording kowalski responses to {cassette_path}')
+        kowalski = RecordingKowalski(kowalski, cassette_path)
+    return kowalski
+
+
+def connect_kowalski(reuse: bool = True,
+                     pool_maxsize: int = 32,
+                     cache_dir: str | Path = None,
+                     cache_max_size_mb: float = 2048):
+    """
+    Get a Kowalski client. By default, one client is created (and pinged) per
+    process and shared by every caller, so that its keep-alive HTTP connection pool
+    is reused across the pipeline and by concurrent threads.
+
+    :param reuse: return the shared client, if False always build a new one
+    :param pool_maxsize: size of the HTTP connection pool of a new client
+    :param cache_dir: if given, a new client serves repeated queries from an
+    on-disk cache in this directory
+    :param cache_max_size_mb: size cap of the on-disk cache
+    """
+    if not reuse:
+        kowalski = create_kowalski_client(pool_maxsize=pool_maxsize)
+        return wrap_kowalski_client(kowalski, cache_dir=cache_dir,
+                                    cache_max_size_mb=cache_max_size_mb)
+
+    with _kowalski_session_lock:
+        pid = os.getpid()
+        if pid in _kowalski_sessions:
+            _kowalski_session_stats['client_reuses'] += 1
+            return _kowalski_sessions[pid]
+
+        kowalski = create_kowalski_client(pool_maxsize=pool_maxsize)
+        kowalski = wrap_kowalski_client(kowalski, cache_dir=cache_dir,
+                                        cache_max_size_mb=cache_max_size_mb)
+        _kowalski_sessions[pid] = kowalski
+        _kowalski_session_stats['clients_created'] += 1
+    return kowalski
+
+
+def get_connection_stats(k=None):
+    """Report how often the shared client was reused, and how many HTTP(S)
+    connections were opened vs. requests sent through the client's pools"""
+    stats = dict(_kowalski_session_stats)
+    if k is None:
+        k = _kowalski_sessions.get(os.getpid())
+    if k is None:
+        return stats
+
+    if isinstance(k, RecordingKowalski):
+        k = k.k
+    if isinstance(k, CachedKowalski):
+        stats['cache'] = k.cache.get_stats()
+        k = k.k
+
+    if hasattr(k, 'instances'):
+        sessions = [instance['session'] for instance in k.instances.values()]
+    else:
+        sessions = [k.session]
+
+    stats['http_connections_opened'] = 0
+    stats['http_requests'] = 0
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['http_connections_opened'] += pool.num_connections
+                stats['http_requests'] += pool.num_requests
+    return stats
+
+
 def query_aux_alerts(k, name, projection=None, instrument="ZTF"):
     if projection is None:
         projection = {'prv_candidates': 0}
@@ -77,29 +226,275 @@ def query_aux_alerts(k, name, projection=None, instrument="ZTF"):
     return data
 
 
-def run_pipeline_offline(k, pipelines_array):
-    queries = [{
-        "query_type": "aggregate",
-        "query": {
-            "catalog": "ZTF_alerts",
-            "pipeline": pipeline,
-            "kwargs": {
-                "max_time_ms": 100000
-            }
-        }
-    } for pipeline in pipelines_array]
+def chunk_list(items: list, chunk_size: int):
+    """Split a list into consecutive chunks of at most chunk_size items"""
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def run_queries(k, queries: list[dict], n_threads: int = 8,
+                query_slots: threading.Semaphore = None):
+    """Run independent Kowalski queries concurrently on a thread pool.
+    The responses are returned in the same order as the queries. If query_slots is
+    given, each query holds one of its slots while in flight, so that several
+    run_queries calls sharing it (e.g. threading.BoundedSemaphore(8)) have at most
+    that many queries in flight in total.
+    """
+    if len(queries) == 0:
+        return []
+
+    def run_query(query):
+        if query_slots is None:
+            return k.query(query=query)
+        with query_slots:
+            return k.query(query=query)
+
+    n_threads = max(1, min(n_threads, len(queries)))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        responses = list(executor.map(run_query, queries))
+    return responses
+
+
+def query_aux_alerts_batch(k,
+                           names: list[str],
+                           projection: dict = None,
+                           instrument: str = "ZTF",
+                           chunk_size: int = 200,
+                           n_threads: int = 8,
+                           query_slots: threading.Semaphore = None):
+    """Query the aux alerts catalog for many objects at once, using one $in find
+    query per chunk of names. Returns a dictionary of {name: aux document}.
+    """
+    if projection is None:
+        projection = {'prv_candidates': 0}
+
+    names = list(dict.fromkeys(names))
+    queries = [get_find_query(catalog=f'{instrument}_alerts_aux',
+                              filter={'_id': {'$in': chunk}},
+                              projection=projection)
+               for chunk in chunk_list(names, chunk_size)]
+    responses = run_queries(k, queries, n_threads=n_threads,
+                            query_slots=query_slots)
+
+    data = {}
+    for response in responses:
+        response = response['default']
+        if response['status'] != 'success':
+            err = f"Aux alerts query failed : {response.get('message')}"
+            print(err)
+            raise ValueError(err)
+        for doc in response['data']:
+            data[doc['_id']] = doc
+    return data
+
+
+def cone_search_batch(k,
+                      coords_dict: dict,
+                      catalog: str,
+                      projection: dict,
+                      filter: dict = {},
+                      cone_search_radius: float = 2,
+                      chunk_size: int = 200,
+                      n_threads: int = 8,
+                      query_slots: threading.Semaphore = None):
+    """Run multi-object cone searches on a catalog for all objects in coords_dict
+    ({name: [ra, dec]}), with chunk_size objects per query and n_threads queries
+    running concurrently. Returns a dictionary of {name: list of matches}.
+    """
+    names = list(coords_dict.keys())
+    queries = [get_cone_search_query(coords_dict={name: coords_dict[name]
+                                                  for name in chunk},
+                                     catalog=catalog,
+                                     projection=projection,
+                                     filter=filter,
+                                     cone_search_radius=cone_search_radius)
+               for chunk in chunk_list(names, chunk_size)]
+    responses = run_queries(k, queries, n_threads=n_threads,
+                            query_slots=query_slots)
+
+    matches = {}
+    for response in responses:
+        response = response['default']
+        if response['status'] != 'success':
+            err = f"Cone search on {catalog} failed : {response.get('message')}"
+            print(err)
+            raise ValueError(err)
+        matches.update(response['data'][catalog])
+    return matches
+
 
-    # response = k.query(query=q)
-    responses = k.batch_query(queries=queries, n_treads=len(pipelines_array))
+def run_pipeline_offline(k,
+                         pipelines_array: list[list[dict]],
+                         catalog: str = "ZTF_alerts",
+                         n_threads: int = 8,
+                         query_slots: threading.Semaphore = None):
+    """Run aggregation pipelines on a catalog concurrently (see run_queries), and
+    return the concatenated results"""
+    queries = [get_aggregate_query(catalog=catalog,
+                                   pipeline=pipeline,
+                                   query_kwargs={"max_time_ms": 100000,
+                                                 "allowDiskUse": True})
+               for pipeline in pipelines_array]
+    responses = run_queries(k, queries, n_threads=n_threads,
+                            query_slots=query_slots)
 
     data = []
     for response in responses:
-        print(f"Response {response['status']}:{response['message']}")
-        data = data+response.get("data")
+        response = response['default']
+        if response['status'] != 'success':
+            err = f"Aggregation on {catalog} failed : {response.get('message')}"
+            print(err)
+            raise ValueError(err)
+        data += response['data']
 
     return data
 
 
+def get_alert_window_filter(jd_start: float,
+                            jd_end: float,
+                            jdstarthist_start: float,
+                            jdstarthist_end: float,
+                            program_ids: list[int] = [1, 2, 3],
+                            filter_kwargs: dict = {}):
+    """Filter on the alerts selected by query_skymap, apart from the position"""
+    return {"candidate.jd": {"$gt": jd_start, "$lt": jd_end},
+            "candidate.jdstarthist": {"$gt": jdstarthist_start,
+                                      "$lt": jdstarthist_end},
+            "candidate.programid": {"$in": program_ids},
+            **filter_kwargs}
+
+
+def get_latest_candids(k,
+                       object_ids: list[str],
+                       catalog: str = "ZTF_alerts",
+                       filter: dict = None,
+                       chunk_size: int = 200,
+                       n_threads: int = 8,
+                       query_slots: threading.Semaphore = None):
+    """candid of the newest alert of each object passing the filter, with one
+    aggregation per chunk of object_ids. Returns a dictionary of {objectId: candid}.
+    """
+    pipelines = [get_latest_alert_pipeline(object_ids=chunk, filter=filter)
+                 for chunk in chunk_list(list(object_ids), chunk_size)]
+    latest = run_pipeline_offline(k, pipelines, catalog=catalog, n_threads=n_threads,
+                                  query_slots=query_slots)
+    return {alert['_id']: alert['candid'] for alert in latest}
+
+
+def find_alerts_by_candid(k,
+                          candids: list[int],
+                          projection: dict = None,
+                          catalog: str = "ZTF_alerts",
+                          filter: dict = None,
+                          chunk_size: int = 200,
+                          n_threads: int = 8,
+                          query_slots: threading.Semaphore = None):
+    """Alerts with the given candids (and passing the filter, if given), with one
+    $in find query per chunk of candids"""
+    if filter is None:
+        filter = {}
+    queries = [get_find_query(catalog=catalog,
+                              filter={'candid': {'$in': chunk}, **filter},
+                              projection={} if projection is None else projection)
+               for chunk in chunk_list(list(candids), chunk_size)]
+    responses = run_queries(k, queries, n_threads=n_threads,
+                            query_slots=query_slots)
+
+    data = []
+    for response in responses:
+        response = response['default']
+        if response['status'] != 'success':
+            err = f"Query of alerts by candid on {catalog} failed : " \
+                  f"{response.get('message')}"
+            print(err)
+            raise ValueError(err)
+        data += response['data']
+    return data
+
+
+def search_latest_in_skymap(k: Kowalski,
+                            skymap_path: Path,
+                            cumprob: float,
+                            jd_start: float,
+                            jd_end: float,
+                            jdstarthist_start: float,
+                            jdstarthist_end: float,
+                            max_n_threads: int = 8,
+                            catalogs: list = ['ZTF_alerts'],
+                            filter_kwargs: dict = {},
+                            projection_kwargs: dict = {},
+                            n_tiles: int = None,
+                            timings_path: str | Path = None,
+                            chunk_size: int = 200,
+                            latest_filter: dict = None,
+                            n_rejected_sample: int = 0):
+    """
+    Newest alert of each object in the credible region of a skymap. The region is
+    first queried for the objectIds only, then the candid of the newest alert of
+    each object in the same window is resolved (see get_latest_candids), and only
+    these alerts are retrieved with the full projection, so that the older alerts
+    of an object are never transferred.
+    If latest_filter is given, only the newest alerts passing it are retrieved :
+    the filter is applied after deduplication, as the local filters are. A sample of
+    at most n_rejected_sample newest alerts failing it is retrieved too.
+
+    :return: dictionaries of {catalog: list} of the retrieved alerts, of the
+    objectIds found in the credible region, and of the sample of rejected alerts
+    """
+    object_alerts = search_in_skymap(k,
+                                     skymap_path=skymap_path,
+                                     cumprob=cumprob,
+                                     jd_start=jd_start,
+                                     jd_end=jd_end,
+                                     jdstarthist_start=jdstarthist_start,
+                                     jdstarthist_end=jdstarthist_end,
+                                     max_n_threads=max_n_threads,
+                                     catalogs=catalogs,
+                                     filter_kwargs=filter_kwargs,
+                                     projection_kwargs={"objectId": 1},
+                                     n_tiles=n_tiles,
+                                     timings_path=timings_path)['default']
+    window_filter = get_alert_window_filter(jd_start=jd_start,
+                                            jd_end=jd_end,
+                                            jdstarthist_start=jdstarthist_start,
+                                            jdstarthist_end=jdstarthist_end,
+                                            filter_kwargs=filter_kwargs)
+    projection = None
+    if len(projection_kwargs) > 0:
+        # query_skymap always returns the positions
+        projection = {"objectId": 1, "candid": 1, "candidate.jd": 1,
+                      "candidate.ra": 1, "candidate.dec": 1, **projection_kwargs}
+
+    alerts, object_ids, rejected_alerts = {}, {}, {}
+    for catalog in catalogs:
+        object_ids[catalog] = list(dict.fromkeys(alert['objectId'] for alert
+                                                 in object_alerts.get(catalog, [])))
+        latest_candids = get_latest_candids(k, object_ids=object_ids[catalog],
+                                            catalog=catalog, filter=window_filter,
+                                            chunk_size=chunk_size,
+                                            n_threads=max_n_threads)
+        alerts[catalog] = find_alerts_by_candid(k,
+                                                candids=list(latest_candids.values()),
+                                                projection=projection,
+                                                catalog=catalog,
+                                                filter=latest_filter,
+                                                chunk_size=chunk_size,
+                                                n_threads=max_n_threads)
+        print(f"Retrieved the latest alert of {len(alerts[catalog])} objects out of "
+              f"{len(object_ids[catalog])} objects and "
+              f"{len(object_alerts.get(catalog, []))} alerts in {catalog}")
+
+        rejected_alerts[catalog] = []
+        if (latest_filter is not None) & (n_rejected_sample > 0):
+            retrieved_candids = set(alert['candid'] for alert in alerts[catalog])
+            rejected_candids = [candid for candid in latest_candids.values()
+                                if candid not in retrieved_candids]
+            rejected_alerts[catalog] = find_alerts_by_candid(
+                k, candids=rejected_candids[:n_rejected_sample],
+                projection=projection, catalog=catalog, chunk_size=chunk_size,
+                n_threads=max_n_threads)
+    return alerts, object_ids, rejected_alerts
+
+
 def search_in_skymap(k: Kowalski,
                      skymap_path: Path,
                      cumprob: float,
@@ -110,7 +505,44 @@ def search_in_skymap(k: Kowalski,
                      max_n_threads: int = 8,
                      catalogs: list = ['ZTF_alerts'],
                      filter_kwargs: dict = {},
-                     projection_kwargs: dict = {}):
+                     projection_kwargs: dict = {},
+                     n_tiles: int = None,
+                     timings_path: str | Path = None,
+                     latest_only: bool = False,
+                     chunk_size: int = 200):
+    """
+    Query the alerts in the credible region of a skymap. If n_tiles is given, the
+    region is split into n_tiles equal-area tiles queried by max_n_threads workers
+    (see search_in_skymap_tiled), with the per-tile timings written to
+    timings_path.
+    If latest_only, only the newest alert of each object in the same window is
+    retrieved with the full projection (see search_latest_in_skymap).
+    """
+    if latest_only:
+        cands_in_skymap, _, _ = search_latest_in_skymap(
+            k, skymap_path=skymap_path, cumprob=cumprob, jd_start=jd_start,
+            jd_end=jd_end, jdstarthist_start=jdstarthist_start,
+            jdstarthist_end=jdstarthist_end, max_n_threads=max_n_threads,
+            catalogs=catalogs, filter_kwargs=filter_kwargs,
+            projection_kwargs=projection_kwargs, n_tiles=n_tiles,
+            timings_path=timings_path, chunk_size=chunk_size)
+        return {'default': cands_in_skymap}
+
+    if n_tiles is not None:
+        return search_in_skymap_tiled(k,
+                                      skymap_path=skymap_path,
+                                      cumprob=cumprob,
+                                      jd_start=jd_start,
+                                      jd_end=jd_end,
+                                      jdstarthist_start=jdstarthist_start,
+                                      jdstarthist_end=jdstarthist_end,
+                                      n_workers=max_n_threads,
+                                      n_tiles=n_tiles,
+                                      catalogs=catalogs,
+                                      filter_kwargs=filter_kwargs,
+                                      projection_kwargs=projection_kwargs,
+                                      timings_path=timings_path)
+
     cands_in_skymap = k.query_skymap(path=skymap_path,
                                      cumprob=cumprob,
                                      jd_start=jd_start,
@@ -143,6 +575,38 @@ def get_find_query(catalog: str,
     return q
 
 
+def get_aggregate_query(catalog: str,
+                        pipeline: list[dict],
+                        query_kwargs: dict = {}):
+    q = {
+        'query_type': 'aggregate',
+        'query': {
+            'catalog': catalog,
+            'pipeline': pipeline,
+            'kwargs': query_kwargs
+        }
+    }
+    return q
+
+
+def get_latest_alert_pipeline(object_ids: list[str],
+                              filter: dict = None):
+    """Aggregation pipeline that returns the candid of the newest alert (by
+    candidate.jd) of each of the object_ids, among the alerts passing filter, as
+    {'_id': objectId, 'candid': candid}. The alerts are projected to these fields
+    before they are sorted, so that the cutouts are never sorted in memory."""
+    match = {"objectId": {"$in": object_ids}}
+    if filter is not None:
+        match.update(filter)
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "objectId": 1, "candid": 1, "candidate.jd": 1}},
+        {"$sort": {"candidate.jd": -1}},
+        {"$group": {"_id": "$objectId", "candid": {"$first": "$candid"}}},
+    ]
+    return pipeline
+
+
 def get_cone_search_query(coords_dict: dict,
                           catalog: str,
                           projection: dict,
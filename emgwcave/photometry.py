@@ -0,0 +1,226 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from emgwcave.candidate_table import CandidateTable, get_candidate_field
+
+# note: WNTR (like PGIR) uses 2massj, which is not in sncosmo as of
+# 20210803, cspjs seems to be close/good enough as an approximation
+# 20220818: added WNTR
+# 20220929: nir bandpasses have been added to sncosmo
+instrument_filters = {
+    'ZTF': {1: "ztfg", 2: "ztfr", 3: "ztfi"},
+    'WNTR': {0: "ps1::y", 1: "2massj", 2: "2massh", 3: "2massks"},
+}
+
+positive_flux_isdiffpos_values = [True, 1, "y", "Y", "t", "1"]
+
+
+class PhotometryTable:
+    """
+    Long-format photometry of many objects, in a single DataFrame sorted by object
+    and mjd. The photometry of one object is a slice of it, with the same index
+    as the per-object DataFrames of make_photometry.
+    """
+
+    def __init__(self, data: pd.DataFrame, slices: dict):
+        self.data = data
+        self.slices = slices
+
+    def __getitem__(self, name: str):
+        start, end = self.slices[name]
+        return self.data.iloc[start:end]
+
+    def __contains__(self, name: str):
+        return name in self.slices
+
+    def __len__(self):
+        return len(self.slices)
+
+    def object_ids(self):
+        return list(self.slices.keys())
+
+
+def get_candidate_rows(candidates):
+    """The candidate dictionaries of all candidates, as one DataFrame"""
+    if isinstance(candidates, CandidateTable):
+        return pd.DataFrame({path.split('.', 1)[1]: candidates[path]
+                             for path in candidates.field_order
+                             if path.startswith('candidate.')
+                             and path in candidates.columns})
+    return pd.DataFrame([dict(candidate['candidate']) for candidate in candidates])
+
+
+def get_prv_candidates_lists(candidates):
+    if isinstance(candidates, CandidateTable):
+        if 'prv_candidates' not in candidates:
+            return [[] for _ in range(len(candidates))]
+        return [[] if prv_candidates is None else prv_candidates
+                for prv_candidates in candidates['prv_candidates']]
+    return [candidate.get('prv_candidates') or [] for candidate in candidates]
+
+
+def make_photometry_table(candidates,
+                          jd_start: float = None,
+                          instrument: str = 'ZTF'):
+    """
+    De-duplicated photometry (latest alert and prv_candidates) of all candidates,
+    built in one vectorized pass. Same processing as the per-alert photometry of
+    Kowalski (https://github.com/dmitryduev/kowalski) : duplicates in (mjd,
+    magpsf) are dropped, points without a valid diffmaglim are removed, and
+    flux/fluxerr are computed at an AB zeropoint of 23.9.
+
+    :param candidates: candidate dictionaries or CandidateTable
+    :param jd_start: date from which to start photometry from
+    :param instrument: instrument name, used to name the filters
+    :return: PhotometryTable, indexed by objectId
+    """
+    object_ids = get_candidate_field(candidates, 'objectId').tolist()
+    df_candidates = get_candidate_rows(candidates)
+    prv_candidates_lists = get_prv_candidates_lists(candidates)
+    n_prv_candidates = np.array([len(prv_candidates)
+                                 for prv_candidates in prv_candidates_lists],
+                                dtype=int)
+    df_prv_candidates = pd.DataFrame([prv_candidate for prv_candidates
+                                      in prv_candidates_lists
+                                      for prv_candidate in prv_candidates])
+
+    # Each object has its latest alert first, then its prv_candidates in order
+    object_index = np.concatenate([np.arange(len(object_ids)),
+                                   np.repeat(np.arange(len(object_ids)),
+                                             n_prv_candidates)])
+    prv_offsets = np.cumsum(n_prv_candidates) - n_prv_candidates
+    sequence = np.concatenate([np.zeros(len(object_ids), dtype=int),
+                               np.arange(np.sum(n_prv_candidates))
+                               - np.repeat(prv_offsets, n_prv_candidates) + 1])
+    order = np.lexsort((sequence, object_index))
+    df_light_curve = pd.concat(
+        [df_candidates, df_prv_candidates], ignore_index=True, sort=False
+    ).iloc[order].reset_index(drop=True)
+    object_index = object_index[order]
+
+    if len(df_light_curve) == 0:
+        return PhotometryTable(pd.DataFrame(columns=['objectId']),
+                               {name: (0, 0) for name in object_ids})
+
+    filters = instrument_filters[instrument]
+    df_light_curve["filter"] = pd.Categorical(df_light_curve["fid"].map(filters),
+                                              categories=list(filters.values()))
+    df_light_curve["magsys"] = "ab"
+    df_light_curve["mjd"] = (df_light_curve["jd"] - 2400000.5).astype(np.float64)
+    df_light_curve["magpsf"] = df_light_curve["magpsf"].astype(np.float32)
+    df_light_curve["sigmapsf"] = df_light_curve["sigmapsf"].astype(np.float32)
+
+    # De-duplicate within each object, and label the rows of each object as
+    # make_photometry did, before sorting them by mjd
+    duplicated = pd.DataFrame({"object": object_index,
+                               "mjd": df_light_curve["mjd"],
+                               "magpsf": df_light_curve["magpsf"]}).duplicated()
+    df_light_curve = df_light_curve.loc[~duplicated.to_numpy()]
+    object_index = object_index[~duplicated.to_numpy()]
+    row_labels = pd.Series(object_index).groupby(object_index).cumcount().to_numpy()
+
+    order = np.lexsort((df_light_curve["mjd"].to_numpy(), object_index))
+    df_light_curve = df_light_curve.iloc[order]
+    object_index, row_labels = object_index[order], row_labels[order]
+
+    # filter out bad data:
+    mask_good = (df_light_curve["diffmaglim"] > 0).to_numpy()
+    if jd_start is not None:
+        # only "new" photometry requested
+        mask_good = mask_good & (df_light_curve["jd"] > jd_start).to_numpy()
+    df_light_curve = df_light_curve.loc[mask_good]
+    object_index, row_labels = object_index[mask_good], row_labels[mask_good]
+
+    # convert from mag to flux, normalized to an arbitrary AB zeropoint of
+    # 23.9 (results in flux in uJy)
+    positive = df_light_curve["isdiffpos"].isin(positive_flux_isdiffpos_values)
+    coeff = np.where(positive, 1.0, -1.0)
+    df_light_curve["flux"] = coeff * 10 ** (-0.4 * (df_light_curve["magpsf"] - 23.9))
+
+    # fluxerr from sigmapsf for detections, and from diffmaglim (the 5-sigma
+    # depth) for non detections
+    detected = np.isfinite(df_light_curve["magpsf"]).to_numpy()
+    df_light_curve["fluxerr"] = np.where(
+        detected,
+        np.abs(df_light_curve["sigmapsf"] * df_light_curve["flux"] * np.log(10) / 2.5),
+        10 ** (-0.4 * (df_light_curve["diffmaglim"] - 23.9)) / 5.0
+    )
+
+    df_light_curve["zp"] = 23.9
+    df_light_curve["zpsys"] = "ab"
+
+    df_light_curve.index = row_labels
+    df_light_curve.insert(0, "objectId",
+                          np.array(object_ids, dtype=object)[object_index])
+
+    starts = np.searchsorted(object_index, np.arange(len(object_ids)), side='left')
+    ends = np.searchsorted(object_index, np.arange(len(object_ids)), side='right')
+    slices = {name: (int(start), int(end))
+              for name, start, end in zip(object_ids, starts, ends)}
+    return PhotometryTable(df_light_curve, slices)
+
+
+def check_parquet_support():
+    """Raise an ImportError if pyarrow, needed for the parquet outputs, is missing"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        err = "The parquet output format requires pyarrow, please install it with " \
+              "pip install emgwcave[parquet]"
+        print(err)
+        raise ImportError(err) from e
+
+
+def get_photometry_dataset_path(phot_dir: str | Path):
+    return os.path.join(phot_dir, 'photometry.parquet')
+
+
+def write_photometry_dataset(photometry: PhotometryTable, savepath: str | Path):
+    """Write the photometry of all objects as a compressed parquet dataset
+    partitioned by objectId, replacing any previous one at savepath"""
+    check_parquet_support()
+    shutil.rmtree(savepath, ignore_errors=True)
+    if len(photometry.data) == 0:
+        os.makedirs(savepath)
+        return
+    photometry.data.to_parquet(savepath, partition_cols=['objectId'],
+                               compression='zstd')
+
+
+def read_photometry_dataset(savepath: str | Path,
+                            object_ids: list[str] = None,
+                            columns: list[str] = None):
+    """
+    Read the photometry written by write_photometry_dataset
+
+    :param savepath: path of the dataset
+    :param object_ids: only read the partitions of these objects
+    :param columns: only read these columns
+    :return: PhotometryTable, with empty photometry for the requested objects that
+    are not in the dataset
+    """
+    check_parquet_support()
+    filters = None
+    if object_ids is not None:
+        object_ids = list(object_ids)
+        filters = [('objectId', 'in', object_ids)]
+    if columns is not None:
+        columns = list(dict.fromkeys(['objectId'] + list(columns)))
+    data = pd.read_parquet(savepath, columns=columns, filters=filters)
+
+    # Partitions are read back as a last, categorical, column in no particular order
+    data_object_ids = data.pop('objectId').astype(str).to_numpy()
+    order = np.argsort(data_object_ids, kind='stable')
+    data = data.iloc[order]
+    data.insert(0, 'objectId', data_object_ids[order])
+    names, starts, counts = np.unique(data_object_ids[order], return_index=True,
+                                      return_counts=True)
+    slices = {name: (int(start), int(start + count))
+              for name, start, count in zip(names, starts, counts)}
+    for name in (object_ids or []):
+        slices.setdefault(name, (0, 0))
+    return PhotometryTable(data, slices)
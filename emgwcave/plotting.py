@@ -14,6 +14,9 @@ from astropy.stats import sigma_clipped_stats
 from matplotlib.gridspec import GridSpec
 from matplotlib.backends.backend_pdf import PdfPages
 from emgwcave.skymap_utils import get_flattened_skymap_path
+from emgwcave.candidate_table import as_candidate_array, get_candidate_field
+from emgwcave.photometry import PhotometryTable, read_photometry_dataset, \
+    get_photometry_dataset_path
 matplotlib.use('Agg')
 
 
@@ -68,31 +71,59 @@ def plot_thumbnail(data, savename=None, ax=None, save=True):
     return ax
 
 
-def save_thumbnails(candidates: dict,
-                    thumbnails_dir: str | Path,
-                    plot: bool = False):
-    print(f'Saving thtumbnails to {thumbnails_dir}')
-    for candidate in candidates:
-        sci_cutout = candidate['cutoutScience']['stampData']
-        ref_cutout = candidate['cutoutTemplate']['stampData']
-        diff_cutout = candidate['cutoutDifference']['stampData']
-        name = candidate['objectId']
+# Thumbnail names and the alert cutouts they are decoded from
+thumbnail_cutout_keys = {'sci': 'cutoutScience',
+                         'ref': 'cutoutTemplate',
+                         'diff': 'cutoutDifference'}
 
-        # print(name, sci_cutout)
-        sci_cutout_data = get_data_from_bytes(sci_cutout)
-        ref_cutout_data = get_data_from_bytes(ref_cutout)
-        diff_cutout_data = get_data_from_bytes(diff_cutout)
 
-        with open(os.path.join(thumbnails_dir, f"{name}_sci.npy"), 'w') as f:
-            np.savetxt(f, sci_cutout_data)
+def get_thumbnails_path(thumbnails_dir: str | Path, raw: bool = False):
+    return os.path.join(thumbnails_dir,
+                        'thumbnails_raw.npz' if raw else 'thumbnails.npz')
 
-        with open(os.path.join(thumbnails_dir, f"{name}_ref.npy"), 'w') as f:
-            np.savetxt(f, ref_cutout_data)
 
-        with open(os.path.join(thumbnails_dir, f"{name}_diff.npy"), 'w') as f:
-            np.savetxt(f, diff_cutout_data)
+def load_thumbnails(thumbnails_dir: str | Path, raw: bool = False):
+    """Thumbnails saved by save_thumbnails, as a lazily loaded {f'{name}_{kind}':
+    array} mapping"""
+    return np.load(get_thumbnails_path(thumbnails_dir, raw=raw))
 
-        if plot:
+
+def save_thumbnails(candidates: dict,
+                    thumbnails_dir: str | Path,
+                    plot: bool = False,
+                    keep_raw: bool = False):
+    """
+    Decode the cutouts of the candidates, and save them as binary arrays in a single
+    compressed thumbnails.npz file in thumbnails_dir, with keys {name}_sci,
+    {name}_ref and {name}_diff.
+
+    :param plot: also save a png of each thumbnail
+    :param keep_raw: also keep the raw gzipped FITS bytes of the cutouts, for
+    provenance, in thumbnails_raw.npz
+    :return: the decoded thumbnails, that can be passed to make_full_pdf
+    """
+    print(f'Saving thumbnails to {thumbnails_dir}')
+    thumbnails, raw_thumbnails = {}, {}
+    for candidate in candidates:
+        name = candidate['objectId']
+        for kind, cutout_key in thumbnail_cutout_keys.items():
+            cutout = candidate[cutout_key]['stampData']
+            thumbnails[f"{name}_{kind}"] = get_data_from_bytes(cutout)
+            if keep_raw:
+                raw_thumbnails[f"{name}_{kind}"] = np.frombuffer(cutout,
+                                                                 dtype=np.uint8)
+
+    np.savez_compressed(get_thumbnails_path(thumbnails_dir), **thumbnails)
+    if keep_raw:
+        # The cutouts are already gzipped
+        np.savez(get_thumbnails_path(thumbnails_dir, raw=True), **raw_thumbnails)
+
+    if plot:
+        for candidate in candidates:
+            name = candidate['objectId']
+            sci_cutout_data = thumbnails[f"{name}_sci"]
+            ref_cutout_data = thumbnails[f"{name}_ref"]
+            diff_cutout_data = thumbnails[f"{name}_diff"]
             sci_thumbname = os.path.join(thumbnails_dir, f"{name}_sci.png")
             ref_thumbname = os.path.join(thumbnails_dir, f"{name}_ref.png")
             diff_thumbname = os.path.join(thumbnails_dir, f"{name}_diff.png")
@@ -100,6 +131,8 @@ def save_thumbnails(candidates: dict,
             plot_thumbnail(ref_cutout_data, ref_thumbname)
             plot_thumbnail(diff_cutout_data, diff_thumbname)
 
+    return thumbnails
+
 
 color_dict = {'ztfg': 'green',
               'ztfr': 'red',
@@ -144,12 +177,31 @@ def make_full_pdf(selected_candidates: list[dict],
                   thumbnails_dir: str | Path,
                   phot_dir: str | Path,
                   pdffilename: str,
-                  mjd0=0):
-    if not isinstance(selected_candidates, np.ndarray):
-        selected_candidates = np.array(selected_candidates)
-
-    annotation_ids = np.array([candidate['annotation_id']
-                               for candidate in selected_candidates])
+                  mjd0=0,
+                  photometry: PhotometryTable = None,
+                  photometry_format: str = 'csv',
+                  thumbnails: dict = None):
+    """
+    Make a pdf with one page per candidate, with its thumbnails and light curve.
+    The thumbnails are read from thumbnails_dir (see save_thumbnails), and the light
+    curves from phot_dir (the lc_{name}.csv files, or the parquet dataset if
+    photometry_format is parquet), unless they are given.
+    """
+    selected_candidates = as_candidate_array(selected_candidates)
+    if thumbnails is None:
+        try:
+            thumbnails = load_thumbnails(thumbnails_dir)
+        except FileNotFoundError as err:
+            print("Maybe the thumbnails were not created locally. Please run "
+                  "save_thumbnails first.")
+            raise err
+    if (photometry is None) & (photometry_format == 'parquet'):
+        photometry = read_photometry_dataset(
+            get_photometry_dataset_path(phot_dir),
+            object_ids=get_candidate_field(selected_candidates, 'objectId'),
+            columns=['filter', 'mjd', 'magpsf', 'sigmapsf', 'diffmaglim'])
+
+    annotation_ids = get_candidate_field(selected_candidates, 'annotation_id')
     selected_candidates = selected_candidates[np.argsort(annotation_ids)]
     with PdfPages(pdffilename) as pdf:
         for candidate in selected_candidates:
@@ -158,21 +210,15 @@ def make_full_pdf(selected_candidates: list[dict],
 
             name = candidate['objectId']
 
-            try:
-                sci_thumbnail_data = np.loadtxt(os.path.join(thumbnails_dir,
-                                                             f"{name}_sci.npy"))
-                ref_thumbnail_data = np.loadtxt(os.path.join(thumbnails_dir,
-                                                             f"{name}_ref.npy"))
-                diff_thumbnail_data = np.loadtxt(os.path.join(thumbnails_dir,
-                                                              f"{name}_diff.npy"))
-
-            except FileNotFoundError as err:
-                print("Maybe the thumbnail plots were not created locally. Please run "
-                      "without -skip_thumbnails option.")
-                raise err
+            sci_thumbnail_data = thumbnails[f"{name}_sci"]
+            ref_thumbnail_data = thumbnails[f"{name}_ref"]
+            diff_thumbnail_data = thumbnails[f"{name}_diff"]
 
-            photometry_df = pd.read_csv(os.path.join(phot_dir,
-                                                     f"lc_{name}.csv"))
+            if photometry is not None:
+                photometry_df = photometry[name]
+            else:
+                photometry_df = pd.read_csv(os.path.join(phot_dir,
+                                                         f"lc_{name}.csv"))
 
             ax = plt.subplot(gs[0])
             ax = plot_thumbnail(sci_thumbnail_data, ax=ax, save=False)
@@ -233,3 +279,6 @@ def make_full_pdf(selected_candidates: list[dict],
             ax.axis('off')
             pdf.savefig(fig)
             plt.close()
+
+    if isinstance(thumbnails, np.lib.npyio.NpzFile):
+        thumbnails.close()
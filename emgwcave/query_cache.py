@@ -0,0 +1,238 @@
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+
+from astropy.time import Time
+
+default_cache_dir = os.path.join(Path.home(), '.cache', 'emgwcave')
+
+
+def get_file_hash(path: str | Path, chunk_size: int = 2 ** 20):
+    """sha256 of the contents of a file"""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def normalize_query(query: dict):
+    """Canonical string representation of a query dictionary"""
+    return json.dumps(query, sort_keys=True, default=str)
+
+
+def get_query_key(method: str, query: dict):
+    """Content address of a query, used as the cache key"""
+    return hashlib.sha256(f"{method}:{normalize_query(query)}".encode()).hexdigest()
+
+
+def get_skymap_query_key(path: str | Path, kwargs: dict):
+    """Content address of a query_skymap call, the skymap is keyed by its contents
+    rather than its path. Returns the key and the normalized query dictionary."""
+    skymap_query = {'skymap_hash': get_file_hash(path), **kwargs}
+    skymap_query.pop('max_n_threads', None)
+    return get_query_key('query_skymap', skymap_query), skymap_query
+
+
+def get_query_ttl(method: str,
+                  query: dict,
+                  live_ttl: float = 3600.,
+                  recent_days: float = 2.):
+    """
+    Time-to-live (in seconds) of a cached query result, None if it never expires.
+    Skymap queries whose jd window ends within recent_days of now, aux queries
+    (the photometry history of an object keeps growing) and latest-alert
+    aggregations expire after live_ttl. Historical skymap queries, cone searches on
+    static catalogs and finds of specific alerts by candid never expire.
+    """
+    if method == 'query_skymap':
+        if query['jd_end'] > Time.now().jd - recent_days:
+            return live_ttl
+        return None
+
+    query_type = query.get('query_type')
+    if query_type == 'cone_search':
+        return None
+    catalog = query.get('query', {}).get('catalog', '')
+    if query_type == 'find' and not catalog.endswith('_aux') \
+            and 'candid' in query['query'].get('filter', {}):
+        return None
+    return live_ttl
+
+
+def get_staleness_warning(cache_stats: dict):
+    """Warning if results of live queries (aux documents with the photometry
+    history, latest alerts, skymap queries of recent alerts) were served from the
+    cache, None otherwise"""
+    if cache_stats.get('live_hits', 0) == 0:
+        return None
+    return f"Warning: {cache_stats['live_hits']} results of live kowalski queries " \
+           f"(photometry history, recent alerts) were served from the cache, up " \
+           f"to {cache_stats['max_live_age_min']:.0f} min old. Alerts ingested " \
+           f"since then are missing, run with -no_cache for fresh results."
+
+
+class QueryCache:
+    """
+    Content-addressed on-disk cache of Kowalski query results. Each result is
+    stored as a gzipped pickle named by the hash of the normalized query. The total
+    size is capped at max_size_mb, evicting the least recently used entries.
+    """
+
+    def __init__(self,
+                 cache_dir: str | Path = default_cache_dir,
+                 max_size_mb: float = 2048,
+                 live_ttl: float = 3600.,
+                 recent_days: float = 2.):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 2 ** 20
+        self.live_ttl = live_ttl
+        self.recent_days = recent_days
+        self.hits = 0
+        self.misses = 0
+        # Hits on entries that expire, i.e. results that may have changed since
+        # they were cached, and the age of the oldest one (in seconds)
+        self.live_hits = 0
+        self.max_live_age = 0.
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self._entries())
+
+    def _entries(self):
+        return self.cache_dir.glob('*/*.pkl.gz')
+
+    def _path(self, key: str):
+        return self.cache_dir.joinpath(key[:2], f'{key}.pkl.gz')
+
+    def get(self, key: str):
+        """Return (True, value) for a valid cache entry, (False, None) otherwise"""
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rb') as f:
+                # Entries written by earlier versions have no storage time
+                expires_at, value, *stored_at = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, OSError):
+            with self._lock:
+                self.misses += 1
+            return False, None
+
+        if expires_at is not None and expires_at < time.time():
+            self.remove(key)
+            with self._lock:
+                self.misses += 1
+            return False, None
+
+        # Touch the entry, the mtime is used for LRU eviction
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+            if expires_at is not None:
+                self.live_hits += 1
+                age = time.time() - stored_at[0] if stored_at else self.live_ttl
+                self.max_live_age = max(self.max_live_age, age)
+        return True, value
+
+    def set(self, key: str, value, ttl: float = None):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        stored_at = time.time()
+        expires_at = None if ttl is None else stored_at + ttl
+        tmp_path = path.with_suffix(f'.tmp{threading.get_ident()}')
+        with gzip.open(tmp_path, 'wb', compresslevel=3) as f:
+            pickle.dump((expires_at, value, stored_at), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        old_size = path.stat().st_size if path.exists() else 0
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += path.stat().st_size - old_size
+            if self._size > self.max_size:
+                self.evict()
+
+    def remove(self, key: str):
+        path = self._path(key)
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is 10% below its
+        size cap. Must be called with the lock held."""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self._size = sum(entry[1] for entry in entries)
+        target_size = 0.9 * self.max_size
+        for _, size, path in entries:
+            if self._size <= target_size:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'live_hits': self.live_hits,
+                'max_live_age_min': round(self.max_live_age / 60, 1),
+                'size_mb': round(self._size / 2 ** 20, 2)}
+
+
+class CachedKowalski:
+    """
+    Wrapper around a Kowalski client that serves query and query_skymap results
+    from a QueryCache. Everything else is passed through to the client.
+    """
+
+    def __init__(self, k, cache: QueryCache):
+        self.k = k
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.k, name)
+
+    def query(self, query=None, **kwargs):
+        if query is None or len(kwargs) > 0:
+            return self.k.query(query=query, **kwargs)
+
+        key = get_query_key('query', query)
+        hit, response = self.cache.get(key)
+        if hit:
+            return response
+
+        response = self.k.query(query=query)
+        if all(instance_response.get('status') == 'success'
+               for instance_response in response.values()):
+            ttl = get_query_ttl('query', query, live_ttl=self.cache.live_ttl,
+                                recent_days=self.cache.recent_days)
+            self.cache.set(key, response, ttl=ttl)
+        return response
+
+    def query_skymap(self, path, **kwargs):
+        key, cache_query = get_skymap_query_key(path, kwargs)
+        hit, response = self.cache.get(key)
+        if hit:
+            return response
+
+        response = self.k.query_skymap(path=path, **kwargs)
+        # Failed or timed out queries return a message instead of the alerts, they
+        # must not be cached (historical skymap queries never expire)
+        catalogs = kwargs.get('catalogs', ['ZTF_alerts'])
+        if all(isinstance(instance_response.get(catalog), list)
+               for instance_response in response.values() for catalog in catalogs):
+            ttl = get_query_ttl('query_skymap', cache_query,
+                                live_ttl=self.cache.live_ttl,
+                                recent_days=self.cache.recent_days)
+            self.cache.set(key, response, ttl=ttl)
+        return response
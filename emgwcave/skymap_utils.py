@@ -1,38 +1,60 @@
 import healpy as hp
 import numpy as np
 from ligo.skymap.postprocess import find_greedy_credible_levels
+from ligo.skymap.moc import uniq2nest, uniq2pixarea
 from astropy.io import fits
 from scipy.stats import norm
 import os
-from astropy.table import Table
+import re
+import tempfile
 from astropy.time import Time
+from pathlib import Path
+from emgwcave.query_cache import get_file_hash
+
+# Highest HEALPix order supported by healpy
+max_healpix_order = 29
 
 
 def get_flattened_skymap_path(skymap_path):
     return skymap_path + '_flattened.fits'
 
 
-def read_lvc_skymap_fits(filename):
-    with fits.open(filename) as h:
-        data = Table(h[1].data)
+def read_skymap_header(filename):
+    """Header of the skymap table, without reading any data"""
+    return fits.getheader(filename, ext=1)
+
+
+def read_skymap_columns(filename, columns: list[str | int]):
+    """
+    Read only the requested columns (names or indices) of the skymap table. The file
+    is memory-mapped, so the other columns are never loaded in memory. Raises
+    KeyError if a column does not exist.
+    """
+    with fits.open(filename, memmap=True) as h:
+        data = h[1].data
         header = h[1].header
+        column_names = [column.name for column in h[1].columns]
+        for column in columns:
+            if isinstance(column, int):
+                if column >= len(column_names):
+                    raise KeyError(f"Column {column} not in {filename}")
+            elif column not in column_names:
+                raise KeyError(f"Column {column} not in {filename}")
+        # Copy the columns out of the memory-mapped file before it is closed
+        column_data = [np.array(data.field(column)).ravel() for column in columns]
+    return column_data, header
 
-    prob_density = np.array(data['PROBDENSITY'])
-    distmu = np.array(data['DISTMU'])
-    distsigma = np.array(data['DISTSIGMA'])
-    distnorm = np.array(data['DISTNORM'])
+
+def read_lvc_skymap_fits(filename):
+    (prob_density, distmu, distsigma, distnorm), header = read_skymap_columns(
+        filename, ['PROBDENSITY', 'DISTMU', 'DISTSIGMA', 'DISTNORM'])
 
     return prob_density, distmu, distsigma, distnorm, header
 
 
 def read_fermi_skymap_fits(filename):
-    with fits.open(filename) as h:
-        data = Table(h[1].data)
-        header = h[1].header
-    uniq = np.array(data['UNIQ'])
-    prob_density = np.array(data['PROBDENSITY'])
-    # prob_density = np.array(data['PROBABILITY'])
-    # prob_density = np.array(data['PROB'])
+    (uniq, prob_density), header = read_skymap_columns(filename,
+                                                       ['UNIQ', 'PROBDENSITY'])
 
     return uniq, prob_density, header
 
@@ -47,6 +69,26 @@ def dist_function(r, distnorm, distmu, distsigma):
     return dp_dr
 
 
+def get_3d_localization_scores(prob_density: np.ndarray,
+                               distmu: np.ndarray,
+                               distsigma: np.ndarray,
+                               distnorm: np.ndarray,
+                               distances: np.ndarray):
+    """
+    Vectorized 3D localization scores of objects at the given luminosity distances
+    (Mpc), from the skymap parameters of their pixels. Returns the distance
+    posterior density dp/dr at the distance, the 3D posterior density
+    (per steradian per Mpc), and the offset of the distance from distmu in units of
+    distsigma. All are NaN where the distance or the map's distance information is
+    missing.
+    """
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        dp_dr = dist_function(distances, distnorm, distmu, distsigma)
+        prob_density_3d = prob_density * dp_dr
+        distance_sigma_offset = (distances - distmu) / distsigma
+    return dp_dr, prob_density_3d, distance_sigma_offset
+
+
 def flatten_skymap(skymap_path, flatten_file_path, update_object_name=False):
     cmd = f'ligo-skymap-flatten {skymap_path} {flatten_file_path}'
     print(cmd)
@@ -58,53 +100,204 @@ def flatten_skymap(skymap_path, flatten_file_path, update_object_name=False):
         h.writeto(flatten_file_path, overwrite=True)
 
 
-def read_flattened_skymap(flatten_file_path, num_fields=1):
-    try:
-        (prob, distmu, distsigma, distnorm), hdr = hp.fitsfunc. \
-            read_map(flatten_file_path,
-                     verbose=False,
-                     partial=False,
-                     field=4,
-                     h=True)
-    except IndexError:
-        prob, hdr = hp.fitsfunc.read_map(flatten_file_path,
-                                         verbose=False,
-                                         partial=False,
-                                         field=range(1),
-                                         h=True)
-        distmu, distsigma, distnorm = None, None, None
+def read_flattened_skymap(flatten_file_path, read_distance: bool = False):
+    """
+    Read a flattened HEALPix skymap with healpy.read_map, in RING ordering, from the
+    memory-mapped file. Only the probability column is read, unless read_distance is
+    True, then the distance columns are read too (they are None if the map does not
+    have them). Pixels that are not in the map (UNSEEN, e.g. in explicit-index
+    partial-sky maps) have a probability of 0 and NaN distances.
+    """
+    distmu, distsigma, distnorm = None, None, None
+    if read_distance:
+        try:
+            (prob, distmu, distsigma, distnorm), hdr = hp.read_map(
+                flatten_file_path, field=[0, 1, 2, 3], partial=False, h=True,
+                memmap=True)
+        except IndexError:
+            read_distance = False
+    if not read_distance:
+        prob, hdr = hp.read_map(flatten_file_path, field=0, partial=False, h=True,
+                                memmap=True)
 
+    prob = np.where(prob == hp.UNSEEN, 0., prob)
+    if distmu is not None:
+        distmu, distsigma, distnorm = [np.where(x == hp.UNSEEN, np.nan, x)
+                                       for x in [distmu, distsigma, distnorm]]
     return (prob, distmu, distsigma, distnorm), hdr
 
 
-def in_skymap(skymap_prob: np.ndarray,
-              ra_obj: list | np.ndarray,
-              dec_obj: list | np.ndarray,
-              probability: float = 0.9):
-    # sortinds = np.argsort(skymap_prob)
-    # skymap_prob = skymap_prob[sortinds]
-    # cumprob = np.cumsum(skymap_prob)
-    #
-    # top_indices = sortinds[cumprob > 1 - probability]
-    # pix = hp.ang2pix(nside, ra_obj, dec_obj, lonlat=True)
-    # return pix in top_indices
-    npix = len(skymap_prob)
-    nside = hp.npix2nside(npix)
-    ipix = hp.ang2pix(nside, ra_obj, dec_obj, lonlat=True)
-    credible_levels = find_greedy_credible_levels(skymap_prob)
-    return credible_levels[ipix] <= probability
+def get_moc_credible_levels(uniq: np.ndarray, prob_density: np.ndarray):
+    """Greedy credible levels of the pixels of a multi-order (MOC) skymap,
+    ranked by probability density"""
+    prob = prob_density * uniq2pixarea(uniq)
+    return find_greedy_credible_levels(prob, prob_density)
+
+
+def get_moc_first_pixels(uniq: np.ndarray, max_order: int = max_healpix_order):
+    """Nested index at max_order of the first pixel inside each multi-order pixel"""
+    order, ipix = uniq2nest(uniq)
+    return ipix.astype(np.int64) << (2 * (max_order - order)).astype(np.int64)
+
+
+def get_moc_pixel_indices(uniq: np.ndarray,
+                          ra_obj: list | np.ndarray,
+                          dec_obj: list | np.ndarray):
+    """
+    Indices of the multi-order pixels containing each of the objects. Each object is
+    located by its nested pixel index at the highest order of the map, and found by
+    a sorted search among the first max-order pixel of every multi-order pixel, so
+    that the map is never expanded.
+    """
+    max_order = np.max(uniq2nest(uniq)[0])
+    first_ipix = get_moc_first_pixels(uniq, max_order=max_order)
+    sortinds = np.argsort(first_ipix)
+    obj_ipix = hp.ang2pix(2 ** int(max_order), ra_obj, dec_obj, nest=True,
+                          lonlat=True)
+    inds = np.searchsorted(first_ipix[sortinds], obj_ipix, side='right') - 1
+    return sortinds[inds]
+
+
+def ranges_to_pixels(starts: np.ndarray, ends: np.ndarray, order: int):
+    """
+    Unique nested pixels at the given order covering the ranges [start, end) of
+    nested pixels at max_healpix_order. A pixel partially covered by a range is
+    included, so the result is a superset of the ranges.
+    """
+    shift = 2 * (max_healpix_order - order)
+    first = np.asarray(starts, dtype=np.int64) >> shift
+    last = (np.asarray(ends, dtype=np.int64) - 1) >> shift
+    counts = last - first + 1
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.unique(np.repeat(first, counts) + offsets)
+
+
+def ranges_to_uniq(starts: np.ndarray, ends: np.ndarray, order: int):
+    """
+    The fewest multi-order (UNIQ) pixels covering exactly the ranges [start, end) of
+    nested pixels at the given order : each range is cut into the largest aligned
+    blocks of 4 ** n pixels, which are pixels at order - n.
+    """
+    uniq = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        while start < end:
+            level = 0
+            while (level < order) and (start % 4 ** (level + 1) == 0) \
+                    and (start + 4 ** (level + 1) <= end):
+                level += 1
+            uniq.append((start >> (2 * level)) + 4 ** (order - level + 1))
+            start += 4 ** level
+    return np.array(uniq, dtype=np.int64)
+
+
+def write_region_skymap(ipix: np.ndarray,
+                        order: int,
+                        savepath: str | Path,
+                        extra_header: list = None):
+    """
+    Write a multi-order (MOC) skymap whose credible region at the returned
+    cumulative probability is exactly the given nested pixels at order, so that a
+    sky region can be queried as a skymap. The region and the rest of the sky are
+    each stored as the fewest multi-order pixels, so the file stays small at high
+    orders. The region has twice the probability density of the rest of the sky,
+    and the cumulative probability falls half a pixel (at order) beyond the region.
+    """
+    npix = hp.order2npix(order)
+    ipix = np.unique(np.asarray(ipix, dtype=np.int64))
+    region = np.zeros(npix + 2, dtype=bool)
+    region[ipix + 1] = True
+    # Ranges of consecutive pixels of the region, and of the rest of the sky
+    boundaries = np.flatnonzero(np.diff(region)).reshape(-1, 2)
+    outside = np.concatenate([[0], boundaries.ravel(), [npix]]).reshape(-1, 2)
+    region_uniq = ranges_to_uniq(boundaries[:, 0], boundaries[:, 1], order)
+    outside_uniq = ranges_to_uniq(outside[:, 0], outside[:, 1], order)
+
+    n_region = len(ipix)
+    n_outside = npix - n_region
+    region_prob = 2 * n_region / (npix + n_region)
+    region_density = region_prob / (n_region * hp.nside2pixarea(2 ** order))
+    if n_outside == 0:
+        outside_density = 0.
+        query_cumprob = 1.
+    else:
+        outside_density = (1 - region_prob) / (n_outside * hp.nside2pixarea(2 ** order))
+        query_cumprob = region_prob + 0.5 * (1 - region_prob) / n_outside
+
+    uniq = np.concatenate([region_uniq, outside_uniq])
+    prob_density = np.concatenate([np.full(len(region_uniq), region_density),
+                                   np.full(len(outside_uniq), outside_density)])
+    sortinds = np.argsort(uniq)
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='UNIQ', format='K', array=uniq[sortinds]),
+        fits.Column(name='PROBDENSITY', format='D', unit='sr-1',
+                    array=prob_density[sortinds])])
+    for key, value in [('PIXTYPE', 'HEALPIX'), ('ORDERING', 'NUNIQ'),
+                       ('COORDSYS', 'C'), ('MOCORDER', order),
+                       ('INDXSCHM', 'EXPLICIT')] + list(extra_header or []):
+        hdu.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(savepath, overwrite=True)
+    return query_cumprob
+
+
+def get_event_header_cards(skymap_path: str | Path):
+    """Header cards identifying the event, to copy to derived skymaps"""
+    header = read_skymap_header(skymap_path)
+    return [(key, header[key]) for key in ['OBJECT', 'DATE-OBS', 'MJD-OBS']
+            if key in header]
+
+
+def write_coarsened_skymap(skymap_path: str | Path,
+                           cumprob: float,
+                           savepath: str | Path,
+                           max_cells: int = 4096,
+                           max_order: int = 9):
+    """
+    Write a conservatively coarsened version of the cumprob credible region of a
+    skymap : the pixels covering the region at the highest order (up to max_order)
+    with at most max_cells of them, a superset of the region. Returns the
+    cumulative probability with which to query the coarsened skymap, its order,
+    and the areas in sq. deg. of the exact and coarsened regions.
+    """
+    starts, ends = Skymap(skymap_path).get_credible_region_ranges(cumprob)
+    order = max_order
+    ipix = ranges_to_pixels(starts, ends, order=order)
+    while (len(ipix) > max_cells) & (order > 0):
+        order -= 1
+        ipix = np.unique(ipix >> 2)
+
+    exact_area = np.sum(ends - starts) * hp.nside2pixarea(2 ** max_healpix_order,
+                                                          degrees=True)
+    coarsened_area = len(ipix) * hp.nside2pixarea(2 ** order, degrees=True)
+    query_cumprob = write_region_skymap(ipix, order=order, savepath=savepath,
+                                        extra_header=get_event_header_cards(
+                                            skymap_path))
+    return query_cumprob, order, exact_area, coarsened_area
+
+
+def write_union_skymap(skymap_paths: list[str | Path],
+                       cumprob: float,
+                       savepath: str | Path,
+                       order: int = 9):
+    """
+    Write a skymap covering the union of the cumprob credible regions of several
+    skymaps, coarsened to the given order (a superset of the union). Returns the
+    cumulative probability with which to query the union skymap.
+    """
+    union_ipix = []
+    for skymap_path in skymap_paths:
+        starts, ends = Skymap(skymap_path).get_credible_region_ranges(cumprob)
+        union_ipix.append(ranges_to_pixels(starts, ends, order=order))
+    union_ipix = np.unique(np.concatenate(union_ipix))
+
+    extra_header = get_event_header_cards(skymap_paths[0])
+    print(f"Union of {len(skymap_paths)} credible regions covers "
+          f"{len(union_ipix) * hp.nside2pixarea(2 ** order, degrees=True):.1f} sq. deg.")
+    return write_region_skymap(union_ipix, order=order, savepath=savepath,
+                               extra_header=extra_header)
 
 
 def get_mjd_from_skymap(skymap_path):
-    try:
-        _, _, _, _, header = read_lvc_skymap_fits(skymap_path)
-    except KeyError as err:
-        print(f"Could not read skymap with LVC reader, trying with Fermi - {err}")
-        try:
-            _, _, header = read_fermi_skymap_fits(skymap_path)
-        except KeyError as exc:
-            print(f"Skymap could not be read by LVC or Fermi - {exc}")
-            raise exc
+    header = read_skymap_header(skymap_path)
 
     if 'MJD-OBS' in header:
         mjd_event = header['MJD-OBS']
@@ -115,3 +308,201 @@ def get_mjd_from_skymap(skymap_path):
               "commandline using -date_event. e.g. 2023-04-04T22:30:00"
         raise KeyError(err)
     return mjd_event
+
+
+class Skymap:
+    """
+    Credible levels of a skymap, computed once per skymap file and cached as float32
+    .npy files named by the hash of the file, which are memory-mapped on later use.
+    contains() then answers for any cumulative probability without sorting the map
+    again. The files are cached in cache_dir, by default the SKYMAP_CACHE_DIR
+    environment variable if it is set, or the directory of the skymap.
+    For multi-order maps, the credible levels are stored sorted by the first
+    max-order pixel of each multi-order pixel, along with those pixels, so that
+    objects are located by a sorted search.
+    """
+
+    def __init__(self, skymap_path: str | Path, cache: bool = True,
+                 cache_dir: str | Path = None):
+        self.path = str(skymap_path)
+        self.cache = cache
+        if cache_dir is None:
+            cache_dir = os.getenv('SKYMAP_CACHE_DIR',
+                                  os.path.dirname(os.path.abspath(self.path)))
+        self.cache_dir = str(cache_dir)
+        self._file_hash = None
+        self._header = None
+        self._credible_levels = None
+        self._first_ipix = None
+
+    @property
+    def file_hash(self):
+        if self._file_hash is None:
+            self._file_hash = get_file_hash(self.path)
+        return self._file_hash
+
+    @property
+    def header(self):
+        """Header of the skymap table, read without touching the data"""
+        if self._header is None:
+            self._header = read_skymap_header(self.path)
+        return self._header
+
+    def read_columns(self, columns: list[str | int]):
+        """Read only the requested columns of the skymap"""
+        column_data, _ = read_skymap_columns(self.path, columns)
+        return column_data
+
+    def get_cache_path(self, name: str):
+        return os.path.join(self.cache_dir, f"{os.path.basename(self.path)}."
+                                            f"{self.file_hash[:16]}.{name}.npy")
+
+    def _save_cached(self, name: str, values: np.ndarray):
+        """
+        Save values to the cache through a temporary file that replaces the cache
+        file at once, so that concurrent runs never load a partially written file.
+        The files cached for earlier versions of the skymap file are removed.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.get_cache_path(name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.npy.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, values)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        basename = os.path.basename(self.path)
+        stale_pattern = re.compile(rf"{re.escape(basename)}\.[0-9a-f]{{16}}\."
+                                   rf"{re.escape(name)}\.npy")
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if stale_pattern.fullmatch(filename) and (path != cache_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _load_cached(self):
+        credible_levels_path = self.get_cache_path('credible_levels')
+        first_ipix_path = self.get_cache_path('first_ipix')
+        if not os.path.exists(credible_levels_path):
+            return False
+        self._credible_levels = np.load(credible_levels_path, mmap_mode='r')
+        if os.path.exists(first_ipix_path):
+            self._first_ipix = np.load(first_ipix_path, mmap_mode='r')
+        return True
+
+    def _compute(self):
+        try:
+            uniq, prob_density, _ = read_fermi_skymap_fits(self.path)
+        except KeyError:
+            uniq = None
+
+        if uniq is not None:
+            credible_levels = get_moc_credible_levels(uniq, prob_density)
+            first_ipix = get_moc_first_pixels(uniq)
+            sortinds = np.argsort(first_ipix)
+            self._credible_levels = credible_levels[sortinds].astype(np.float32)
+            self._first_ipix = first_ipix[sortinds]
+        else:
+            try:
+                (skymap_prob, _, _, _), _ = read_flattened_skymap(self.path)
+            except:
+                flattened_filepath = get_flattened_skymap_path(self.path)
+                if not os.path.exists(flattened_filepath):
+                    flatten_skymap(self.path, flattened_filepath)
+                (skymap_prob, _, _, _), _ = read_flattened_skymap(flattened_filepath)
+            self._credible_levels = \
+                find_greedy_credible_levels(skymap_prob).astype(np.float32)
+
+        if self.cache:
+            try:
+                # The first pixels are saved first, as the credible levels file marks
+                # a complete cache
+                if self._first_ipix is not None:
+                    self._save_cached('first_ipix', self._first_ipix)
+                self._save_cached('credible_levels', self._credible_levels)
+            except OSError as err:
+                print(f"Could not cache credible levels of {self.path} in "
+                      f"{self.cache_dir} - {err}")
+
+    @property
+    def credible_levels(self):
+        if self._credible_levels is None:
+            if not (self.cache and self._load_cached()):
+                self._compute()
+        return self._credible_levels
+
+    @property
+    def is_moc(self):
+        _ = self.credible_levels
+        return self._first_ipix is not None
+
+    def get_credible_levels(self,
+                            ra_obj: list | np.ndarray,
+                            dec_obj: list | np.ndarray):
+        """Credible level of the skymap at each of the positions"""
+        credible_levels = self.credible_levels
+        if self.is_moc:
+            obj_ipix = hp.ang2pix(2 ** max_healpix_order, ra_obj, dec_obj, nest=True,
+                                  lonlat=True)
+            inds = np.searchsorted(self._first_ipix, obj_ipix, side='right') - 1
+        else:
+            nside = hp.npix2nside(len(credible_levels))
+            inds = hp.ang2pix(nside, ra_obj, dec_obj, lonlat=True)
+        return np.asarray(credible_levels[inds], dtype=float)
+
+    def get_distance_parameters(self,
+                                ra_obj: list | np.ndarray,
+                                dec_obj: list | np.ndarray):
+        """
+        Probability density per steradian and distance ansatz parameters (distmu,
+        distsigma, distnorm) of the skymap at each of the positions. The distance
+        parameters are NaN if the map has no distance information.
+        """
+        try:
+            uniq, prob_density, distmu, distsigma, distnorm = self.read_columns(
+                ['UNIQ', 'PROBDENSITY', 'DISTMU', 'DISTSIGMA', 'DISTNORM'])
+            inds = get_moc_pixel_indices(uniq, ra_obj, dec_obj)
+        except KeyError:
+            if self.is_moc:
+                uniq, prob_density = self.read_columns(['UNIQ', 'PROBDENSITY'])
+                inds = get_moc_pixel_indices(uniq, ra_obj, dec_obj)
+                distmu = distsigma = distnorm = np.full(len(uniq), np.nan)
+            else:
+                (prob, distmu, distsigma, distnorm), _ = read_flattened_skymap(
+                    self.path, read_distance=True)
+                nside = hp.npix2nside(len(prob))
+                prob_density = prob / hp.nside2pixarea(nside)
+                inds = hp.ang2pix(nside, ra_obj, dec_obj, lonlat=True)
+                if distmu is None:
+                    distmu = distsigma = distnorm = np.full(len(prob), np.nan)
+        return prob_density[inds], distmu[inds], distsigma[inds], distnorm[inds]
+
+    def get_credible_region_ranges(self, cumprob: float = 0.9):
+        """
+        The cumprob credible region, as ranges [start, end) of nested pixels at
+        max_healpix_order
+        """
+        credible_levels = np.asarray(self.credible_levels)
+        if self.is_moc:
+            starts = np.asarray(self._first_ipix)
+            ends = np.append(starts[1:], hp.order2npix(max_healpix_order))
+        else:
+            nside = hp.npix2nside(len(credible_levels))
+            shift = 2 * (max_healpix_order - hp.nside2order(nside))
+            nest_ipix = hp.ring2nest(nside, np.arange(len(credible_levels)))
+            starts = nest_ipix.astype(np.int64) << shift
+            ends = (nest_ipix.astype(np.int64) + 1) << shift
+        in_region = credible_levels <= cumprob
+        return starts[in_region], ends[in_region]
+
+    def contains(self,
+                 ra_obj: list | np.ndarray,
+                 dec_obj: list | np.ndarray,
+                 cumprob: float = 0.9):
+        """Whether each of the positions is inside the cumprob credible region"""
+        return self.get_credible_levels(ra_obj, dec_obj) <= cumprob
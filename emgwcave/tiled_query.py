@@ -0,0 +1,299 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import healpy as hp
+import numpy as np
+import pandas as pd
+import requests
+
+from emgwcave.skymap_utils import Skymap, ranges_to_pixels, write_region_skymap
+
+timeout_messages = ['max_time_ms', 'maxtimemsexpired', 'exceeded time limit',
+                    'timed out']
+
+
+def is_timeout(error: Exception | str | None):
+    """Whether a query failed because it ran out of time (and may succeed on a
+    smaller tile), rather than e.g. a bad token, a network outage or a malformed
+    query"""
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # Including connect timeouts, the server can not be reached at all
+        return False
+    if isinstance(error, (TimeoutError, requests.exceptions.Timeout)):
+        return True
+    message = str(error).lower() if error is not None else ''
+    return any(timeout_message in message for timeout_message in timeout_messages)
+
+
+class QueryTile:
+    """
+    A part of the credible region, as nested pixels at a HEALPix order, and a jd
+    window, queried with a single query_skymap call. The jd window excludes its
+    start, and excludes its end unless include_jd_end is True.
+    """
+
+    def __init__(self,
+                 tile_id: str,
+                 ipix: np.ndarray,
+                 order: int,
+                 jd_start: float,
+                 jd_end: float,
+                 include_jd_end: bool = False,
+                 depth: int = 0):
+        self.tile_id = tile_id
+        self.depth = depth
+        self.ipix = np.asarray(ipix, dtype=np.int64)
+        self.order = order
+        self.jd_start = jd_start
+        self.jd_end = jd_end
+        self.include_jd_end = include_jd_end
+
+    @property
+    def query_jd_end(self):
+        """End of the jd window to query, as query_skymap excludes it"""
+        if self.include_jd_end:
+            return float(np.nextafter(self.jd_end, np.inf))
+        return self.jd_end
+
+    @property
+    def area(self):
+        """Area of the tile in sq. deg."""
+        return len(self.ipix) * hp.nside2pixarea(2 ** self.order, degrees=True)
+
+    def split(self, max_order: int = 10, min_jd_window: float = 0.5):
+        """
+        Split an oversized tile in two : into two halves of its pixels, into its
+        child pixels at the next order if it is a single pixel, or into two halves
+        of its jd window if it can not be split further on the sky. Alerts exactly
+        at the middle of the jd window go to the first half. Returns an empty list if
+        the tile can not be split at all.
+        """
+        window = (self.jd_start, self.jd_end, self.include_jd_end)
+        if len(self.ipix) > 1:
+            half = len(self.ipix) // 2
+            parts = [(self.ipix[:half], self.order, *window),
+                     (self.ipix[half:], self.order, *window)]
+        elif self.order < max_order:
+            children = 4 * self.ipix[0] + np.arange(4)
+            parts = [(children[:2], self.order + 1, *window),
+                     (children[2:], self.order + 1, *window)]
+        elif self.jd_end - self.jd_start > min_jd_window:
+            jd_mid = (self.jd_start + self.jd_end) / 2
+            parts = [(self.ipix, self.order, self.jd_start, jd_mid, True),
+                     (self.ipix, self.order, jd_mid, self.jd_end,
+                      self.include_jd_end)]
+        else:
+            return []
+        return [QueryTile(f'{self.tile_id}.{ind}', *part, depth=self.depth + 1)
+                for ind, part in enumerate(parts)]
+
+
+def plan_query_tiles(skymap_path: str | Path,
+                     cumprob: float,
+                     jd_start: float,
+                     jd_end: float,
+                     n_tiles: int,
+                     order: int = 8,
+                     max_order: int = 10):
+    """
+    Split the cumprob credible region of a skymap into n_tiles tiles of equal
+    area. The region is covered with nested pixels at the given order (raised up to
+    max_order until there are at least n_tiles pixels), which are split into
+    contiguous runs of equal length, so that each tile is a compact patch of sky.
+    """
+    starts, ends = Skymap(skymap_path).get_credible_region_ranges(cumprob)
+    ipix = ranges_to_pixels(starts, ends, order=order)
+    while (len(ipix) < n_tiles) & (order < max_order):
+        order += 1
+        ipix = ranges_to_pixels(starts, ends, order=order)
+
+    tiles = [QueryTile(str(ind), tile_ipix, order, jd_start, jd_end)
+             for ind, tile_ipix in enumerate(np.array_split(ipix,
+                                                            min(n_tiles, len(ipix))))]
+    return tiles
+
+
+def search_in_skymap_tiled(k,
+                           skymap_path: str | Path,
+                           cumprob: float,
+                           jd_start: float,
+                           jd_end: float,
+                           jdstarthist_start: float,
+                           jdstarthist_end: float,
+                           n_workers: int = 8,
+                           n_tiles: int = None,
+                           catalogs: list = ['ZTF_alerts'],
+                           filter_kwargs: dict = {},
+                           projection_kwargs: dict = {},
+                           order: int = 8,
+                           max_order: int = 10,
+                           min_jd_window: float = 0.5,
+                           max_split_depth: int = 16,
+                           timings_path: str | Path = None):
+    """
+    Query the credible region of a skymap as many small, equal-area tiles instead
+    of a single query_skymap call. The tiles are put on a shared queue from which
+    n_workers threads take the next tile as soon as they are done with the previous
+    one, so that no worker sits idle while others are stuck on large tiles. A tile
+    whose query times out (e.g. hits max_time_ms) is split further (see
+    QueryTile.split) and its parts are put back on the queue, at most
+    max_split_depth times from each initial tile. Any other error (e.g. a bad
+    token or a network outage) is not retried, and is raised once all tiles are
+    done.
+    As the tiles are coarsened to whole pixels, the union of the tiles is a
+    superset of the credible region, alerts outside it are removed by the later
+    localization check.
+
+    :param k: Kowalski client
+    :param n_workers: number of tiles queried concurrently
+    :param n_tiles: number of tiles to start with, defaults to 4 per worker
+    :param order: HEALPix order of the tiles
+    :param max_order: highest HEALPix order to split tiles to
+    :param min_jd_window: shortest jd window to split tiles to
+    :param max_split_depth: number of times a tile and its parts can be split
+    :param timings_path: if given, the per-tile timings are written to this csv
+    :return: results in the same format as query_skymap
+    """
+    if n_tiles is None:
+        n_tiles = 4 * n_workers
+
+    tile_queue = queue.Queue()
+    for tile in plan_query_tiles(skymap_path, cumprob, jd_start, jd_end,
+                                 n_tiles=n_tiles, order=order, max_order=max_order):
+        tile_queue.put(tile)
+
+    alerts = {catalog: {} for catalog in catalogs}
+    timings = []
+    failed_tiles = []
+    worker_errors = []
+    lock = threading.Lock()
+    tiles_dir = tempfile.mkdtemp(prefix='emgwcave_tiles_')
+
+    def query_tile(tile: QueryTile):
+        tile_path = os.path.join(tiles_dir, f'tile_{tile.tile_id}.fits')
+        try:
+            tile_cumprob = write_region_skymap(tile.ipix, order=tile.order,
+                                               savepath=tile_path)
+            response = k.query_skymap(path=tile_path,
+                                      cumprob=tile_cumprob,
+                                      jd_start=tile.jd_start,
+                                      jd_end=tile.query_jd_end,
+                                      jdstarthist_start=jdstarthist_start,
+                                      jdstarthist_end=jdstarthist_end,
+                                      catalogs=catalogs,
+                                      program_ids=[1, 2, 3],
+                                      filter_kwargs=filter_kwargs,
+                                      projection_kwargs=projection_kwargs,
+                                      max_n_threads=1)['default']
+            missing_catalogs = [catalog for catalog in catalogs
+                                if not isinstance(response.get(catalog), list)]
+            if len(missing_catalogs) > 0:
+                err = f"No results for {missing_catalogs} in tile {tile.tile_id} : " \
+                      f"{response.get('message')}"
+                if not is_timeout(response.get('message')):
+                    raise ValueError(err)
+                return None, err
+            return response, None
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            return None, str(e)
+        finally:
+            if os.path.exists(tile_path):
+                os.remove(tile_path)
+
+    def worker(worker_id: int):
+        while True:
+            tile = tile_queue.get()
+            try:
+                if tile is None:
+                    return
+                process_tile(tile, worker_id)
+            except Exception as e:
+                with lock:
+                    worker_errors.append(e)
+            finally:
+                # Always mark the tile done, so that the queue can be joined
+                tile_queue.task_done()
+
+    def process_tile(tile: QueryTile, worker_id: int):
+        t0 = time.perf_counter()
+        response, error = query_tile(tile)
+        duration = time.perf_counter() - t0
+
+        n_alerts = 0
+        if error is None:
+            with lock:
+                for catalog in catalogs:
+                    n_alerts += len(response[catalog])
+                    for alert in response[catalog]:
+                        alerts[catalog][alert.get('candid', id(alert))] = alert
+        else:
+            sub_tiles = []
+            if tile.depth < max_split_depth:
+                sub_tiles = tile.split(max_order=max_order,
+                                       min_jd_window=min_jd_window)
+            print(f"Query of tile {tile.tile_id} ({tile.area:.2f} sq. deg.) "
+                  f"failed, splitting it in {len(sub_tiles)} : {error}")
+            for sub_tile in sub_tiles:
+                tile_queue.put(sub_tile)
+            if len(sub_tiles) == 0:
+                with lock:
+                    failed_tiles.append(tile)
+
+        with lock:
+            timings.append({'tile_id': tile.tile_id,
+                            'worker': worker_id,
+                            'order': tile.order,
+                            'n_pixels': len(tile.ipix),
+                            'area_deg2': tile.area,
+                            'jd_start': tile.jd_start,
+                            'jd_end': tile.jd_end,
+                            'status': 'success' if error is None else 'failed',
+                            'n_alerts': n_alerts,
+                            'duration_s': duration})
+
+    t_start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(worker_id,), daemon=True)
+               for worker_id in range(n_workers)]
+    for thread in workers:
+        thread.start()
+    try:
+        # Failed tiles put their parts back on the queue before being marked done,
+        # so the queue is only drained once all tiles and their parts are done
+        tile_queue.join()
+    finally:
+        for _ in workers:
+            tile_queue.put(None)
+        for thread in workers:
+            thread.join()
+        shutil.rmtree(tiles_dir, ignore_errors=True)
+    total_duration = time.perf_counter() - t_start
+
+    if len(worker_errors) > 0:
+        print(f"{len(worker_errors)} tiles could not be processed : {worker_errors}")
+        raise worker_errors[0]
+
+    timings = pd.DataFrame(timings)
+    if timings_path is not None:
+        timings.to_csv(timings_path, index=False)
+    n_retried = int(np.sum(timings['status'] == 'failed'))
+    print(f"Queried {len(timings) - n_retried} tiles ({n_retried} split and retried) "
+          f"with {n_workers} workers in {total_duration:.1f} s, "
+          f"{timings['duration_s'].sum() / max(total_duration, 1e-9):.1f} "
+          f"tile-seconds per second")
+
+    if len(failed_tiles) > 0:
+        err = f"Queries of tiles {[tile.tile_id for tile in failed_tiles]} failed " \
+              f"even at the smallest tile size and jd window, or after " \
+              f"{max_split_depth} splits"
+        print(err)
+        raise ValueError(err)
+
+    return {'default': {catalog: list(alerts[catalog].values())
+                        for catalog in catalogs}}
@@ -34,6 +34,9 @@ setuptools.setup(
         "typing",
         "ligo.skymap"
     ],
+    extras_require={
+        "parquet": ["pyarrow"],
+    },
     package_data={
     }
 )
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Without kowalski credentials, run the tests offline against a cassette of synthetic
+kowalski responses, written by python tests/synthetic_kowalski.py. Offline, the
+pipeline tests (test_lvc_candidates, test_grb_candidates, test_offline_pipeline)
+are smoke tests of the pipeline on synthetic alerts, they do not check the
+results of real queries. To record a cassette of live responses instead, run the
+tests with live credentials and
+KOWALSKI_CASSETTE=<cassette.json.gz> KOWALSKI_CASSETTE_MODE=record
+The credible levels of the skymaps are cached in a temporary directory rather than
+next to the skymaps in data/skymaps.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+cassette_path = 'data/cassettes/synthetic_responses.json.gz'
+
+if os.getenv('SKYMAP_CACHE_DIR') is None:
+    skymap_cache_dir = tempfile.mkdtemp(prefix='emgwcave_skymap_cache_')
+    atexit.register(shutil.rmtree, skymap_cache_dir, ignore_errors=True)
+    os.environ['SKYMAP_CACHE_DIR'] = skymap_cache_dir
+
+if (os.getenv('KOWALSKI_TOKEN') is None) & (os.getenv('KOWALSKI_CASSETTE') is None) \
+        & os.path.exists(cassette_path):
+    os.environ['KOWALSKI_CASSETTE'] = cassette_path
+    os.environ['KOWALSKI_CASSETTE_MODE'] = 'replay'
@@ -0,0 +1,329 @@
+"""
+An in-process stand-in for kowalski, serving synthetic alerts. Its responses
+follow the structure of kowalski responses, but the alerts are made up. The
+offline tests replay a cassette of its responses : run this file from the
+repository root to write the cassette again,
+
+python tests/synthetic_kowalski.py
+"""
+
+import copy
+import gzip
+import io
+import operator
+import os
+import sys
+import unittest
+import numpy as np
+from astropy.io import fits
+from emgwcave.skymap_utils import Skymap
+from emgwcave.kowalski_utils import get_alert_window_filter
+
+cassette_path = 'data/cassettes/synthetic_responses.json.gz'
+
+comparison_operators = {'$gt': operator.gt, '$gte': operator.ge,
+                        '$lt': operator.lt, '$lte': operator.le}
+
+
+def get_value(document, path):
+    value = document
+    for key in path.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def has_field(document, path):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        document = document.get(key) if isinstance(document, dict) else None
+    return isinstance(document, dict) and keys[-1] in document
+
+
+def evaluate_expression(document, expression):
+    """Evaluate the $expr operators used in the alert filters. Arithmetic on a
+    missing or null value gives null, and, as in mongo aggregation expressions,
+    comparisons sort null below every number."""
+    if isinstance(expression, str) and expression.startswith('$'):
+        return get_value(document, expression[1:])
+    if not isinstance(expression, dict):
+        return expression
+    (name, arguments), = expression.items()
+    values = [evaluate_expression(document, argument) for argument in arguments]
+    if name == '$subtract':
+        if any(value is None for value in values):
+            return None
+        return values[0] - values[1]
+    sort_keys = [(0, 0) if value is None else (1, value) for value in values]
+    return comparison_operators[name](sort_keys[0], sort_keys[1])
+
+
+def matches_filter(document, mongo_filter):
+    """
+    Evaluate a mongo filter on a document, with the operators used in the alert
+    filters. As in mongo, comparisons to a missing or null value are False.
+    """
+    for key, condition in mongo_filter.items():
+        if key == '$and':
+            matched = all(matches_filter(document, c) for c in condition)
+        elif key == '$or':
+            matched = any(matches_filter(document, c) for c in condition)
+        elif key == '$expr':
+            matched = bool(evaluate_expression(document, condition))
+        elif isinstance(condition, dict):
+            value = get_value(document, key)
+            matched = True
+            for name, operand in condition.items():
+                if name == '$exists':
+                    matched &= has_field(document, key) == operand
+                elif name == '$in':
+                    matched &= value in operand
+                elif name == '$nin':
+                    matched &= value not in operand
+                elif name == '$ne':
+                    matched &= value != operand
+                else:
+                    matched &= (value is not None) \
+                        and comparison_operators[name](value, operand)
+        else:
+            matched = get_value(document, key) == condition
+        if not matched:
+            return False
+    return True
+
+
+def project_path(source, target, keys):
+    key, rest = keys[0], keys[1:]
+    if key not in source:
+        return
+    value = source[key]
+    if len(rest) == 0:
+        target[key] = copy.deepcopy(value)
+    elif isinstance(value, list):
+        items = target.setdefault(key, [{} for _ in value])
+        for item, target_item in zip(value, items):
+            if isinstance(item, dict):
+                project_path(item, target_item, rest)
+    elif isinstance(value, dict):
+        project_path(value, target.setdefault(key, {}), rest)
+
+
+def project(document, projection):
+    """Apply a mongo inclusion or exclusion projection to a document"""
+    if not projection:
+        return copy.deepcopy(document)
+    if all(value == 0 for value in projection.values()):
+        return {key: copy.deepcopy(value) for key, value in document.items()
+                if key not in projection}
+    projected = {'_id': document['_id']} \
+        if ('_id' in document) and (projection.get('_id', 1) != 0) else {}
+    for path, value in projection.items():
+        if value != 0:
+            project_path(document, projected, path.split('.'))
+    return projected
+
+
+def run_pipeline(documents, pipeline):
+    """Run the aggregation stages used by the latest-alert pipelines"""
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == '$match':
+            documents = [d for d in documents if matches_filter(d, spec)]
+        elif name == '$project':
+            documents = [project(d, spec) for d in documents]
+        elif name == '$sort':
+            for path, direction in reversed(list(spec.items())):
+                documents = sorted(documents, key=lambda d: get_value(d, path),
+                                   reverse=direction < 0)
+        elif name == '$group':
+            # Only the $first accumulator, of a field or of the whole document
+            (field, accumulator), = [(f, a) for f, a in spec.items() if f != '_id']
+            groups = {}
+            for document in documents:
+                group = get_value(document, spec['_id'][1:])
+                if group not in groups:
+                    groups[group] = {'_id': group,
+                                     field: document
+                                     if accumulator['$first'] == '$$ROOT'
+                                     else get_value(document,
+                                                    accumulator['$first'][1:])}
+            documents = list(groups.values())
+        elif name == '$replaceRoot':
+            documents = [d[spec['newRoot'][1:]] for d in documents]
+        elif name == '$limit':
+            documents = documents[:spec]
+        else:
+            raise ValueError(f"Unsupported aggregation stage {name}")
+    return documents
+
+
+class SyntheticKowalski:
+    """Answers the queries of the pipeline like kowalski would, from synthetic
+    alerts and aux documents"""
+
+    def __init__(self, alerts: list[dict], aux: dict):
+        self.alerts = alerts
+        self.aux = aux
+        self.instances = {}
+        self.n_queries = 0
+
+    def ping(self):
+        return True
+
+    def query_skymap(self, path, cumprob, jd_start, jd_end, jdstarthist_start,
+                     jdstarthist_end, catalogs=['ZTF_alerts'],
+                     program_ids=[1, 2, 3], filter_kwargs={}, projection_kwargs={},
+                     **kwargs):
+        self.n_queries += 1
+        window_filter = get_alert_window_filter(
+            jd_start=jd_start, jd_end=jd_end, jdstarthist_start=jdstarthist_start,
+            jdstarthist_end=jdstarthist_end, program_ids=program_ids,
+            filter_kwargs=filter_kwargs)
+        alerts = [alert for alert in self.alerts
+                  if matches_filter(alert, window_filter)]
+        if len(alerts) > 0:
+            inside = Skymap(path, cache=False).contains(
+                np.array([alert['candidate']['ra'] for alert in alerts]),
+                np.array([alert['candidate']['dec'] for alert in alerts]), cumprob)
+            alerts = [alert for alert, is_inside in zip(alerts, inside) if is_inside]
+        projection = {'objectId': 1, 'candid': 1, 'candidate.ra': 1,
+                      'candidate.dec': 1, **projection_kwargs} \
+            if len(projection_kwargs) > 0 else {}
+        return {'default': {catalog: [project(alert, projection) for alert in alerts]
+                            for catalog in catalogs}}
+
+    def query(self, query=None):
+        self.n_queries += 1
+        query_type, q = query['query_type'], query['query']
+        if query_type == 'find':
+            documents = list(self.aux.values()) if q['catalog'].endswith('_aux') \
+                else self.alerts
+            data = [project(document, q.get('projection', {}))
+                    for document in documents
+                    if matches_filter(document, q['filter'])]
+        elif query_type == 'aggregate':
+            data = run_pipeline(self.alerts, q['pipeline'])
+        elif query_type == 'cone_search':
+            data = {catalog: {name: [] for name in q['object_coordinates']['radec']}
+                    for catalog in q['catalogs']}
+        else:
+            raise ValueError(f"Unsupported query type {query_type}")
+        return {'default': {'status': 'success', 'message': 'Successfully executed '
+                            'query', 'data': data}}
+
+
+def get_stamp(rng):
+    """A gzipped fits cutout, of a point source on a noisy background"""
+    y, x = np.mgrid[:63, :63]
+    data = 100 * np.exp(-((x - 31) ** 2 + (y - 31) ** 2) / 8.) \
+        + np.round(rng.normal(size=(63, 63)))
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data.astype(np.float32)).writeto(buffer)
+    return {'stampData': gzip.compress(buffer.getvalue())}
+
+
+def get_positions_in_skymap(skymap_path, n_positions, rng, cumprob=0.5):
+    skymap = Skymap(skymap_path, cache=False)
+    ras = rng.uniform(0, 360, 50000)
+    decs = np.degrees(np.arcsin(rng.uniform(-1, 1, 50000)))
+    inside = skymap.contains(ras, decs, cumprob)
+    return ras[inside][:n_positions], decs[inside][:n_positions]
+
+
+def make_alert(name, candid, jd, jdstarthist, ra, dec, rng, **fields):
+    """An alert passing the stage 1 cuts of the Fritz EMGW filter, unless fields
+    overrides some of them"""
+    candidate = {'jd': jd, 'jdstarthist': jdstarthist, 'ra': ra, 'dec': dec,
+                 'candid': candid, 'programid': 1, 'ndethist': 3, 'fid': 1,
+                 'isdiffpos': 't', 'drb': 0.95, 'magpsf': 19.5, 'sigmapsf': 0.1,
+                 'diffmaglim': 20.5, 'ssdistnr': -999., 'ssmagnr': -999.,
+                 'ssnamenr': None, 'distnr': -999., 'magnr': -999.,
+                 'sgmag1': -999., 'simag1': -999.}
+    for ind in [1, 2, 3]:
+        candidate.update({f'distpsnr{ind}': 25., f'sgscore{ind}': 0.1,
+                          f'srmag{ind}': 21.})
+    candidate.update(fields)
+    return {'objectId': name, 'candid': candid, 'candidate': candidate,
+            'cutoutScience': get_stamp(rng), 'cutoutTemplate': get_stamp(rng),
+            'cutoutDifference': get_stamp(rng)}
+
+
+def make_synthetic_data(skymap_path, jd_event, selected_names, seed=0,
+                        jd_offsets=(0.8, 1.2)):
+    """
+    Alerts and aux documents of objects inside the credible region of a skymap,
+    first detected shortly after jd_event. The objects named selected_names pass
+    the Fritz EMGW filter, and there is one rejected object for each of its cuts :
+    its latest alert is bogus (although an earlier one is real), an asteroid, or it
+    has no earlier detection.
+    """
+    rng = np.random.default_rng(seed)
+    rejected = {'bogus': {'drb': 0.1}, 'asteroid': {'ssdistnr': 2., 'ssmagnr': 18.},
+                'single': {}}
+    names = list(selected_names) + [f'ZTF23zz{seed}{kind}'[:12] for kind in rejected]
+    ras, decs = get_positions_in_skymap(skymap_path, len(names), rng)
+    alerts, aux = [], {}
+    candid = 2300000000000000000 + seed * 1000000
+    for ind, name in enumerate(names):
+        kind = list(rejected)[ind - len(selected_names)] \
+            if ind >= len(selected_names) else None
+        offsets = jd_offsets[-1:] if kind == 'single' else jd_offsets
+        for offset in offsets:
+            candid += 1
+            fields = rejected[kind] if (kind is not None) \
+                and (offset == jd_offsets[-1]) else {}
+            alerts.append(make_alert(name, candid, jd=jd_event + offset,
+                                     jdstarthist=jd_event + 0.3,
+                                     ra=float(ras[ind]), dec=float(decs[ind]),
+                                     rng=rng, **fields))
+
+        prv_candidates = [{'jd': jd_event - 1., 'fid': 2, 'diffmaglim': 20.,
+                           'programid': 1, 'candid': None}]
+        if kind != 'single':
+            prv_candidates.append({'jd': jd_event + 0.5, 'fid': 1, 'magpsf': 19.8,
+                                   'sigmapsf': 0.15, 'diffmaglim': 20.5,
+                                   'isdiffpos': 't', 'programid': 1,
+                                   'candid': candid + 500000})
+        prv_candidates += [{key: alert['candidate'][key] for key in
+                            ['jd', 'fid', 'magpsf', 'sigmapsf', 'diffmaglim',
+                             'isdiffpos', 'programid', 'candid']}
+                           for alert in alerts if alert['objectId'] == name]
+        # The first object is in a CLU galaxy
+        clu_galaxies = [{'z': 0.03, 'z_err': 0.001, 'name': 'CLU_synthetic',
+                         'coordinates': {'distance_arcsec': 4.2}}] if ind == 0 else []
+        aux[name] = {'_id': name, 'prv_candidates': prv_candidates,
+                     'cross_matches': {'CLU_20190625': clu_galaxies, 'AllWISE': [],
+                                       'PS1_STRM': []}}
+    return alerts, aux
+
+
+def get_synthetic_kowalski():
+    """Synthetic kowalski with the events of the offline tests, whose expected
+    candidates pass the filters"""
+    import test_lvc_candidates
+    import test_grb_candidates
+    alerts, aux = [], {}
+    for seed, test in enumerate([test_lvc_candidates, test_grb_candidates]):
+        test_alerts, test_aux = make_synthetic_data(
+            test.skymap_path, jd_event=test.mjd_event + 2400000.5,
+            selected_names=test.CANDIDATE_NAMES, seed=seed + 1)
+        alerts += test_alerts
+        aux.update(test_aux)
+    return SyntheticKowalski(alerts, aux)
+
+
+if __name__ == '__main__':
+    # Write the cassette by running the offline smoke tests against the synthetic
+    # kowalski, shared by the whole process
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from emgwcave import kowalski_utils
+    from emgwcave.cassette import RecordingKowalski
+    if os.path.exists(cassette_path):
+        os.remove(cassette_path)
+    k = RecordingKowalski(get_synthetic_kowalski(), cassette_path)
+    kowalski_utils._kowalski_sessions[os.getpid()] = k
+    tests = unittest.defaultTestLoader.loadTestsFromNames(
+        ['test_lvc_candidates', 'test_grb_candidates', 'test_offline_pipeline'])
+    result = unittest.TextTestRunner().run(tests)
+    k.save()
+    print(f"Recorded {len(k.cassette)} responses to {cassette_path}")
+    sys.exit(not result.wasSuccessful())
@@ -0,0 +1,175 @@
+"""
+Test the batched queries of the aux alerts catalog
+"""
+
+import unittest
+import os
+import tempfile
+from copy import deepcopy
+import numpy as np
+import pandas as pd
+from emgwcave.candidate_utils import append_photometry_to_candidates, \
+    get_candidates_crossmatch, annotate_candidates, append_3d_localization_scores
+from emgwcave.fritz_filter import pythonised_fritz_emgw_filter_stationary_stage
+from emgwcave.kowalski_utils import query_aux_alerts_batch, run_queries, \
+    get_prv_candidates_projection, default_prv_candidates_fields
+from emgwcave.photometry import make_photometry_table
+from emgwcave.plotting import save_thumbnails, make_full_pdf
+from emgwcave.skymap_utils import get_mjd_from_skymap
+from synthetic_kowalski import SyntheticKowalski, make_synthetic_data, project
+
+skymap_path = 'data/skymaps/2023-04-17T22-42-11_bayestar.multiorder.fits'
+jd_event = get_mjd_from_skymap(skymap_path) + 2400000.5
+CANDIDATE_NAMES = [f'ZTF23aaaaaa{letter}' for letter in 'abcde']
+
+
+class QueryLogKowalski(SyntheticKowalski):
+    """Keeps the find queries it answered"""
+
+    def __init__(self, alerts, aux):
+        super().__init__(alerts, aux)
+        self.queries = []
+
+    def query(self, query=None):
+        self.queries.append(query)
+        return super().query(query=query)
+
+
+class FailingKowalski(SyntheticKowalski):
+    def query(self, query=None):
+        return {'default': {'status': 'error', 'message': 'max_time_ms exceeded'}}
+
+
+def add_unused_fields(aux: dict):
+    """Aux documents with fields that the pipeline does not read, like the full
+    documents of kowalski, and crossmatches in every catalog"""
+    full_aux = deepcopy(aux)
+    for ind, document in enumerate(full_aux.values()):
+        for prv_candidate in document['prv_candidates']:
+            prv_candidate.update({'ra': 1., 'dec': 1., 'rb': 0.5, 'drb': 0.5,
+                                  'field': 600, 'rcid': 3, 'magzpsci': 26.,
+                                  'magpsf_unused': 30.})
+        cross_matches = document['cross_matches']
+        for galaxy in cross_matches['CLU_20190625']:
+            galaxy.update({'ra': 1., 'dec': 1., 'a': 0.3, 'b2a': 0.5})
+        cross_matches['AllWISE'] = [{'w1mpro': 15., 'w2mpro': 14.8 - 0.5 * (ind % 2),
+                                     'w3mpro': 12., 'w4mpro': 9., 'ra': 1.}]
+        cross_matches['PS1_STRM'] = [{'class': ['GALAXY', 'QSO', 'STAR'][ind % 3],
+                                      'prob_Star': 0.1, 'prob_Galaxy': 0.8,
+                                      'prob_QSO': 0.1, 'z_phot': 0.05,
+                                      'z_photErr': 0.01, 'raMean': 1.}]
+        cross_matches['Gaia_EDR3'] = [{'parallax': 1.}]
+    return full_aux
+
+
+def get_latest_alerts(alerts):
+    latest_alerts = {}
+    for alert in alerts:
+        latest_alerts[alert['objectId']] = alert
+    return list(latest_alerts.values())
+
+
+class TestAuxQueries(unittest.TestCase):
+    """Test that the aux alerts are queried in chunks"""
+
+    def setUp(self):
+        self.alerts, self.aux = make_synthetic_data(skymap_path, jd_event=jd_event,
+                                                    selected_names=CANDIDATE_NAMES)
+
+    def test_batched_photometry(self):
+        """Test that the photometry of all candidates is retrieved with one query
+        per chunk of objects, and matches the one retrieved object by object"""
+        # The two alerts of the first object are both candidates
+        candidates = [self.alerts[0]] + get_latest_alerts(self.alerts)
+        n_objects = len(self.aux)
+        projection = get_prv_candidates_projection()
+
+        k = QueryLogKowalski(self.alerts, self.aux)
+        batch_candidates = append_photometry_to_candidates(
+            deepcopy(candidates), k=k, batch=True, chunk_size=3, n_threads=2)
+        self.assertEqual(len(k.queries), int(np.ceil(n_objects / 3)))
+        names = [name for query in k.queries
+                 for name in query['query']['filter']['_id']['$in']]
+        self.assertEqual(sorted(names), sorted(self.aux))
+        self.assertTrue(all(query['query']['projection'] == projection
+                            for query in k.queries))
+
+        k = QueryLogKowalski(self.alerts, self.aux)
+        single_candidates = append_photometry_to_candidates(
+            deepcopy(candidates), k=k, batch=False)
+        self.assertEqual(len(k.queries), len(candidates))
+
+        for batch_candidate, single_candidate in zip(batch_candidates,
+                                                     single_candidates):
+            expected = project(self.aux[batch_candidate['objectId']],
+                               projection)['prv_candidates']
+            self.assertEqual(batch_candidate['prv_candidates'], expected)
+            self.assertEqual(single_candidate['prv_candidates'], expected)
+
+    def test_projections_cover_downstream_fields(self):
+        """Test that the default aux projections keep every field read by the
+        stationary stage, the annotations, the 3D scores, the light curves and the
+        pdf : the results are the same as with the full documents"""
+        k = SyntheticKowalski(self.alerts, add_unused_fields(self.aux))
+        results = {}
+        for name, photometry_projection, crossmatch_projection in [
+                ('full', {'prv_candidates': 1}, {'cross_matches': 1}),
+                ('default', None, None)]:
+            candidates = append_photometry_to_candidates(
+                deepcopy(get_latest_alerts(self.alerts)), k=k,
+                projection=photometry_projection)
+            candidates = pythonised_fritz_emgw_filter_stationary_stage(
+                candidates, mjd_event=jd_event - 2400000.5, save=False)
+            candidates = get_candidates_crossmatch(candidates, k=k,
+                                                   projection=crossmatch_projection)
+            candidates = annotate_candidates(candidates, k=k)
+            candidates = append_3d_localization_scores(candidates, skymap_path)
+            photometry = make_photometry_table(candidates)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                pdffile = os.path.join(tmpdir, 'candidates.pdf')
+                make_full_pdf(candidates, thumbnails_dir=tmpdir, phot_dir=tmpdir,
+                              pdffilename=pdffile, mjd0=jd_event - 2400000.5,
+                              photometry=photometry,
+                              thumbnails=save_thumbnails(candidates,
+                                                         thumbnails_dir=tmpdir))
+                self.assertTrue(os.path.exists(pdffile))
+            fields = ['objectId', 'mindiff', 'earliest_detection', 'stationary_flag',
+                      'annotations', 'annotation_id', 'clu_distance_mpc',
+                      'probability_density_3d']
+            results[name] = (pd.DataFrame([{field: candidate[field]
+                                            for field in fields}
+                                           for candidate in candidates]),
+                             photometry.data)
+
+        full_candidates, full_photometry = results['full']
+        candidates, photometry = results['default']
+        self.assertEqual(len(candidates), len(CANDIDATE_NAMES) + 2)
+        self.assertGreater(len(set(candidates['annotation_id'])), 2)
+        pd.testing.assert_frame_equal(candidates, full_candidates)
+        self.assertNotIn('rb', photometry.columns)
+        light_curve_columns = ['objectId', 'filter', 'magsys', 'mjd', 'flux',
+                               'fluxerr', 'zp', 'zpsys'] + default_prv_candidates_fields
+        pd.testing.assert_frame_equal(photometry[light_curve_columns],
+                                      full_photometry[light_curve_columns])
+
+    def test_failed_batch(self):
+        """Test that a failed chunk raises instead of dropping its objects"""
+        with self.assertRaises(ValueError):
+            query_aux_alerts_batch(FailingKowalski(self.alerts, self.aux),
+                                   names=list(self.aux), chunk_size=2)
+
+    def test_run_queries_order(self):
+        """Test that concurrent queries are answered in order"""
+        k = QueryLogKowalski(self.alerts, self.aux)
+        queries = [{'query_type': 'find',
+                    'query': {'catalog': 'ZTF_alerts_aux', 'filter': {'_id': name},
+                              'projection': {'_id': 1}}}
+                   for name in self.aux]
+        responses = run_queries(k, queries, n_threads=4)
+        self.assertEqual([response['default']['data'][0]['_id']
+                          for response in responses], list(self.aux))
+        self.assertEqual(run_queries(k, [], n_threads=4), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Test the files the candidates are saved to
+"""
+
+import unittest
+import os
+import json
+import tempfile
+from copy import deepcopy
+from importlib.util import find_spec
+import pandas as pd
+from emgwcave.candidate_table import CandidateTable
+from emgwcave.candidate_utils import save_candidates_to_file, \
+    wait_for_background_saves, get_flat_rows, cutout_keys
+from emgwcave.fritz_filter import pythonised_fritz_emgw_filter_stage_1
+from test_fritz_filter import get_random_sources
+
+
+def get_candidates():
+    """Candidates with flags, ints and nested fields that some of them do not have"""
+    candidates = get_random_sources(200, seed=3)
+    pythonised_fritz_emgw_filter_stage_1(candidates, save=False)
+    for ind, candidate in enumerate(candidates):
+        candidate['candid'] = 2300000000000000000 + ind
+        candidate['cutoutScience'] = {'stampData': b'\x00'}
+        if ind % 3:
+            candidate['candidate']['nid'] = ind
+            candidate['candidate']['fid'] = 1 + ind % 2
+        if ind % 4 == 0:
+            candidate['annotation'] = None if ind % 8 else 'likely QSO'
+        if ind % 5 == 0:
+            candidate['prv_candidates'] = [{'jd': 2460000.5, 'magpsf': 19.}]
+        if ind % 6 == 0:
+            candidate['stationary_flag'] = bool(ind % 12)
+    return candidates
+
+
+def get_json_normalize_csv(candidates, savefile):
+    """The csv file as written with pandas.json_normalize"""
+    candidates = deepcopy(candidates)
+    for candidate in candidates:
+        for key in cutout_keys:
+            candidate.pop(key, None)
+    pd.json_normalize(candidates).to_csv(savefile, index=False)
+    with open(savefile) as f:
+        return f.read()
+
+
+class TestCandidateFiles(unittest.TestCase):
+    """Test saving the candidates to csv and parquet files"""
+
+    def test_csv_matches_json_normalize(self):
+        """Test that the csv files are identical to those written with
+        pandas.json_normalize, for dictionaries and CandidateTables, in the
+        foreground and in the background"""
+        candidates = get_candidates()
+        self.assertNotIsInstance(get_flat_rows(candidates), list)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            expected = get_json_normalize_csv(candidates,
+                                              os.path.join(tmpdir, 'expected.csv'))
+            self.assertIn('fritz_emgw_filter_1_flag', expected)
+            table = CandidateTable.from_alerts(candidates)
+            for name, to_save, background in [('dicts', candidates, False),
+                                              ('table', table, False),
+                                              ('background', table, True)]:
+                savefile = os.path.join(tmpdir, f'{name}.csv')
+                save_candidates_to_file(to_save, savefile, background=background)
+                wait_for_background_saves()
+                with open(savefile) as f:
+                    self.assertEqual(f.read(), expected, name)
+
+        # The candidates are not modified
+        self.assertIn('cutoutScience', candidates[0])
+        self.assertIn('cutoutScience', table[0])
+
+    @unittest.skipUnless(find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet_round_trip(self):
+        """Test that the parquet files read back with the columns and values of
+        the csv files, typed ints, floats, flags and strings, and the nested fields
+        as JSON"""
+        candidates = get_candidates()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csvfile = os.path.join(tmpdir, 'candidates.csv')
+            save_candidates_to_file(candidates, csvfile)
+            expected = pd.read_csv(csvfile)
+            table = CandidateTable.from_alerts(candidates)
+            for name, to_save, background in [('dicts', candidates, False),
+                                              ('table', table, False),
+                                              ('background', table, True)]:
+                savefile = os.path.join(tmpdir, f'{name}.parquet')
+                save_candidates_to_file(to_save, savefile, background=background,
+                                        output_format='parquet')
+                wait_for_background_saves()
+                df = pd.read_parquet(savefile)
+
+                self.assertEqual(list(df.columns), list(expected.columns), name)
+                self.assertEqual(df['candid'].dtype, 'int64')
+                self.assertEqual(df['candid'].iloc[-1], 2300000000000000199)
+                self.assertEqual(df['fritz_emgw_filter_1_flag'].dtype, 'int64')
+                self.assertEqual(df['real_flag'].dtype, bool)
+                self.assertEqual(df['candidate.drb'].dtype, 'float64')
+                self.assertEqual(df['candidate.nid'].dtype, 'float64')
+                self.assertTrue(pd.api.types.is_string_dtype(df['objectId']))
+                # Flags that some candidates do not have are kept as flags
+                self.assertEqual({value for value in df['stationary_flag']
+                                  if not pd.isna(value)}, {True, False})
+                self.assertTrue(all(isinstance(value, bool)
+                                    for value in df['stationary_flag'].dropna()))
+
+                for column in df.columns:
+                    missing = df[column].isna()
+                    self.assertTrue(missing.equals(expected[column].isna()), column)
+                    if column == 'prv_candidates':
+                        continue
+                    self.assertEqual(list(df[column][~missing]),
+                                     list(expected[column][~missing]), column)
+                prv_candidates = [json.loads(value) if isinstance(value, str)
+                                  else None for value in df['prv_candidates']]
+                self.assertEqual(prv_candidates,
+                                 [candidate.get('prv_candidates')
+                                  for candidate in candidates])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Test the columnar candidate table
+"""
+
+import unittest
+from copy import deepcopy
+import numpy as np
+from emgwcave.candidate_table import CandidateTable, CandidateRow
+from emgwcave.candidate_utils import deduplicate_candidates
+
+
+def get_alerts():
+    alerts = []
+    for ind in range(6):
+        alerts.append({'objectId': f'ZTF23aaa{ind % 3:05d}',
+                       'candid': 2300000000000000000 + ind,
+                       'candidate': {'jd': 2460000.5 + ind, 'ra': 10. * ind,
+                                     'isdiffpos': 't',
+                                     'ssnamenr': None if ind % 2 else 'asteroid'},
+                       'prv_candidates': [{'jd': 2460000.5}] * ind})
+    return alerts
+
+
+class TestCandidateTable(unittest.TestCase):
+    """Test the candidate table and its row views"""
+
+    def test_round_trip(self):
+        """Test that alerts are stored in columns and rebuilt unchanged"""
+        alerts = get_alerts()
+        table = CandidateTable.from_alerts(alerts)
+        self.assertEqual(table['candidate.jd'].dtype, float)
+        self.assertEqual(table['candid'].dtype, np.int64)
+        self.assertIn('prv_candidates', table.side_stores)
+        self.assertEqual(table.to_alerts(), alerts)
+        self.assertEqual([row.to_dict() for row in table], alerts)
+
+    def test_row_views(self):
+        """Test that rows behave like dictionaries and write through to the table"""
+        table = CandidateTable.from_alerts(get_alerts())
+        row = table[1]
+        self.assertIsInstance(row['candid'], int)
+        self.assertEqual(row['candidate']['ra'], 10.)
+        self.assertIsNone(row['candidate']['ssnamenr'])
+        self.assertNotIn('cross_matches', row)
+
+        row['cross_matches'] = {'CLU_20190625': []}
+        row['candidate']['age'] = 3.
+        row['annotations'] = 'likely QSO'
+        self.assertEqual(table['cross_matches'][1], {'CLU_20190625': []})
+        self.assertIsNone(table['cross_matches'][0])
+        self.assertNotIn('cross_matches', table[0])
+        self.assertEqual(table['candidate.age'][1], 3.)
+        self.assertEqual(table['annotations'][1], 'likely QSO')
+
+        # Fields set on one row are not added to the other rows
+        self.assertNotIn('annotations', table[0])
+        self.assertNotIn('age', table[0]['candidate'])
+        with self.assertRaises(KeyError):
+            table[0]['annotations']
+        self.assertNotIn('annotations', list(table[0]))
+        self.assertNotIn('annotations', table[[0, 2]].to_alerts()[0])
+        self.assertEqual(table[[2, 1]][1]['annotations'], 'likely QSO')
+
+        # Values that do not fit the column dtype upcast it
+        row['candidate']['jd'] = 'unknown'
+        self.assertEqual(table[1]['candidate']['jd'], 'unknown')
+        self.assertEqual(table[0]['candidate']['jd'], 2460000.5)
+
+        row_copy = deepcopy(row)
+        self.assertIsInstance(row_copy, dict)
+        self.assertNotIsInstance(row_copy, CandidateRow)
+        row_copy['candidate']['ra'] = -1.
+        self.assertEqual(table[1]['candidate']['ra'], 10.)
+
+    def test_mixed_fields(self):
+        """Test that fields missing from some alerts, or nested in some alerts only,
+        are rebuilt unchanged"""
+        alerts = get_alerts()
+        alerts[0]['annotations'] = 'likely QSO'
+        alerts[1]['annotations'] = None
+        alerts[2]['annotations'] = {'sdss': 'QSO'}
+        alerts[3]['candidate']['age'] = 3
+        alerts[4]['magpsf'] = 19.
+        table = CandidateTable.from_alerts(alerts)
+        self.assertIn('annotations', table.side_stores)
+        self.assertNotIn('annotations', table.columns)
+        self.assertEqual(table.to_alerts(), alerts)
+        self.assertEqual([row.to_dict() for row in table], alerts)
+        self.assertNotIn('age', table[0]['candidate'])
+        self.assertNotIn('magpsf', table[0])
+        self.assertEqual(table[3]['candidate']['age'], 3)
+
+    def test_masking_and_deduplication(self):
+        """Test that masking and deduplication give the same candidates as with
+        object arrays of dictionaries"""
+        alerts = get_alerts()
+        table = CandidateTable.from_alerts(alerts)
+        mask = table['candidate.ra'] > 15
+        self.assertEqual(table[mask].to_alerts(),
+                         list(np.array(get_alerts())[mask]))
+
+        deduplicated = deduplicate_candidates(table)
+        self.assertIsInstance(deduplicated, CandidateTable)
+        self.assertEqual(deduplicated.to_alerts(),
+                         list(deduplicate_candidates(get_alerts())))
+
+    def test_slices_and_prefix_index(self):
+        """Test that slices are views of the columns, and that the candidate fields
+        of the rows follow the columns added after the first access"""
+        table = CandidateTable.from_alerts(get_alerts())
+        for sliced in [table[1:4], table[np.arange(1, 4)], table[table['candid'] > 0]]:
+            self.assertTrue(np.shares_memory(sliced['candidate.jd'],
+                                             table['candidate.jd']))
+        sliced = table[2:4]
+        self.assertEqual(len(sliced), 2)
+        self.assertEqual(sliced.to_alerts(), get_alerts()[2:4])
+        sliced[0]['candidate']['ra'] = -1.
+        self.assertEqual(table[2]['candidate']['ra'], -1.)
+        self.assertEqual(table[[-1]].to_alerts(), get_alerts()[-1:])
+        self.assertFalse(np.shares_memory(table[[0, 2]]['candidate.jd'],
+                                          table['candidate.jd']))
+
+        self.assertEqual(list(table[0]['candidate']),
+                         ['jd', 'ra', 'isdiffpos', 'ssnamenr'])
+        table[1]['candidate']['age'] = 3.
+        table['candidate.drb'] = np.ones(len(table))
+        self.assertEqual(list(table[0]['candidate']),
+                         ['jd', 'ra', 'isdiffpos', 'ssnamenr', 'drb'])
+        self.assertEqual(list(table[1]['candidate']),
+                         ['jd', 'ra', 'isdiffpos', 'ssnamenr', 'age', 'drb'])
+
+        # Rows without any candidate field do not have a candidate
+        table = CandidateTable.from_alerts([{'objectId': 'ZTF23aaa00000'},
+                                            {'objectId': 'ZTF23aaa00001',
+                                             'candidate': {'jd': 2460000.5}}])
+        self.assertNotIn('candidate', table[0])
+        self.assertEqual(dict(table[1]['candidate']), {'jd': 2460000.5})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Test recording and replaying of kowalski responses
+"""
+
+import unittest
+import tempfile
+import os
+import gzip
+import json
+from unittest import mock
+import numpy as np
+from emgwcave.cassette import RecordingKowalski, ReplayKowalski, Cassette
+from emgwcave.kowalski_utils import query_aux_alerts_batch, cone_search_batch, \
+    wrap_kowalski_client
+
+skymap_path = 'data/skymaps/2023-04-30T07-47-19_crossmatch-9457-9455.fits.fits'
+
+
+class FakeKowalski:
+    """Answers aux and cone search queries like kowalski would"""
+
+    def __init__(self):
+        self.n_queries = 0
+
+    def query(self, query=None):
+        self.n_queries += 1
+        if query['query_type'] == 'find':
+            names = query['query']['filter']['_id']['$in']
+            data = [{'_id': name, 'prv_candidates': [{'jd': 1.}]} for name in names]
+        else:
+            catalog = list(query['query']['catalogs'].keys())[0]
+            names = query['query']['object_coordinates']['radec'].keys()
+            data = {catalog: {name: [] for name in names}}
+        return {'default': {'status': 'success', 'data': data}}
+
+    def query_skymap(self, path, **kwargs):
+        self.n_queries += 1
+        return {'default': {'ZTF_alerts': [{'objectId': 'ZTF23aaaaaaa'}]}}
+
+
+class TestCassette(unittest.TestCase):
+    """Test record/replay of kowalski responses"""
+
+    def test_record_replay(self):
+        """Test that replayed responses are identical to recorded ones"""
+        names = [f'ZTF23aaa{i:04d}' for i in range(25)]
+        coords_dict = {name: [10., 20.] for name in names}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cassette_path = os.path.join(tmpdir, 'cassette.json.gz')
+
+            fake_kowalski = FakeKowalski()
+            k = RecordingKowalski(fake_kowalski, cassette_path)
+            aux = query_aux_alerts_batch(k, names, chunk_size=10, n_threads=3)
+            matches = cone_search_batch(k, coords_dict, catalog='milliquas_v6',
+                                        projection={}, chunk_size=10)
+            skymap_response = k.query_skymap(path=skymap_path, cumprob=0.9)
+            k.save()
+            self.assertEqual(fake_kowalski.n_queries, 7)
+            self.assertEqual(len(aux), 25)
+
+            k = ReplayKowalski(cassette_path)
+            self.assertEqual(query_aux_alerts_batch(k, names, chunk_size=10), aux)
+            self.assertEqual(cone_search_batch(k, coords_dict, catalog='milliquas_v6',
+                                               projection={}, chunk_size=10),
+                             matches)
+            self.assertEqual(k.query_skymap(path=skymap_path, cumprob=0.9),
+                             skymap_response)
+
+            with self.assertRaises(KeyError):
+                k.query_skymap(path=skymap_path, cumprob=0.5)
+
+    def test_json_cassette(self):
+        """Test that cutout bytes and numpy values are written as JSON, and read
+        back as kowalski returns them"""
+        stamp = gzip.compress(b'SIMPLE  =                    T')
+        response = {'default': {'status': 'success',
+                                'data': [{'candid': np.int64(2300000000000000001),
+                                          'candidate': {'drb': np.float32(0.5)},
+                                          'cutoutScience': {'stampData': stamp}}]}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cassette_path = os.path.join(tmpdir, 'cassette.json.gz')
+            cassette = Cassette(cassette_path)
+            cassette.record('key', response)
+            cassette.save()
+            with gzip.open(cassette_path, 'rt') as f:
+                self.assertIn('key', json.load(f))
+
+            document = Cassette(cassette_path).get('key')['default']['data'][0]
+            self.assertEqual(document, {'candid': 2300000000000000001,
+                                        'candidate': {'drb': 0.5},
+                                        'cutoutScience': {'stampData': stamp}})
+            self.assertIsInstance(document['candid'], int)
+
+    def test_record_cache_hits(self):
+        """Test that responses served by the query cache are recorded too"""
+        names = [f'ZTF23aaa{i:04d}' for i in range(5)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            fake_kowalski = FakeKowalski()
+            for ind in range(2):
+                cassette_path = os.path.join(tmpdir, f'cassette_{ind}.json.gz')
+                with mock.patch.dict(os.environ,
+                                     {'KOWALSKI_CASSETTE': cassette_path,
+                                      'KOWALSKI_CASSETTE_MODE': 'record'}):
+                    k = wrap_kowalski_client(fake_kowalski, cache_dir=cache_dir)
+                self.assertIsInstance(k, RecordingKowalski)
+                aux = query_aux_alerts_batch(k, names, chunk_size=10)
+                k.save()
+            self.assertEqual(fake_kowalski.n_queries, 1)
+
+            k = ReplayKowalski(cassette_path)
+            self.assertEqual(query_aux_alerts_batch(k, names, chunk_size=10), aux)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Test the concurrent enrichment of the candidates
+"""
+
+import unittest
+import threading
+import time
+import numpy as np
+from emgwcave.candidate_table import CandidateTable
+from emgwcave.candidate_utils import cutout_keys
+from emgwcave.enrichment import enrich_candidates
+
+
+class FakeKowalski:
+    """Answers aux, milliquas cone search and cutout queries, and keeps track of
+    the number of queries in flight"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n_in_flight = 0
+        self.max_in_flight = 0
+        self.n_queries = 0
+
+    def query(self, query=None):
+        with self.lock:
+            self.n_queries += 1
+            self.n_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.n_in_flight)
+        try:
+            time.sleep(0.01)
+            return self.answer(query)
+        finally:
+            with self.lock:
+                self.n_in_flight -= 1
+
+    @staticmethod
+    def answer(query):
+        if query['query_type'] == 'cone_search':
+            catalog = list(query['query']['catalogs'].keys())[0]
+            names = query['query']['object_coordinates']['radec'].keys()
+            data = {catalog: {name: [{'Name': f'QSO {name}'}] for name in names}}
+        elif query['query']['catalog'] == 'ZTF_alerts_aux':
+            names = query['query']['filter']['_id']['$in']
+            data = [{'_id': name,
+                     'prv_candidates': [{'jd': 2460000.5, 'objectId': name}],
+                     'cross_matches': {'CLU_20190625': [{'z': 0.01}]}}
+                    for name in names]
+        else:
+            candids = query['query']['filter']['candid']['$in']
+            data = [{'candid': candid,
+                     **{key: np.full((2, 2), candid % 1000) for key in cutout_keys}}
+                    for candid in candids]
+        return {'default': {'status': 'success', 'data': data}}
+
+
+def get_candidates(n: int = 30):
+    return [{'objectId': f'ZTF23aaa{ind:05d}', 'candid': 2300000000000000000 + ind,
+             'candidate': {'ra': 10. + ind, 'dec': 20., 'jd': 2460000.5}}
+            for ind in range(n)]
+
+
+class TestEnrichment(unittest.TestCase):
+    """Test the concurrent enrichment of the candidates"""
+
+    def test_enrich_candidates(self):
+        """Test that the fields of all three phases are attached to every
+        candidate, and that the queries of all phases share the concurrency limit"""
+        for container in [list, CandidateTable.from_alerts]:
+            k = FakeKowalski()
+            candidates = enrich_candidates(container(get_candidates()), k=k,
+                                           max_concurrent_queries=3, chunk_size=2)
+            # 15 aux queries for the photometry, 15 aux and 15 cone search queries
+            # for the crossmatches, and 15 cutout queries
+            self.assertEqual(k.n_queries, 60)
+            self.assertLessEqual(k.max_in_flight, 3)
+            self.assertGreater(k.max_in_flight, 1)
+
+            self.assertEqual(len(candidates), 30)
+            for ind, candidate in enumerate(candidates):
+                name = candidate['objectId']
+                self.assertEqual(candidate['prv_candidates'],
+                                 [{'jd': 2460000.5, 'objectId': name}])
+                self.assertEqual(candidate['cross_matches'],
+                                 {'CLU_20190625': [{'z': 0.01}],
+                                  'milliquas': [{'Name': f'QSO {name}'}]})
+                for key in cutout_keys:
+                    np.testing.assert_array_equal(candidate[key],
+                                                  np.full((2, 2), ind))
+                # The other fields are untouched
+                self.assertEqual(candidate['candidate']['jd'], 2460000.5)
+
+    def test_separate_limits(self):
+        """Test that concurrent enrichments each keep their own limit"""
+        k = FakeKowalski()
+        threads = [threading.Thread(target=enrich_candidates,
+                                    args=(get_candidates(),),
+                                    kwargs={'k': k, 'max_concurrent_queries': 2,
+                                            'chunk_size': 2})
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(k.n_queries, 120)
+        self.assertLessEqual(k.max_in_flight, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
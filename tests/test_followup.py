@@ -0,0 +1,110 @@
+"""
+Test the incremental follow-up of an event
+"""
+
+import unittest
+import tempfile
+from unittest import mock
+from astropy.time import Time
+from emgwcave.__main__ import filter_candidates
+from emgwcave.followup import FollowupState
+from emgwcave.skymap_utils import get_mjd_from_skymap
+from synthetic_kowalski import SyntheticKowalski, make_synthetic_data
+
+skymap_path = 'data/skymaps/2023-04-17T22-42-11_bayestar.multiorder.fits'
+other_skymap_path = 'data/skymaps/2023-04-30T07-47-19_crossmatch-9457-9455.fits.fits'
+mjd_event = get_mjd_from_skymap(skymap_path=skymap_path)
+jd_event = mjd_event + 2400000.5
+CANDIDATE_NAMES = ['ZTF23aaaaaaa', 'ZTF23aaaaaab', 'ZTF23aaaaaac']
+
+
+def run_followup(k, outdir, end_date_jd, **load_kwargs):
+    followup_state = FollowupState.load(outdir=outdir, skymap_path=skymap_path,
+                                        cumprob=0.9, **load_kwargs)
+    with mock.patch('emgwcave.__main__.connect_kowalski', return_value=k):
+        selected_candidates = filter_candidates(skymap_path=skymap_path,
+                                                cumprob=0.9,
+                                                mjd_event=mjd_event,
+                                                start_date_jd=jd_event,
+                                                end_date_jd=end_date_jd,
+                                                time_window_days=3.,
+                                                outdir=outdir,
+                                                followup_state=followup_state)
+    followup_state.save()
+    return followup_state, [candidate['objectId'] for candidate in selected_candidates]
+
+
+class TestFollowup(unittest.TestCase):
+    """Test resuming a follow-up from its saved state"""
+
+    def test_incremental_run(self):
+        """Test that a resumed run only queries new alerts, refreshes the candidates
+        with new alerts, and drops those whose newest alert fails the filters"""
+        # All objects have alerts 0.8 and 1.2 days after the event, the newest
+        # alerts of the rejected objects fail the filters
+        alerts, aux = make_synthetic_data(skymap_path, jd_event=jd_event,
+                                          selected_names=CANDIDATE_NAMES)
+        k = SyntheticKowalski(alerts, aux)
+        with tempfile.TemporaryDirectory() as outdir:
+            followup_state, names = run_followup(k, outdir, end_date_jd=jd_event + 1.)
+            self.assertEqual(names, CANDIDATE_NAMES + ['ZTF23zz0aste', 'ZTF23zz0bogu'])
+            self.assertEqual(followup_state.last_jd_end, jd_event + 1.)
+
+            followup_state, names = run_followup(k, outdir, end_date_jd=jd_event + 2.)
+            self.assertEqual(names, CANDIDATE_NAMES)
+            self.assertEqual(list(followup_state.candidates), CANDIDATE_NAMES)
+            for name in CANDIDATE_NAMES:
+                self.assertEqual(followup_state.candidates[name]['candidate']['jd'],
+                                 jd_event + 1.2)
+
+            # The checkpoint is never later than now
+            now_jd = Time.now().jd
+            followup_state.update(followup_state.candidates.values(),
+                                  jd_end=now_jd + 10.)
+            self.assertGreaterEqual(followup_state.last_jd_end, now_jd)
+            self.assertLess(followup_state.last_jd_end, now_jd + 1.)
+
+            # The state is not resumed with other skymap versions
+            resumed_state = FollowupState.load(outdir=outdir, skymap_path=skymap_path,
+                                               cumprob=0.9)
+            self.assertEqual(resumed_state.last_jd_end, jd_event + 2.)
+            new_state = FollowupState.load(outdir=outdir, skymap_path=skymap_path,
+                                           cumprob=0.9,
+                                           skymap_versions=[other_skymap_path])
+            self.assertIsNone(new_state.last_jd_end)
+            new_state = FollowupState.load(
+                outdir=outdir, skymap_path=skymap_path, cumprob=0.9,
+                localization_compare_skymappath=other_skymap_path)
+            self.assertEqual(len(new_state.candidates), 0)
+
+    def test_late_alert(self):
+        """Test that an alert from before the checkpoint, that kowalski ingested
+        after the previous run, is retrieved by the next run"""
+        alerts, aux = make_synthetic_data(skymap_path, jd_event=jd_event,
+                                          selected_names=CANDIDATE_NAMES)
+        # The only alert of the last object, 0.8 days after the event, is ingested
+        # after the first run, that ends 0.85 days after the event
+        late_name = CANDIDATE_NAMES[-1]
+        alerts = [alert for alert in alerts if (alert['objectId'] != late_name)
+                  or (alert['candidate']['jd'] < jd_event + 1.)]
+        ingested_alerts = [alert for alert in alerts if alert['objectId'] != late_name]
+        for ingestion_margin_hours, expected_names in [(3., CANDIDATE_NAMES),
+                                                       (0., CANDIDATE_NAMES[:-1])]:
+            with tempfile.TemporaryDirectory() as outdir:
+                _, names = run_followup(SyntheticKowalski(ingested_alerts, aux), outdir,
+                                        end_date_jd=jd_event + 0.85,
+                                        ingestion_margin_hours=ingestion_margin_hours)
+                self.assertNotIn(late_name, names)
+
+                followup_state, names = run_followup(
+                    SyntheticKowalski(alerts, aux), outdir,
+                    end_date_jd=jd_event + 2.,
+                    ingestion_margin_hours=ingestion_margin_hours)
+                self.assertEqual(names, expected_names)
+                # The alerts of the margin that were already retained are merged
+                # back without duplicates
+                self.assertEqual(list(followup_state.candidates), expected_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+"""
+Test the columnar Fritz EMGW filter stages
+"""
+
+import unittest
+import tempfile
+from unittest import mock
+import numpy as np
+from emgwcave.__main__ import filter_candidates
+from emgwcave.fritz_filter import pythonised_fritz_emgw_filter_stage_1, \
+    pythonised_fritz_emgw_filter_stationary_stage, positive_isdiffpos_values, \
+    get_fritz_emgw_stage_1_mongo_filter, get_server_side_stage_1_mask, \
+    verify_server_side_filter
+from emgwcave.skymap_utils import get_mjd_from_skymap
+from synthetic_kowalski import SyntheticKowalski, make_synthetic_data, matches_filter
+
+skymap_path = 'data/skymaps/2023-04-17T22-42-11_bayestar.multiorder.fits'
+
+
+def get_reference_flags(candidate):
+    """Stage 1 flags of one candidate, evaluated one comparison at a time"""
+    age = candidate['jd'] - candidate['jdstarthist']
+    flags = {
+        'positive_sub_flag': candidate['isdiffpos'] in positive_isdiffpos_values,
+        'real_flag': candidate['drb'] > 0.3,
+        'young_flag': age < 10,
+        'asteroid_flag': (0 <= candidate['ssdistnr'] < 10)
+                         & (candidate['ssmagnr'] < 20),
+        'point_underneath_flag': (0 <= candidate['distpsnr1'] < 2)
+                                 & (candidate['sgscore1'] > 0.76),
+        'brightstar_flag': any((0 <= candidate[f'distpsnr{ind}'] < 20)
+                               & (0 <= candidate[f'srmag{ind}'] < 15)
+                               & (candidate[f'sgscore{ind}'] > 0.49)
+                               for ind in [1, 2, 3])
+                           | ((candidate['sgscore1'] == 0.5)
+                              & (0 <= candidate['distpsnr1'] < 0.5)
+                              & ((0 <= candidate['sgmag1'] < 17)
+                                 | (0 <= candidate['srmag1'] < 17)
+                                 | (0 <= candidate['simag1'] < 17))),
+        'variable_source_flag': ((0 < candidate['distnr'] < 0.4)
+                                 & (candidate['magnr'] < 19) & (age > 90))
+                                | ((0 < candidate['distnr'] < 0.8)
+                                   & (0 < candidate['magnr'] < 17) & (age > 90))
+                                | ((0 < candidate['distnr'] < 1.2)
+                                   & (0 < candidate['magnr'] < 16) & (age > 90)),
+    }
+    flags['fritz_emgw_filter_1_flag'] = flags['positive_sub_flag'] \
+        and flags['real_flag'] and flags['young_flag'] \
+        and not flags['asteroid_flag'] and not flags['point_underneath_flag'] \
+        and not flags['brightstar_flag'] and not flags['variable_source_flag']
+    return flags
+
+
+def get_random_sources(n: int, seed: int = 0):
+    """Sources whose fields are drawn from values around the cut boundaries"""
+    rng = np.random.default_rng(seed)
+    values = {
+        'drb': [0.1, 0.3, 0.9],
+        'ssdistnr': [-999., 0., 5., 10.],
+        'ssmagnr': [-999., 19., 20.],
+        'sgscore1': [0.2, 0.49, 0.5, 0.76, 0.9],
+        'sgscore2': [0.2, 0.49, 0.9],
+        'sgscore3': [0.2, 0.49, 0.9],
+        'distpsnr1': [-999., 0., 0.3, 1.9, 2., 15., 20.],
+        'distpsnr2': [-999., 0., 15., 20.],
+        'distpsnr3': [-999., 0., 15., 20.],
+        'srmag1': [-999., 0., 14., 15., 16.5, 17.],
+        'srmag2': [-999., 14., 15.],
+        'srmag3': [-999., 14., 15.],
+        'sgmag1': [-999., 16., 17.],
+        'simag1': [-999., 16., 17.],
+        'distnr': [-999., 0., 0.3, 0.4, 0.7, 1.1, 1.2],
+        'magnr': [-999., 0., 15., 16., 17., 18., 19.],
+    }
+    sources = []
+    for ind in range(n):
+        candidate = {field: rng.choice(field_values)
+                     for field, field_values in values.items()}
+        candidate['isdiffpos'] = rng.choice(['t', 'f', '1', '0', 'True', 'False'])
+        candidate['jdstarthist'] = 2460000.5
+        candidate['jd'] = candidate['jdstarthist'] + rng.choice([0., 9.9, 10., 95.])
+        sources.append({'objectId': f'ZTF23aaa{ind:05d}', 'candidate': candidate})
+    return sources
+
+
+class TestFritzFilter(unittest.TestCase):
+    """Test the stage 1 filter against a per-candidate evaluation"""
+
+    def test_stage_1_flags(self):
+        """Test that the columnar flags and selection are identical"""
+        sources = get_random_sources(5000)
+        selected = pythonised_fritz_emgw_filter_stage_1(sources, save=False)
+
+        expected_selected = []
+        for source in sources:
+            expected_flags = get_reference_flags(source['candidate'])
+            for flag, value in expected_flags.items():
+                self.assertEqual(source[flag], bool(value), flag)
+            if expected_flags['fritz_emgw_filter_1_flag']:
+                expected_selected.append(source['objectId'])
+        self.assertGreater(len(expected_selected), 0)
+        self.assertEqual([source['objectId'] for source in selected],
+                         expected_selected)
+
+    def test_mongo_filter(self):
+        """Test that the server-side filter agrees with the local flags, including
+        for null and missing fields"""
+        rng = np.random.default_rng(2)
+        sources = get_random_sources(5000, seed=2)
+        for source in sources:
+            for field in ['drb', 'jdstarthist', 'ssdistnr', 'ssmagnr', 'distpsnr1',
+                          'sgscore1']:
+                if rng.uniform() < 0.1:
+                    source['candidate'][field] = None
+                elif rng.uniform() < 0.1:
+                    del source['candidate'][field]
+        mongo_filter = get_fritz_emgw_stage_1_mongo_filter()
+        server_mask = np.array([matches_filter(source, mongo_filter)
+                                for source in sources])
+        local_mask = get_server_side_stage_1_mask(sources)
+        self.assertGreater(np.sum(server_mask), 0)
+        self.assertLess(np.sum(server_mask), len(sources))
+        np.testing.assert_array_equal(server_mask, local_mask)
+
+        # Both directions are verified
+        self.assertEqual(len(verify_server_side_filter(
+            [sources[ind] for ind in np.flatnonzero(server_mask)],
+            rejected_sources=[sources[ind] for ind in np.flatnonzero(~server_mask)])),
+            0)
+        mismatches = verify_server_side_filter(sources[:100],
+                                               rejected_sources=sources[:100])
+        self.assertEqual(len(mismatches), 100)
+
+    def test_missing_jdstarthist(self):
+        """Test that alerts with a missing or null jdstarthist do not pass the
+        server-side age cut"""
+        passing_candidate = {'isdiffpos': 't', 'drb': 0.9, 'jd': 2460001.5,
+                             'jdstarthist': 2460000.5, 'ssdistnr': -999.,
+                             'ssmagnr': -999., 'distpsnr1': 15., 'sgscore1': 0.2}
+        sources = [{'objectId': 'ZTF23aaaaaaa', 'candidate': passing_candidate},
+                   {'objectId': 'ZTF23aaaaaab',
+                    'candidate': {**passing_candidate, 'jdstarthist': None}},
+                   {'objectId': 'ZTF23aaaaaac',
+                    'candidate': {key: value for key, value in passing_candidate.items()
+                                  if key != 'jdstarthist'}}]
+        mongo_filter = get_fritz_emgw_stage_1_mongo_filter()
+        self.assertEqual([matches_filter(source, mongo_filter) for source in sources],
+                         [True, False, False])
+        np.testing.assert_array_equal(get_server_side_stage_1_mask(sources),
+                                      [True, False, False])
+        # The age cut alone lets them through, null sorts below every number
+        age_filter = {'$expr': mongo_filter['$expr']}
+        self.assertTrue(all(matches_filter(source, age_filter) for source in sources))
+
+    def test_server_side_filter(self):
+        """Test that filtering on kowalski selects the same candidates as locally,
+        as the cuts are applied to the newest alert of each object in both cases"""
+        mjd_event = get_mjd_from_skymap(skymap_path)
+        names = ['ZTF23aaaaaaa', 'ZTF23aaaaaab']
+        alerts, aux = make_synthetic_data(skymap_path, jd_event=mjd_event + 2400000.5,
+                                          selected_names=names)
+        k = SyntheticKowalski(alerts, aux)
+        for server_side_filter in [False, True]:
+            with tempfile.TemporaryDirectory() as outdir, \
+                    mock.patch('emgwcave.__main__.connect_kowalski', return_value=k):
+                selected = filter_candidates(skymap_path=skymap_path, cumprob=0.9,
+                                             mjd_event=mjd_event,
+                                             start_date_jd=mjd_event + 2400000.5,
+                                             end_date_jd=mjd_event + 2400003.5,
+                                             time_window_days=3., outdir=outdir,
+                                             server_side_filter=server_side_filter)
+            self.assertEqual([source['objectId'] for source in selected], names)
+
+    def test_stationary_stage(self):
+        """Test the segmented reductions over the previous detections against a
+        per-source evaluation, including sources without previous detections"""
+        rng = np.random.default_rng(1)
+        mjd_event = 60000.
+        sources = []
+        for ind in range(500):
+            jd = 2460000.5 + rng.uniform(0, 5)
+            prv_candidates = []
+            for _ in range(rng.choice([0, 0, 1, 3, 20])):
+                prv_candidate = {'jd': jd - rng.choice([0., 0.005, 0.5, 3.]),
+                                 'isdiffpos': rng.choice(['t', 'f', '1', 'True'])}
+                if rng.uniform() < 0.8:
+                    prv_candidate['magpsf'] = rng.choice([18., 99.])
+                prv_candidates.append(prv_candidate)
+            sources.append({'objectId': f'ZTF23aaa{ind:05d}', 'candidate': {'jd': jd},
+                            'prv_candidates': prv_candidates})
+
+        selected = pythonised_fritz_emgw_filter_stationary_stage(
+            sources, mjd_event=mjd_event, save=False)
+
+        expected_selected = []
+        for source in sources:
+            jd = source['candidate']['jd']
+            detections = [x for x in source['prv_candidates'] if 'magpsf' in x]
+            jds = np.array([x['jd'] for x in detections])
+            stationary_flag = any((abs(x['jd'] - jd) > 0.01) & (x['magpsf'] < 99)
+                                  & (x['isdiffpos'] in ['1', 't'])
+                                  for x in detections)
+            earliest_detection = np.min(jds) if len(jds) > 0 else jd
+            mindiff = np.max(np.abs(jds - jd)) if len(jds) > 0 else 0
+            self.assertEqual(source['stationary_flag'], stationary_flag)
+            self.assertEqual(source['earliest_detection'], earliest_detection)
+            self.assertEqual(source['mindiff'], mindiff)
+            if stationary_flag & (earliest_detection > mjd_event + 2400000.5):
+                expected_selected.append(source['objectId'])
+        self.assertGreater(len(expected_selected), 0)
+        self.assertEqual([source['objectId'] for source in selected],
+                         expected_selected)
+
+
+if __name__ == '__main__':
+    unittest.main()
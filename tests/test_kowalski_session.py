@@ -0,0 +1,87 @@
+"""
+Test the Kowalski client shared across the pipeline
+"""
+
+import unittest
+import os
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import requests
+from requests.adapters import HTTPAdapter
+from penquins import Kowalski
+from emgwcave import kowalski_utils
+from emgwcave.kowalski_utils import connect_kowalski, create_kowalski_client, \
+    get_connection_stats
+
+credentials = {'KOWALSKI_TOKEN': 'token', 'KOWALSKI_URL': 'kowalski.example.org',
+               'KOWALSKI_PORT': '443'}
+
+
+class FakeClient:
+    """Client with a pooled HTTP session, that never connects"""
+
+    def __init__(self, pool_maxsize):
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_maxsize,
+                                                   pool_maxsize=pool_maxsize))
+
+
+class TestKowalskiSession(unittest.TestCase):
+    """Test that one pooled client is shared by each process"""
+
+    def setUp(self):
+        # Start each test without a shared client, and restore it afterwards
+        sessions = dict(kowalski_utils._kowalski_sessions)
+        self.stats = dict(kowalski_utils._kowalski_session_stats)
+        kowalski_utils._kowalski_sessions.clear()
+        self.addCleanup(kowalski_utils._kowalski_sessions.update, sessions)
+        self.addCleanup(kowalski_utils._kowalski_session_stats.update, self.stats)
+        self.addCleanup(kowalski_utils._kowalski_sessions.clear)
+
+    def test_shared_client(self):
+        """Test that concurrent callers get the same client, built once with the
+        requested pool size, and that another process gets its own client"""
+        with mock.patch('emgwcave.kowalski_utils.create_kowalski_client',
+                        side_effect=FakeClient) as create_client:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                clients = list(executor.map(
+                    lambda _: connect_kowalski(pool_maxsize=64), range(32)))
+            self.assertEqual(create_client.call_count, 1)
+            self.assertTrue(all(client is clients[0] for client in clients))
+            self.assertEqual(clients[0].pool_maxsize, 64)
+            stats = get_connection_stats()
+            self.assertEqual(stats['clients_created'], self.stats['clients_created'] + 1)
+            self.assertEqual(stats['client_reuses'], self.stats['client_reuses'] + 31)
+
+            # Unless asked otherwise
+            self.assertIsNot(connect_kowalski(reuse=False), clients[0])
+            self.assertEqual(create_client.call_count, 2)
+
+            # A forked worker does not share the connections of its parent
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                self.assertIsNot(connect_kowalski(), clients[0])
+            self.assertEqual(create_client.call_count, 3)
+            self.assertIs(connect_kowalski(), clients[0])
+
+    def test_pool_size(self):
+        """Test that the connection pool of a new client is as large as requested"""
+        environment = {key: value for key, value in os.environ.items()
+                       if not key.startswith('KOWALSKI')}
+        environment.update(credentials)
+        with mock.patch.dict(os.environ, environment, clear=True), \
+                mock.patch.object(Kowalski, 'get_catalogs', return_value=None), \
+                mock.patch.object(Kowalski, 'ping', return_value=True):
+            k = create_kowalski_client(pool_maxsize=48)
+        session = k.instances['default']['session']
+        for url in ['https://kowalski.example.org', 'http://kowalski.example.org']:
+            adapter = session.get_adapter(url)
+            self.assertEqual(adapter._pool_connections, 48)
+            self.assertEqual(adapter._pool_maxsize, 48)
+        stats = get_connection_stats(k)
+        self.assertEqual(stats['http_connections_opened'], 0)
+        self.assertEqual(stats['http_requests'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Test the retrieval of the latest alert of each object
+"""
+
+import unittest
+import numpy as np
+from emgwcave.kowalski_utils import search_in_skymap
+from emgwcave.candidate_utils import deduplicate_candidates, get_thumbnails
+from synthetic_kowalski import SyntheticKowalski, matches_filter, get_stamp
+
+
+class FakeKowalski(SyntheticKowalski):
+    """Serves query_skymap from all the alerts, wherever the skymap is, and counts
+    the alerts transferred with more than their objectId"""
+
+    def __init__(self, alerts):
+        super().__init__(alerts, aux={})
+        self.n_transferred = 0
+        self.pipelines = []
+
+    def query_skymap(self, jd_start, jd_end, jdstarthist_start, jdstarthist_end,
+                     catalogs, program_ids, projection_kwargs, **kwargs):
+        window_filter = {"candidate.jd": {"$gt": jd_start, "$lt": jd_end},
+                         "candidate.jdstarthist": {"$gt": jdstarthist_start,
+                                                   "$lt": jdstarthist_end},
+                         "candidate.programid": {"$in": program_ids}}
+        alerts = [{field: alert[field] for field in projection_kwargs}
+                  if len(projection_kwargs) > 0 else alert
+                  for alert in self.alerts if matches_filter(alert, window_filter)]
+        return {'default': {catalogs[0]: alerts}}
+
+    def query(self, query=None):
+        response = super().query(query=query)
+        if query['query_type'] == 'find':
+            self.n_transferred += len(response['default']['data'])
+        else:
+            self.pipelines.append(query['query']['pipeline'])
+        return response
+
+
+class TestLatestAlerts(unittest.TestCase):
+    """Test the server-side and local deduplication"""
+
+    def test_latest_alerts(self):
+        """Test that only the newest alert of each object in the window is
+        retrieved, and that it is the one kept by the local deduplication"""
+        rng = np.random.default_rng(0)
+        alerts = []
+        for candid in range(1000):
+            alerts.append({'objectId': f'ZTF23aaa{rng.integers(50):05d}',
+                           'candid': candid,
+                           'candidate': {'jd': 2460000.5 + rng.uniform(0, 10),
+                                         'jdstarthist': 2460000.5,
+                                         'programid': int(rng.choice([1, 2, 3]))}})
+        k = FakeKowalski(alerts)
+        kwargs = dict(skymap_path=None, cumprob=0.9, jd_start=2460001.5,
+                      jd_end=2460008.5, jdstarthist_start=2460000.,
+                      jdstarthist_end=2460001.)
+
+        all_alerts = search_in_skymap(k, **kwargs)['default']['ZTF_alerts']
+        latest_alerts = search_in_skymap(k, latest_only=True, chunk_size=20,
+                                         **kwargs)['default']['ZTF_alerts']
+
+        expected = deduplicate_candidates(all_alerts)
+        self.assertEqual(len(expected), 50)
+        self.assertEqual(k.n_transferred, 50)
+        self.assertEqual(list(deduplicate_candidates(latest_alerts)), list(expected))
+
+        # The newest alerts are found by sorting only their objectId, candid and jd
+        for pipeline in k.pipelines:
+            stages = [list(stage)[0] for stage in pipeline]
+            self.assertEqual(stages, ['$match', '$project', '$sort', '$group'])
+            self.assertEqual(set(pipeline[1]['$project']),
+                             {'_id', 'objectId', 'candid', 'candidate.jd'})
+
+    def test_latest_thumbnails(self):
+        """Test that candidates without a candid get the cutouts of the newest alert
+        of their object, fetched by candid"""
+        rng = np.random.default_rng(1)
+        alerts = [{'objectId': objectid, 'candid': candid,
+                   'candidate': {'jd': jd},
+                   'cutoutScience': get_stamp(rng), 'cutoutTemplate': get_stamp(rng),
+                   'cutoutDifference': get_stamp(rng)}
+                  for candid, (objectid, jd) in enumerate([('a', 1.), ('a', 3.),
+                                                           ('b', 2.), ('a', 2.)])]
+        k = FakeKowalski(alerts)
+        candidates = get_thumbnails([{'objectId': 'a'}, {'objectId': 'b'},
+                                     {'objectId': 'a', 'candid': 3}], k=k)
+        for candidate, candid in zip(candidates, [1, 2, 3]):
+            self.assertEqual(candidate['cutoutScience'],
+                             alerts[candid]['cutoutScience'])
+        self.assertEqual(k.n_transferred, 3)
+        self.assertEqual(len(k.pipelines), 1)
+
+    def test_deduplicate_candidates(self):
+        """Test that the newest alert of each object is kept, sorted by objectId"""
+        alerts = [{'objectId': objectid, 'candid': candid, 'candidate': {'jd': jd}}
+                  for candid, (objectid, jd) in enumerate([('b', 1.), ('a', 3.),
+                                                           ('b', 4.), ('a', 2.),
+                                                           ('c', np.nan)])]
+        deduplicated = deduplicate_candidates(alerts)
+        self.assertEqual([alert['candid'] for alert in deduplicated], [1, 2, 4])
+        self.assertEqual(len(deduplicate_candidates([])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
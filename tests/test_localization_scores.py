@@ -0,0 +1,127 @@
+"""
+Test the 3D localization scores on a synthetic skymap with known values
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import healpy as hp
+from astropy.io import fits
+from astropy.cosmology import Planck18
+from emgwcave.candidate_table import CandidateTable
+from emgwcave.candidate_utils import append_3d_localization_scores
+
+# A multi-order skymap with the 12 pixels of order 0, each with its own distance
+# ansatz
+n_pixels = 12
+prob_density = np.arange(1, n_pixels + 1) / (n_pixels * (n_pixels + 1) / 2) \
+    / hp.nside2pixarea(1)
+distmu = np.linspace(50., 600., n_pixels)
+distsigma = np.linspace(10., 120., n_pixels)
+distnorm = 1. / (distmu ** 2 + distsigma ** 2)
+
+
+def write_skymap(savepath, with_distance: bool = True):
+    columns = [fits.Column(name='UNIQ', format='K', array=np.arange(n_pixels) + 4),
+               fits.Column(name='PROBDENSITY', format='D', array=prob_density)]
+    if with_distance:
+        columns += [fits.Column(name='DISTMU', format='D', array=distmu),
+                    fits.Column(name='DISTSIGMA', format='D', array=distsigma),
+                    fits.Column(name='DISTNORM', format='D', array=distnorm)]
+    hdu = fits.BinTableHDU.from_columns(columns)
+    for key, value in [('PIXTYPE', 'HEALPIX'), ('ORDERING', 'NUNIQ'),
+                       ('COORDSYS', 'C'), ('MOCORDER', 0)]:
+        hdu.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(savepath)
+
+
+def get_candidates():
+    """One candidate at the center of each pixel, in a CLU galaxy whose distance
+    is a given number of sigmas from the distance of the pixel. The last one has
+    no CLU crossmatch."""
+    ras, decs = hp.pix2ang(1, np.arange(n_pixels), nest=True, lonlat=True)
+    sigma_offsets = np.linspace(-3., 3., n_pixels)
+    distances = distmu + sigma_offsets * distsigma
+    redshifts = [find_redshift(distance) for distance in distances]
+    candidates = []
+    for ind in range(n_pixels):
+        # The nearest galaxy on the sky is used, not the first one
+        clu_galaxies = [{'z': 0.5, 'coordinates': {'distance_arcsec': 30.}},
+                        {'z': redshifts[ind], 'coordinates': {'distance_arcsec': 2.}}]
+        candidates.append({'objectId': f'ZTF23aaa{ind:05d}',
+                           'candidate': {'ra': ras[ind], 'dec': decs[ind]},
+                           'cross_matches': {'CLU_20190625': clu_galaxies
+                                             if ind < n_pixels - 1 else []}})
+    return candidates, distances, sigma_offsets
+
+
+def find_redshift(distance: float):
+    """Redshift at a luminosity distance (Mpc), by bisection"""
+    low, high = 0., 1.
+    for _ in range(60):
+        middle = (low + high) / 2
+        if Planck18.luminosity_distance(middle).value < distance:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+class TestLocalizationScores(unittest.TestCase):
+    """Test the vectorized 3D localization scores"""
+
+    def test_known_scores(self):
+        """Test the scores against the distance ansatz evaluated by hand"""
+        candidates, distances, sigma_offsets = get_candidates()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            skymap_path = os.path.join(tmpdir, 'synthetic.multiorder.fits')
+            write_skymap(skymap_path)
+            for container in [list, CandidateTable.from_alerts]:
+                scored = append_3d_localization_scores(container(candidates),
+                                                       skymap_path)
+                scores = {field: np.array([candidate[field] for candidate in scored],
+                                          dtype=float)
+                          for field in ['clu_distance_mpc',
+                                        'distance_posterior_density',
+                                        'probability_density_3d',
+                                        'distance_sigma_offset',
+                                        'distance_consistent_flag']}
+
+                expected_dp_dr = distances ** 2 * distnorm \
+                    * np.exp(-0.5 * sigma_offsets ** 2) / (distsigma * np.sqrt(2 * np.pi))
+                has_clu = np.arange(n_pixels) < n_pixels - 1
+                np.testing.assert_allclose(scores['clu_distance_mpc'][has_clu],
+                                           distances[has_clu], rtol=1e-6)
+                np.testing.assert_allclose(scores['distance_sigma_offset'][has_clu],
+                                           sigma_offsets[has_clu], atol=1e-5)
+                np.testing.assert_allclose(
+                    scores['distance_posterior_density'][has_clu],
+                    expected_dp_dr[has_clu], rtol=1e-5)
+                np.testing.assert_allclose(scores['probability_density_3d'][has_clu],
+                                           (prob_density * expected_dp_dr)[has_clu],
+                                           rtol=1e-5)
+                np.testing.assert_array_equal(
+                    scores['distance_consistent_flag'][has_clu],
+                    np.abs(sigma_offsets[has_clu]) <= 2)
+                # Without a CLU redshift, the scores are NaN and not consistent
+                for field in ['clu_distance_mpc', 'distance_posterior_density',
+                              'probability_density_3d', 'distance_sigma_offset']:
+                    self.assertTrue(np.isnan(scores[field][-1]), field)
+                self.assertEqual(scores['distance_consistent_flag'][-1], 0)
+
+    def test_skymap_without_distance(self):
+        """Test that the scores are NaN for a skymap without distance information"""
+        candidates, _, _ = get_candidates()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            skymap_path = os.path.join(tmpdir, 'synthetic.multiorder.fits')
+            write_skymap(skymap_path, with_distance=False)
+            scored = append_3d_localization_scores(candidates, skymap_path)
+        self.assertTrue(np.all(np.isnan([candidate['probability_density_3d']
+                                         for candidate in scored])))
+        self.assertFalse(np.any([candidate['distance_consistent_flag']
+                                 for candidate in scored]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Smoke test of the full pipeline, from the kowalski queries to the pdf. Offline,
+the queries are answered from the cassette of synthetic responses (see
+conftest.py), so this checks that the stages fit together, not the results of real
+queries.
+"""
+
+import unittest
+import os
+import tempfile
+import pandas as pd
+from emgwcave.__main__ import filter_candidates, setup_output_directories
+from emgwcave.kowalski_utils import connect_kowalski
+from emgwcave.candidate_utils import get_thumbnails, save_candidates_to_file, \
+    write_photometry_to_file
+from emgwcave.photometry import make_photometry_table
+from emgwcave.plotting import save_thumbnails, make_full_pdf
+from test_lvc_candidates import skymap_path, mjd_event, start_date_jd, end_date_jd, \
+    time_window_days, CANDIDATE_NAMES
+
+
+class TestOfflinePipeline(unittest.TestCase):
+    """Smoke test of the pipeline end to end"""
+
+    def test_pipeline_smoke(self):
+        """Test that the candidates, thumbnails, light curves and pdf are written"""
+        with tempfile.TemporaryDirectory() as outdir:
+            phot_dir, thumbnails_dir = setup_output_directories(outdir)
+            selected_candidates = filter_candidates(skymap_path=skymap_path,
+                                                    cumprob=0.9,
+                                                    mjd_event=mjd_event,
+                                                    start_date_jd=start_date_jd,
+                                                    end_date_jd=end_date_jd,
+                                                    time_window_days=time_window_days,
+                                                    outdir=outdir)
+            names = [candidate['objectId'] for candidate in selected_candidates]
+            self.assertEqual(names, CANDIDATE_NAMES)
+
+            get_thumbnails(selected_candidates, k=connect_kowalski())
+            thumbnails = save_thumbnails(selected_candidates,
+                                         thumbnails_dir=thumbnails_dir)
+            self.assertEqual(len(thumbnails), 3 * len(names))
+
+            savefile = os.path.join(outdir, 'candidates.csv')
+            save_candidates_to_file(selected_candidates, savefile)
+            photometry = make_photometry_table(selected_candidates)
+            write_photometry_to_file(selected_candidates, phot_dir=phot_dir,
+                                     photometry=photometry)
+            pdffile = os.path.join(outdir, 'candidates.pdf')
+            make_full_pdf(selected_candidates, thumbnails_dir=thumbnails_dir,
+                          phot_dir=phot_dir, pdffilename=pdffile, mjd0=mjd_event,
+                          photometry=photometry, thumbnails=thumbnails)
+
+            self.assertEqual(list(pd.read_csv(savefile)['objectId']), names)
+            self.assertEqual(len(os.listdir(phot_dir)), len(names))
+            with open(pdffile, 'rb') as f:
+                self.assertEqual(f.read(5), b'%PDF-')
+
+
+if __name__ == '__main__':
+    unittest.main()
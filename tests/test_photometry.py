@@ -0,0 +1,111 @@
+"""
+Test the batched photometry
+"""
+
+import unittest
+import importlib.util
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from emgwcave.photometry import make_photometry_table, write_photometry_dataset, \
+    read_photometry_dataset
+from emgwcave.candidate_utils import make_photometry, save_candidates_to_file
+from emgwcave.candidate_table import CandidateTable
+
+has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+
+
+def get_candidates():
+    candidates = []
+    for ind in range(3):
+        jd = 2460001.5 + ind
+        candidate = {'jd': jd, 'fid': 1, 'magpsf': 19., 'sigmapsf': 0.1,
+                     'diffmaglim': 20.5, 'isdiffpos': 't'}
+        prv_candidates = [
+            # duplicate of the latest alert
+            {'jd': jd, 'fid': 1, 'magpsf': 19., 'sigmapsf': 0.1, 'diffmaglim': 20.5,
+             'isdiffpos': 't'},
+            # non detection
+            {'jd': jd - 2, 'fid': 2, 'diffmaglim': 20.},
+            # bad data
+            {'jd': jd - 1, 'fid': 2, 'magpsf': 18., 'sigmapsf': 0.1,
+             'diffmaglim': -99., 'isdiffpos': 't'},
+            # negative subtraction
+            {'jd': jd - 0.5, 'fid': 3, 'magpsf': 18.5, 'sigmapsf': 0.2,
+             'diffmaglim': 20., 'isdiffpos': 'f'},
+        ]
+        candidates.append({'objectId': f'ZTF23aaa{ind:05d}', 'candidate': candidate,
+                           'prv_candidates': prv_candidates[:ind + 2]})
+    return candidates
+
+
+class TestPhotometry(unittest.TestCase):
+    """Test the photometry table of many candidates"""
+
+    def test_photometry_table(self):
+        """Test the de-duplication, flux conversion and per-object slices"""
+        candidates = get_candidates()
+        photometry = make_photometry_table(candidates)
+        self.assertEqual(photometry.object_ids(),
+                         [candidate['objectId'] for candidate in candidates])
+        self.assertIsInstance(photometry.data['filter'].dtype, pd.CategoricalDtype)
+
+        last = photometry['ZTF23aaa00002']
+        self.assertEqual(list(last['filter']), ['ztfr', 'ztfi', 'ztfg'])
+        self.assertEqual(list(last.index), [1, 3, 0])
+        self.assertTrue(np.all(np.diff(last['mjd']) > 0))
+        np.testing.assert_allclose(last['flux'],
+                                   [np.nan, -10 ** (-0.4 * (18.5 - 23.9)),
+                                    10 ** (-0.4 * (19. - 23.9))], rtol=1e-6)
+        np.testing.assert_allclose(last['fluxerr'].iloc[0],
+                                   10 ** (-0.4 * (20. - 23.9)) / 5.)
+        self.assertEqual(len(photometry['ZTF23aaa00000']), 2)
+
+        table_photometry = make_photometry_table(CandidateTable.from_alerts(candidates))
+        for candidate in candidates:
+            name = candidate['objectId']
+            pd.testing.assert_frame_equal(table_photometry[name], photometry[name])
+            pd.testing.assert_frame_equal(make_photometry(candidate), photometry[name])
+
+        recent = make_photometry_table(candidates, jd_start=2460002.5)
+        self.assertEqual(len(recent['ZTF23aaa00000']), 0)
+        self.assertEqual(list(recent['ZTF23aaa00002']['jd']), [2460003.0, 2460003.5])
+
+    @unittest.skipUnless(has_pyarrow, "pyarrow is not installed")
+    def test_parquet_outputs(self):
+        """Test that the photometry dataset and candidates file keep their dtypes"""
+        candidates = get_candidates()
+        candidates[0]['stationary_flag'] = True
+        photometry = make_photometry_table(candidates)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataset_path = os.path.join(tmpdir, 'photometry.parquet')
+            # Writing again replaces the dataset
+            write_photometry_dataset(photometry, dataset_path)
+            write_photometry_dataset(photometry, dataset_path)
+            read_photometry = read_photometry_dataset(
+                dataset_path, object_ids=['ZTF23aaa00002', 'ZTF23aaa00005'],
+                columns=['mjd', 'filter', 'flux'])
+
+            savefile = os.path.join(tmpdir, 'candidates.parquet')
+            save_candidates_to_file(candidates, savefile, output_format='parquet')
+            saved_candidates = pd.read_parquet(savefile)
+
+        self.assertEqual(read_photometry.object_ids(),
+                         ['ZTF23aaa00002', 'ZTF23aaa00005'])
+        self.assertEqual(len(read_photometry['ZTF23aaa00005']), 0)
+        pd.testing.assert_frame_equal(
+            read_photometry['ZTF23aaa00002'],
+            photometry['ZTF23aaa00002'][['objectId', 'mjd', 'filter', 'flux']],
+            check_categorical=False, check_index_type=False)
+
+        self.assertEqual(saved_candidates['candidate.fid'].dtype, np.int64)
+        self.assertEqual(saved_candidates['candidate.jd'].dtype, np.float64)
+        self.assertEqual(list(saved_candidates['stationary_flag']), [True, None, None])
+        self.assertEqual(json.loads(saved_candidates['prv_candidates'].iloc[0]),
+                         candidates[0]['prv_candidates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
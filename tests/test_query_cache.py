@@ -0,0 +1,186 @@
+"""
+Test the on-disk cache of kowalski queries
+"""
+
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+from astropy.time import Time
+from emgwcave.query_cache import QueryCache, CachedKowalski, get_query_key, \
+    get_skymap_query_key, get_query_ttl, get_staleness_warning
+
+skymap_path = 'data/skymaps/2023-04-30T07-47-19_crossmatch-9457-9455.fits.fits'
+
+
+class FakeKowalski:
+    """Answers skymap queries with the given responses, in turn"""
+
+    def __init__(self, skymap_responses: list[dict]):
+        self.skymap_responses = skymap_responses
+        self.n_queries = 0
+
+    def query_skymap(self, path, **kwargs):
+        response = self.skymap_responses[self.n_queries]
+        self.n_queries += 1
+        return response
+
+
+class TestQueryCache(unittest.TestCase):
+    """Test the query cache"""
+
+    def test_failed_skymap_query_not_cached(self):
+        """Test that failed skymap queries are not cached, so that they are retried"""
+        failed_response = {'default': {'message': 'max_time_ms exceeded'}}
+        response = {'default': {'ZTF_alerts': [{'objectId': 'ZTF23aaaaaaa'}]}}
+        kwargs = dict(cumprob=0.9, jd_start=2460000.5, jd_end=2460001.5,
+                      catalogs=['ZTF_alerts'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fake_kowalski = FakeKowalski([failed_response, response])
+            k = CachedKowalski(fake_kowalski, QueryCache(tmpdir))
+            self.assertEqual(k.query_skymap(path=skymap_path, **kwargs),
+                             failed_response)
+            self.assertEqual(k.query_skymap(path=skymap_path, **kwargs), response)
+            self.assertEqual(k.query_skymap(path=skymap_path, **kwargs), response)
+            self.assertEqual(fake_kowalski.n_queries, 2)
+
+    def test_ttl_expiry(self):
+        """Test that entries expire after their time-to-live, and are removed"""
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('emgwcave.query_cache.time.time') as clock:
+            clock.return_value = 1000.
+            cache = QueryCache(tmpdir)
+            cache.set('live', 'alerts', ttl=60.)
+            cache.set('historical', 'alerts', ttl=None)
+            self.assertEqual(cache.get('live'), (True, 'alerts'))
+
+            clock.return_value = 1061.
+            self.assertEqual(cache.get('live'), (False, None))
+            self.assertFalse(cache._path('live').exists())
+            clock.return_value = 1e12
+            self.assertEqual(cache.get('historical'), (True, 'alerts'))
+            self.assertEqual(cache.get_stats()['hits'], 2)
+            self.assertEqual(cache.get_stats()['misses'], 1)
+            self.assertEqual(cache._size, cache._path('historical').stat().st_size)
+
+    def test_live_hits_reported(self):
+        """Test that hits on live entries are counted with their age, and reported
+        by the staleness warning, and that hits on entries that never expire are
+        not"""
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('emgwcave.query_cache.time.time') as clock:
+            clock.return_value = 1000.
+            cache = QueryCache(tmpdir)
+            cache.set('historical', 'alerts', ttl=None)
+            cache.set('live', 'photometry', ttl=3600.)
+            clock.return_value = 1600.
+            self.assertTrue(cache.get('historical')[0])
+            self.assertIsNone(get_staleness_warning(cache.get_stats()))
+
+            self.assertTrue(cache.get('live')[0])
+            clock.return_value = 2200.
+            self.assertTrue(cache.get('live')[0])
+            stats = cache.get_stats()
+            self.assertEqual(stats['hits'], 3)
+            self.assertEqual(stats['live_hits'], 2)
+            self.assertEqual(stats['max_live_age_min'], 20.)
+            self.assertIn('2 results', get_staleness_warning(stats))
+            self.assertIn('20 min old', get_staleness_warning(stats))
+
+    def test_query_ttl(self):
+        """Test that only the results that can change expire"""
+        now_jd = Time.now().jd
+        skymap_query = dict(skymap_hash='0', cumprob=0.9, jd_start=now_jd - 3)
+        self.assertEqual(get_query_ttl('query_skymap',
+                                       {**skymap_query, 'jd_end': now_jd}), 3600.)
+        self.assertIsNone(get_query_ttl('query_skymap',
+                                        {**skymap_query, 'jd_end': now_jd - 3}))
+        aux_query = {'query_type': 'find',
+                     'query': {'catalog': 'ZTF_alerts_aux', 'filter': {'_id': 'a'}}}
+        candid_query = {'query_type': 'find',
+                        'query': {'catalog': 'ZTF_alerts',
+                                  'filter': {'candid': {'$in': [1, 2]}}}}
+        cone_query = {'query_type': 'cone_search', 'query': {}}
+        latest_query = {'query_type': 'aggregate',
+                        'query': {'catalog': 'ZTF_alerts', 'pipeline': []}}
+        self.assertEqual(get_query_ttl('query', aux_query, live_ttl=10.), 10.)
+        self.assertIsNone(get_query_ttl('query', candid_query))
+        self.assertIsNone(get_query_ttl('query', cone_query))
+        self.assertEqual(get_query_ttl('query', latest_query), 3600.)
+
+    def test_live_skymap_query_expires(self):
+        """Test that a skymap query of recent alerts is run again once expired"""
+        response = {'default': {'ZTF_alerts': []}}
+        kwargs = dict(cumprob=0.9, jd_start=Time.now().jd - 1, jd_end=Time.now().jd,
+                      catalogs=['ZTF_alerts'])
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('emgwcave.query_cache.time.time') as clock:
+            clock.return_value = 1000.
+            fake_kowalski = FakeKowalski([response] * 3)
+            k = CachedKowalski(fake_kowalski, QueryCache(tmpdir, live_ttl=60.))
+            k.query_skymap(path=skymap_path, **kwargs)
+            k.query_skymap(path=skymap_path, **kwargs)
+            self.assertEqual(fake_kowalski.n_queries, 1)
+            clock.return_value = 1061.
+            k.query_skymap(path=skymap_path, **kwargs)
+            self.assertEqual(fake_kowalski.n_queries, 2)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entries are evicted first, down to 10%
+        below the size cap"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Incompressible entries of about 30 kB, 3 of them fit in 100 kB
+            cache = QueryCache(tmpdir, max_size_mb=100 / 1024)
+            for mtime, key in enumerate(['a', 'b', 'c']):
+                cache.set(key, os.urandom(30000))
+                os.utime(cache._path(key), (mtime, mtime))
+            # Reading a touches it, so b is now the least recently used
+            self.assertTrue(cache.get('a')[0])
+            cache.set('d', os.urandom(30000))
+
+            self.assertEqual([cache.get(key)[0] for key in ['a', 'b', 'c', 'd']],
+                             [True, False, True, True])
+            self.assertLessEqual(cache._size, 0.9 * cache.max_size)
+            self.assertEqual(cache._size, sum(path.stat().st_size
+                                              for path in cache._entries()))
+            # The size is recovered from the files by a new cache on the same
+            # directory
+            self.assertEqual(QueryCache(tmpdir)._size, cache._size)
+
+    def test_key_stability(self):
+        """Test that keys do not depend on the order of the query fields, nor on
+        the path of the skymap, only on its contents"""
+        query = {'query_type': 'find',
+                 'query': {'catalog': 'ZTF_alerts_aux', 'filter': {'_id': 'a'},
+                           'projection': {'prv_candidates.jd': 1}}}
+        reordered_query = {'query': {'projection': {'prv_candidates.jd': 1},
+                                     'filter': {'_id': 'a'},
+                                     'catalog': 'ZTF_alerts_aux'},
+                           'query_type': 'find'}
+        self.assertEqual(get_query_key('query', query),
+                         get_query_key('query', reordered_query))
+        self.assertNotEqual(get_query_key('query', query),
+                            get_query_key('query_skymap', query))
+        # Keys are stable across versions, so that existing caches stay valid
+        self.assertEqual(get_query_key('query', {'b': 2, 'a': 1}),
+                         hashlib.sha256(b'query:{"a": 1, "b": 2}').hexdigest())
+
+        kwargs = dict(cumprob=0.9, jd_start=2460000.5, jd_end=2460001.5)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            copied_path = shutil.copy(skymap_path, tmpdir)
+            key, _ = get_skymap_query_key(skymap_path, kwargs)
+            self.assertEqual(get_skymap_query_key(copied_path,
+                                                  {**kwargs, 'max_n_threads': 4})[0],
+                             key)
+            self.assertNotEqual(get_skymap_query_key(skymap_path,
+                                                     {**kwargs, 'cumprob': 0.5})[0],
+                                key)
+            with open(copied_path, 'ab') as f:
+                f.write(b' ')
+            self.assertNotEqual(get_skymap_query_key(copied_path, kwargs)[0], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+"""
+Test localization checks on multi-order skymaps
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import healpy as hp
+from astropy.table import Table
+from ligo.skymap.moc import rasterize
+from ligo.skymap.postprocess import find_greedy_credible_levels
+from emgwcave.skymap_utils import read_fermi_skymap_fits, Skymap, \
+    write_union_skymap, write_coarsened_skymap, flatten_skymap, read_flattened_skymap
+
+skymap_paths = ['data/skymaps/2023-04-17T22-42-11_bayestar.multiorder.fits',
+                'data/skymaps/2023-04-30T07-47-19_crossmatch-9457-9455.fits.fits']
+
+
+def get_random_coordinates(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    ras = rng.uniform(0, 360, n)
+    decs = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    return ras, decs
+
+
+def get_rasterized_mask(skymap_path: str, ras: np.ndarray, decs: np.ndarray,
+                        cumprob: float):
+    """Whether the positions are in the credible region of the rasterized map"""
+    uniq, prob_density, _ = read_fermi_skymap_fits(skymap_path)
+    flattened_density = np.asarray(rasterize(Table(
+        {'UNIQ': uniq, 'PROBDENSITY': prob_density}))['PROBDENSITY'])
+    nside = hp.npix2nside(len(flattened_density))
+    credible_levels = find_greedy_credible_levels(
+        flattened_density * hp.nside2pixarea(nside))
+    ipix = hp.ang2pix(nside, ras, decs, nest=True, lonlat=True)
+    return credible_levels[ipix] <= cumprob
+
+
+class TestMOCLocalization(unittest.TestCase):
+    """Test the multi-order localization check"""
+
+    def test_moc_matches_flattened(self):
+        """Test that the MOC check agrees with a check on the rasterized map"""
+        ras, decs = get_random_coordinates(20000)
+        for skymap_path in skymap_paths:
+            moc_mask = Skymap(skymap_path, cache=False).contains(ras, decs, 0.9)
+            self.assertGreater(np.sum(moc_mask), 0)
+            np.testing.assert_array_equal(
+                moc_mask, get_rasterized_mask(skymap_path, ras, decs, 0.9))
+
+
+class TestFlattenedSkymap(unittest.TestCase):
+    """Test reading flattened skymaps against healpy.read_map"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.nested_path = os.path.join(cls.tmpdir, 'nested.fits')
+        flatten_skymap(skymap_paths[0], cls.nested_path)
+        maps = hp.read_map(cls.nested_path, field=[0, 1, 2, 3], nest=True)
+        cls.ring_path = os.path.join(cls.tmpdir, 'ring.fits')
+        hp.write_map(cls.ring_path, [hp.reorder(x, n2r=True) for x in maps],
+                     nest=False, column_names=['PROB', 'DISTMU', 'DISTSIGMA',
+                                               'DISTNORM'])
+        cls.prob_only_path = os.path.join(cls.tmpdir, 'prob_only.fits')
+        hp.write_map(cls.prob_only_path, maps[0], nest=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_matches_read_map(self):
+        """Test that RING and NESTED maps are read as healpy reads them, in RING
+        ordering"""
+        expected = hp.read_map(self.ring_path, field=[0, 1, 2, 3])
+        for path in [self.ring_path, self.nested_path]:
+            (prob, distmu, distsigma, distnorm), _ = read_flattened_skymap(
+                path, read_distance=True)
+            np.testing.assert_array_equal(prob, hp.read_map(path))
+            for values, expected_values in zip([prob, distmu, distsigma, distnorm],
+                                               expected):
+                np.testing.assert_array_equal(values, expected_values)
+            (prob_only, distmu, _, _), _ = read_flattened_skymap(path)
+            np.testing.assert_array_equal(prob_only, prob)
+            self.assertIsNone(distmu)
+
+        (prob, distmu, _, _), _ = read_flattened_skymap(self.prob_only_path,
+                                                        read_distance=True)
+        np.testing.assert_array_equal(prob, expected[0])
+        self.assertIsNone(distmu)
+
+    def test_partial_map(self):
+        """Test that the pixels missing from an explicit-index partial-sky map have
+        no probability and no distance"""
+        maps = hp.read_map(self.ring_path, field=[0, 1, 2, 3])
+        in_map = maps[0] > 0
+        partial_maps = [np.where(in_map, x, hp.UNSEEN) for x in maps]
+        partial_path = os.path.join(self.tmpdir, 'partial.fits')
+        hp.write_map(partial_path, partial_maps, partial=True, overwrite=True)
+        (prob, distmu, distsigma, distnorm), _ = read_flattened_skymap(
+            partial_path, read_distance=True)
+        np.testing.assert_array_equal(prob, np.where(in_map, maps[0], 0.))
+        for values, expected_values in zip([distmu, distsigma, distnorm], maps[1:]):
+            np.testing.assert_array_equal(values[in_map], expected_values[in_map])
+            self.assertTrue(np.all(np.isnan(values[~in_map])))
+        ras, decs = get_random_coordinates(1000)
+        np.testing.assert_array_equal(
+            Skymap(partial_path, cache=False).get_credible_levels(ras, decs),
+            Skymap(self.ring_path, cache=False).get_credible_levels(ras, decs))
+
+
+class TestSkymap(unittest.TestCase):
+    """Test the cached credible levels of a skymap"""
+
+    def test_cached_credible_levels(self):
+        """Test that cached credible levels give the same answers"""
+        ras, decs = get_random_coordinates(20000, seed=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            skymap_path = shutil.copy(skymap_paths[0], tmpdir)
+            cache_dir = os.path.join(tmpdir, 'cache')
+
+            skymap = Skymap(skymap_path, cache_dir=cache_dir)
+            self.assertTrue(skymap.is_moc)
+            self.assertTrue(os.path.exists(skymap.get_cache_path('credible_levels')))
+            cached_skymap = Skymap(skymap_path, cache_dir=cache_dir)
+            for cumprob in [0.5, 0.9]:
+                expected_mask = get_rasterized_mask(skymap_path, ras, decs, cumprob)
+                np.testing.assert_array_equal(skymap.contains(ras, decs, cumprob),
+                                              expected_mask)
+                np.testing.assert_array_equal(
+                    cached_skymap.contains(ras, decs, cumprob), expected_mask)
+            self.assertIsInstance(cached_skymap.credible_levels, np.memmap)
+
+    def test_stale_cache_removed(self):
+        """Test that caching a new version of a skymap removes the files cached for
+        the earlier versions, and only those"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            skymap_path = shutil.copy(skymap_paths[0], os.path.join(tmpdir, 'S1.fits'))
+            old_files = Skymap(skymap_path, cache_dir=tmpdir).get_cache_path('*')
+            _ = Skymap(skymap_path, cache_dir=tmpdir).credible_levels
+            other_path = shutil.copy(skymap_paths[1],
+                                     os.path.join(tmpdir, 'S1.fits.update.fits'))
+            _ = Skymap(other_path, cache_dir=tmpdir).credible_levels
+
+            # A new version of the skymap, with a different hash
+            shutil.copy(skymap_paths[1], skymap_path)
+            new_skymap = Skymap(skymap_path, cache_dir=tmpdir)
+            _ = new_skymap.credible_levels
+            cached_files = sorted(os.listdir(tmpdir))
+            self.assertEqual(len(cached_files), 6)
+            self.assertNotIn(os.path.basename(old_files.replace('*', 'credible_levels')),
+                             cached_files)
+            for name in ['credible_levels', 'first_ipix']:
+                self.assertIn(os.path.basename(new_skymap.get_cache_path(name)),
+                              cached_files)
+                self.assertIn(os.path.basename(
+                    Skymap(other_path, cache_dir=tmpdir).get_cache_path(name)),
+                              cached_files)
+
+    def test_union_skymap(self):
+        """Test that the union skymap covers the credible regions of all maps"""
+        ras, decs = get_random_coordinates(20000, seed=2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = [shutil.copy(skymap_path, tmpdir) for skymap_path in skymap_paths]
+            union_path = os.path.join(tmpdir, 'union_skymap.fits')
+            union_cumprob = write_union_skymap(paths, cumprob=0.9,
+                                               savepath=union_path)
+            in_any_mask = np.any([Skymap(path).contains(ras, decs, 0.9)
+                                  for path in paths], axis=0)
+            in_union_mask = Skymap(union_path).contains(ras, decs, union_cumprob)
+            self.assertGreater(np.sum(in_any_mask), 0)
+            self.assertTrue(np.all(in_union_mask[in_any_mask]))
+
+    def test_coarsened_skymap(self):
+        """Test that the coarsened skymap is a superset of the credible region with
+        a bounded number of cells"""
+        ras, decs = get_random_coordinates(20000, seed=3)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for skymap_path in skymap_paths:
+                path = shutil.copy(skymap_path, tmpdir)
+                coarsened_path = os.path.join(tmpdir, 'coarsened_skymap.fits')
+                query_cumprob, order, exact_area, coarsened_area = \
+                    write_coarsened_skymap(path, cumprob=0.9,
+                                           savepath=coarsened_path, max_cells=500)
+                coarsened_skymap = Skymap(coarsened_path, cache=False)
+                n_cells = np.sum(coarsened_skymap.credible_levels <= query_cumprob)
+                self.assertLessEqual(n_cells, 500)
+                self.assertGreaterEqual(coarsened_area, exact_area)
+                in_region_mask = Skymap(path).contains(ras, decs, 0.9)
+                in_coarsened_mask = coarsened_skymap.contains(ras, decs,
+                                                              query_cumprob)
+                self.assertTrue(np.all(in_coarsened_mask[in_region_mask]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Test the binary thumbnail storage
+"""
+
+import unittest
+import gzip
+import io
+import tempfile
+import numpy as np
+from astropy.io import fits
+from emgwcave.plotting import save_thumbnails, load_thumbnails, get_data_from_bytes
+
+
+def get_stamp(data):
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data).writeto(buffer)
+    return {'stampData': gzip.compress(buffer.getvalue())}
+
+
+class TestThumbnails(unittest.TestCase):
+    """Test that thumbnails are saved as binary arrays in a single file"""
+
+    def test_save_thumbnails(self):
+        """Test that the saved, returned and raw thumbnails match the cutouts"""
+        rng = np.random.default_rng(0)
+        candidates = []
+        for ind in range(3):
+            candidate = {'objectId': f'ZTF23aaa{ind:05d}'}
+            for key in ['cutoutScience', 'cutoutTemplate', 'cutoutDifference']:
+                data = rng.normal(size=(63, 63)).astype(np.float32)
+                data[0, ind] = np.nan
+                candidate[key] = get_stamp(data)
+            candidates.append(candidate)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            thumbnails = save_thumbnails(candidates, thumbnails_dir=tmpdir,
+                                         keep_raw=True)
+            with load_thumbnails(tmpdir) as saved_thumbnails:
+                saved_thumbnails = dict(saved_thumbnails)
+            with load_thumbnails(tmpdir, raw=True) as raw_thumbnails:
+                raw_thumbnails = dict(raw_thumbnails)
+
+        self.assertEqual(len(saved_thumbnails), 9)
+        for candidate in candidates:
+            name = candidate['objectId']
+            for kind, key in [('sci', 'cutoutScience'), ('ref', 'cutoutTemplate'),
+                              ('diff', 'cutoutDifference')]:
+                data = get_data_from_bytes(candidate[key]['stampData'])
+                np.testing.assert_array_equal(saved_thumbnails[f'{name}_{kind}'], data)
+                np.testing.assert_array_equal(thumbnails[f'{name}_{kind}'], data)
+                self.assertEqual(raw_thumbnails[f'{name}_{kind}'].tobytes(),
+                                 candidate[key]['stampData'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Test the tiled skymap queries
+"""
+
+import unittest
+import os
+import tempfile
+import threading
+import healpy as hp
+import numpy as np
+import pandas as pd
+import requests
+from emgwcave.skymap_utils import Skymap, write_region_skymap, max_healpix_order
+from emgwcave.tiled_query import search_in_skymap_tiled, plan_query_tiles, QueryTile
+
+skymap_path = 'data/skymaps/2023-04-17T22-42-11_bayestar.multiorder.fits'
+
+
+def get_random_coordinates(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    ras = rng.uniform(0, 360, n)
+    decs = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    return ras, decs
+
+
+class FakeKowalski:
+    """Returns the alerts inside the queried skymap, and times out on tiles larger
+    than max_area"""
+
+    def __init__(self, ras, decs, max_area):
+        self.ras = ras
+        self.decs = decs
+        self.max_area = max_area
+        self.lock = threading.Lock()
+        self.n_queries = 0
+
+    def query_skymap(self, path, cumprob, **kwargs):
+        with self.lock:
+            self.n_queries += 1
+        skymap = Skymap(path, cache=False)
+        in_tile = skymap.contains(self.ras, self.decs, cumprob)
+        starts, ends = skymap.get_credible_region_ranges(cumprob)
+        area = np.sum(ends - starts) * hp.nside2pixarea(2 ** max_healpix_order,
+                                                        degrees=True)
+        if area > self.max_area:
+            return {'default': {'message': 'max_time_ms exceeded'}}
+        return {'default': {'ZTF_alerts': [{'candid': int(ind)}
+                                           for ind in np.where(in_tile)[0]]}}
+
+
+class FailingKowalski:
+    """Fails every query, by raising error or by returning it as the message"""
+
+    def __init__(self, error):
+        self.error = error
+        self.lock = threading.Lock()
+        self.n_queries = 0
+
+    def query_skymap(self, **kwargs):
+        with self.lock:
+            self.n_queries += 1
+        if isinstance(self.error, Exception):
+            raise self.error
+        return {'default': {'status': 'error', 'message': self.error}}
+
+
+class TestTiledQuery(unittest.TestCase):
+    """Test the tiled skymap queries"""
+
+    def test_tiled_query(self):
+        """Test that tiles cover the credible region, and that tiles that fail are
+        split until they succeed"""
+        ras, decs = get_random_coordinates(20000)
+        in_region = Skymap(skymap_path).contains(ras, decs, 0.9)
+
+        tiles = plan_query_tiles(skymap_path, 0.9, 0., 1., n_tiles=8)
+        self.assertEqual(len(tiles), 8)
+        tile_sizes = [len(tile.ipix) for tile in tiles]
+        self.assertLessEqual(max(tile_sizes) - min(tile_sizes), 1)
+        max_area = 0.6 * tiles[0].area
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            timings_path = os.path.join(tmpdir, 'timings.csv')
+            k = FakeKowalski(ras, decs, max_area=max_area)
+            response = search_in_skymap_tiled(k, skymap_path, cumprob=0.9,
+                                              jd_start=0., jd_end=1.,
+                                              jdstarthist_start=0.,
+                                              jdstarthist_end=1., n_workers=3,
+                                              n_tiles=8, timings_path=timings_path)
+            timings = pd.read_csv(timings_path)
+
+        candids = [alert['candid'] for alert in response['default']['ZTF_alerts']]
+        self.assertEqual(len(candids), len(set(candids)))
+        self.assertTrue(np.all(np.isin(np.where(in_region)[0], candids)))
+        self.assertEqual(np.sum(timings['status'] == 'failed'), 8)
+        self.assertEqual(np.sum(timings['status'] == 'success'), 16)
+        self.assertEqual(k.n_queries, 24)
+
+    def test_region_skymap(self):
+        """Test that a tile is written as a small multi-order skymap whose credible
+        region is exactly the tile"""
+        ras, decs = get_random_coordinates(20000)
+        tiles = plan_query_tiles(skymap_path, 0.9, 0., 1., n_tiles=8, order=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tile_path = os.path.join(tmpdir, 'tile.fits')
+            cumprob = write_region_skymap(tiles[0].ipix, order=10, savepath=tile_path)
+            self.assertLess(os.path.getsize(tile_path), 1e6)
+            in_tile = Skymap(tile_path, cache=False).contains(ras, decs, cumprob)
+        ipix = hp.ang2pix(2 ** 10, ras, decs, nest=True, lonlat=True)
+        self.assertGreater(np.sum(in_tile), 0)
+        np.testing.assert_array_equal(in_tile, np.isin(ipix, tiles[0].ipix))
+
+    def test_split_jd_window(self):
+        """Test that an alert at the middle of a split jd window is queried once"""
+        tile = QueryTile('0', [5], order=10, jd_start=0., jd_end=1.)
+        first, second = tile.split(max_order=10, min_jd_window=0.1)
+        jds = np.array([0., 0.25, 0.5, 0.75, 1.])
+        n_queried = np.zeros(len(jds), dtype=int)
+        # The first half is split again, at 0.25
+        for part in first.split(max_order=10, min_jd_window=0.1) + [second]:
+            n_queried += (jds > part.jd_start) & (jds < part.query_jd_end)
+        np.testing.assert_array_equal(n_queried, [0, 1, 1, 1, 0])
+
+    def test_worker_error(self):
+        """Test that an error in a worker is raised instead of hanging"""
+        class BrokenKowalski:
+            def query_skymap(self, **kwargs):
+                return {'default': {'ZTF_alerts': [None]}}
+
+        with self.assertRaises(AttributeError):
+            search_in_skymap_tiled(BrokenKowalski(), skymap_path, cumprob=0.9,
+                                   jd_start=0., jd_end=1., jdstarthist_start=0.,
+                                   jdstarthist_end=1., n_workers=2, n_tiles=4)
+
+    def test_query_error_not_split(self):
+        """Test that errors other than timeouts are raised after a single attempt
+        of each tile, instead of splitting the tiles"""
+        query_kwargs = {'skymap_path': skymap_path, 'cumprob': 0.9, 'jd_start': 0.,
+                        'jd_end': 1., 'jdstarthist_start': 0., 'jdstarthist_end': 1.,
+                        'n_workers': 1, 'n_tiles': 1}
+        for error, error_type in [
+                (requests.exceptions.ConnectionError('Connection refused'),
+                 requests.exceptions.ConnectionError),
+                (requests.exceptions.ConnectTimeout('Connection timed out'),
+                 requests.exceptions.ConnectTimeout),
+                ('Unauthorized', ValueError)]:
+            k = FailingKowalski(error)
+            with self.assertRaises(error_type):
+                search_in_skymap_tiled(k, **query_kwargs)
+            self.assertEqual(k.n_queries, 1)
+
+        # Queries that always time out are split a limited number of times
+        k = FailingKowalski('operation exceeded time limit')
+        with self.assertRaises(ValueError):
+            search_in_skymap_tiled(k, **query_kwargs, max_split_depth=2)
+        self.assertEqual(k.n_queries, 1 + 2 + 4)
+
+
+if __name__ == '__main__':
+    unittest.main()